@@ -0,0 +1,173 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+from PIL import Image
+
+from .image_processing import DITHER_OPTIONS, process_image, settings
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+CHECKPOINT_FILE = '.batch-checkpoint.jsonl'  # Written to the output folder, one line per finished image
+
+
+def find_images(inputs):
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            paths.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            paths.append(path)
+    # An image named twice (on its own and in its folder, say) is processed once
+    unique, seen = [], set()
+    for path in paths:
+        if os.path.abspath(path) not in seen:
+            seen.add(os.path.abspath(path))
+            unique.append(path)
+    return unique
+
+
+def output_names(paths):
+    # processed_<name>.png, with part of a hash of the full path added to names two inputs
+    # share (photos/cat.jpg and scans/cat.png, say), so no output overwrites another
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    counts = Counter(stem.lower() for stem in stems)
+    names = {}
+    for path, stem in zip(paths, stems):
+        if counts[stem.lower()] > 1:
+            stem += '-' + hashlib.sha256(os.path.abspath(path).encode('utf-8')).hexdigest()[:8]
+        names[path] = f'processed_{stem}.png'
+    return names
+
+
+def _entry(path, name, dither, profile):
+    # What a checkpoint line records: an image changed since then, or now saved under
+    # another name, is processed again
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'output': name, 'size': stat.st_size, 'mtime': stat.st_mtime,
+            'dither': dither, 'profile': profile}
+
+
+def _done(entry):
+    # A checkpoint entry in a form that goes in a set
+    return tuple(sorted(entry.items()))
+
+
+def _is_done(path, name, dither, profile, done):
+    try:
+        return _done(_entry(path, name, dither, profile)) in done
+    except OSError:
+        # Gone or unreadable: left for the run to count as a failed image
+        return False
+
+
+def load_checkpoint(output):
+    done = []
+    try:
+        with open(os.path.join(output, CHECKPOINT_FILE)) as f:
+            for line in f:
+                try:
+                    done.append(json.loads(line))
+                except ValueError:
+                    # A line cut short by an interrupted run
+                    continue
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def _init_worker():
+    # One process per core already; OpenCV's own threads would only fight over them
+    cv2.setNumThreads(1)
+
+
+def _process(path, destination, dither, profile):
+    start = time.perf_counter()
+    image, _ = process_image(path, dither, False, profile=profile)
+    image.save(destination)
+    return time.perf_counter() - start
+
+
+def run_batch(inputs, output, dither=None, profile=None, workers=None, print_images=False, resume=False):
+    from .printing import print_image
+
+    os.makedirs(output, exist_ok=True)
+    paths = find_images(inputs)
+    names = output_names(paths)
+    skipped = set()
+    if resume:
+        done = {_done(entry) for entry in load_checkpoint(output)}
+        skipped = {path for path in paths if _is_done(path, names[path], dither, profile, done)}
+    todo = [path for path in paths if path not in skipped]
+    if skipped:
+        print(f"Resuming: {len(skipped)} of {len(paths)} images already done")
+
+    checkpoint = open(os.path.join(output, CHECKPOINT_FILE), 'a' if resume else 'w')
+    start = time.perf_counter()
+    finished = failed = 0
+    # Results arrive in whatever order the pool finishes them; printing waits for its turn
+    ready, next_to_print = {}, 0
+
+    def complete(index):
+        path = todo[index]
+        if print_images:
+            with Image.open(os.path.join(output, names[path])) as image:
+                print_image(image.copy())
+        checkpoint.write(json.dumps(_entry(path, names[path], dither, profile)) + '\n')
+        checkpoint.flush()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            futures = {executor.submit(_process, path, os.path.join(output, names[path]), dither, profile): index
+                       for index, path in enumerate(todo)}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    seconds = future.result()
+                    ready[index] = True
+                    finished += 1
+                    status = f"{seconds * 1000:.0f} ms"
+                except Exception as e:
+                    ready[index] = False
+                    failed += 1
+                    status = f"failed: {e}"
+
+                elapsed = time.perf_counter() - start
+                rate = (finished + failed) / elapsed
+                remaining = (len(todo) - finished - failed) / rate if rate else 0
+                print(f"[{finished + failed}/{len(todo)}] {os.path.basename(todo[index])} {status} "
+                      f"({rate:.1f}/s, {remaining:.0f}s left)")
+
+                while next_to_print in ready:
+                    if ready.pop(next_to_print):
+                        complete(next_to_print)
+                    next_to_print += 1
+    finally:
+        checkpoint.close()
+
+    print(f"Processed {finished} images in {time.perf_counter() - start:.1f}s"
+          + (f", {failed} failed" if failed else ''))
+    return finished, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process a folder of images for the thermal printer.")
+    parser.add_argument('inputs', nargs='+', help="Image files or folders of images")
+    parser.add_argument('-o', '--output', default='processed_images', help="Folder for the processed images")
+    parser.add_argument('--dither', choices=DITHER_OPTIONS, help="Dither for every image; default is each profile's own")
+    parser.add_argument('--profile', choices=list(settings), help="Use this settings profile instead of classifying")
+    parser.add_argument('--workers', type=int, help="Processes to use; default is one per core")
+    parser.add_argument('--print', dest='print_images', action='store_true',
+                        help="Send each image to the print spooler, in input order")
+    parser.add_argument('--resume', action='store_true', help="Skip images finished by an earlier run")
+    args = parser.parse_args(argv)
+    run_batch(args.inputs, args.output, args.dither, args.profile, args.workers, args.print_images, args.resume)
+
+
+if __name__ == '__main__':
+    main()
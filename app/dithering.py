@@ -0,0 +1,191 @@
+import numpy as np
+from PIL import Image
+
+BLUE_NOISE_SIZE = 64  # Side of the tiled blue-noise threshold map
+BLUE_NOISE_SIGMA = 1.5
+BLUE_NOISE_SEED = 576
+DIFFUSION_ROWS = 256  # Rows error diffusion works on at a time; error is carried across the seams
+
+# Error-diffusion kernels as (row offset, column offset, weight) plus the divisor
+ERROR_DIFFUSION_KERNELS = {
+    'FLOYDSTEINBERG_SERPENTINE': ([(0, 1, 7), (1, -1, 3), (1, 0, 5), (1, 1, 1)], 16),
+    'ATKINSON': ([(0, 1, 1), (0, 2, 1), (1, -1, 1), (1, 0, 1), (1, 1, 1), (2, 0, 1)], 8),
+    'JARVIS': ([(0, 1, 7), (0, 2, 5),
+                (1, -2, 3), (1, -1, 5), (1, 0, 7), (1, 1, 5), (1, 2, 3),
+                (2, -2, 1), (2, -1, 3), (2, 0, 5), (2, 1, 3), (2, 2, 1)], 48),
+    'STUCKI': ([(0, 1, 8), (0, 2, 4),
+                (1, -2, 2), (1, -1, 4), (1, 0, 8), (1, 1, 4), (1, 2, 2),
+                (2, -2, 1), (2, -1, 2), (2, 0, 4), (2, 1, 2), (2, 2, 1)], 42),
+}
+# Plain Floyd-Steinberg, for ErrorDiffuser; apply_dither uses Pillow's own for whole images
+FLOYDSTEINBERG_KERNEL = ([(0, 1, 7), (1, -1, 3), (1, 0, 5), (1, 1, 1)], 16)
+
+_blue_noise = None
+
+
+def blue_noise_matrix():
+    # Built once per process with void-and-cluster, then tiled like the Bayer matrices
+    global _blue_noise
+    if _blue_noise is None:
+        ranks = _void_and_cluster(BLUE_NOISE_SIZE, BLUE_NOISE_SIGMA, BLUE_NOISE_SEED)
+        _blue_noise = ((ranks + 0.5) * 255 / ranks.size).astype(np.uint8)
+    return _blue_noise
+
+
+def _void_and_cluster(size, sigma, seed):
+    # Toroidal Gaussian centred on (0, 0); rolling it gives one dot's energy contribution
+    offsets = np.minimum(np.arange(size), size - np.arange(size))
+    kernel = np.exp(-(offsets[:, None] ** 2 + offsets[None, :] ** 2) / (2 * sigma ** 2))
+
+    def energy_of(pattern):
+        return np.real(np.fft.ifft2(np.fft.fft2(pattern) * np.fft.fft2(kernel)))
+
+    def tightest_cluster(pattern, energy):
+        return np.unravel_index(np.argmax(np.where(pattern, energy, -np.inf)), pattern.shape)
+
+    def largest_void(pattern, energy):
+        return np.unravel_index(np.argmin(np.where(pattern, np.inf, energy)), pattern.shape)
+
+    def toggle(pattern, energy, position, value):
+        pattern[position] = value
+        energy += np.roll(kernel, position, axis=(0, 1)) * (1 if value else -1)
+
+    # Initial pattern: random dots relaxed until no dot moves
+    rng = np.random.default_rng(seed)
+    pattern = rng.random((size, size)) < 0.1
+    energy = energy_of(pattern.astype(float))
+    while True:
+        cluster = tightest_cluster(pattern, energy)
+        toggle(pattern, energy, cluster, False)
+        void = largest_void(pattern, energy)
+        if void == cluster:
+            toggle(pattern, energy, cluster, True)
+            break
+        toggle(pattern, energy, void, True)
+
+    ranks = np.zeros((size, size), dtype=np.int32)
+    ones = int(pattern.sum())
+
+    # Rank the initial dots by repeatedly removing the tightest cluster
+    work, work_energy = pattern.copy(), energy.copy()
+    for rank in range(ones - 1, -1, -1):
+        position = tightest_cluster(work, work_energy)
+        toggle(work, work_energy, position, False)
+        ranks[position] = rank
+
+    # Then rank the rest by repeatedly filling the largest void
+    for rank in range(ones, size * size):
+        position = largest_void(pattern, energy)
+        toggle(pattern, energy, position, True)
+        ranks[position] = rank
+    return ranks
+
+
+def error_diffusion_dither(image, mode):
+    gray = np.asarray(image, dtype=np.float32)
+    dithered = ErrorDiffuser(mode, gray.shape[1]).dither(gray)
+    return Image.fromarray(dithered, mode='L')
+
+
+class ErrorDiffuser:
+    # Error diffusion fed a band of rows at a time, keeping the error pushed past the last
+    # row for the next band. The work is cut at multiples of DIFFUSION_ROWS from the top,
+    # so bands that are themselves multiples of it give the same dots as one pass.
+    def __init__(self, mode, width):
+        self.kernel, self.divisor = ERROR_DIFFUSION_KERNELS.get(mode, FLOYDSTEINBERG_KERNEL)
+        self.serpentine = mode == 'FLOYDSTEINBERG_SERPENTINE'
+        self.depth = max(dy for dy, _, _ in self.kernel)
+        self.reach = max(abs(dx) for _, dx, _ in self.kernel)
+        self.row = 0
+        if self.serpentine:
+            self.carried = np.zeros((self.depth, width + 2 * self.reach), dtype=np.float32)
+        else:
+            self.carried = np.zeros((self.depth, width), dtype=np.float32)
+
+    def dither(self, gray):
+        gray = np.asarray(gray, dtype=np.float32)
+        dithered = np.empty(gray.shape, dtype=np.uint8)
+        top = 0
+        while top < gray.shape[0]:
+            bottom = min(gray.shape[0], top + DIFFUSION_ROWS - (self.row + top) % DIFFUSION_ROWS)
+            if self.serpentine:
+                dithered[top:bottom] = _serpentine_diffusion(gray[top:bottom], self.kernel, self.divisor,
+                                                             self.carried, self.row + top)
+            else:
+                dithered[top:bottom], self.carried = _wavefront_diffusion(gray[top:bottom], self.kernel,
+                                                                          self.divisor, self.carried)
+            top = bottom
+        self.row += gray.shape[0]
+        return dithered
+
+
+def _wavefront_diffusion(gray, kernel, divisor, carried):
+    # Pixel (y, x) only receives error from pixels to its left and from earlier rows, so with
+    # t = x + skew * y every pixel sharing a t is independent and a whole diagonal can be
+    # quantized in one vector step. skewed[t, y] holds pixel (y, t - skew * y); rows past
+    # the bottom collect the error carried into the next band, as carried did into this one.
+    height, width = gray.shape
+    skew = max([-dx // dy + 1 for dy, dx, _ in kernel if dy > 0 and dx < 0] + [1])
+    reach = max(abs(dx) for _, dx, _ in kernel)
+    depth = max(dy for dy, _, _ in kernel)
+    steps = width + skew * (height - 1)
+
+    skewed = np.zeros((steps + reach + skew * depth, height + depth), dtype=np.float32)
+    rows = np.arange(height)[:, None]
+    columns = np.arange(width)[None, :]
+    skewed[columns + skew * rows, rows] = gray
+    received = min(height, depth)
+    skewed[columns + skew * rows[:received], rows[:received]] += carried[:received]
+    weights = [(dy, dx + skew * dy, weight / divisor) for dy, dx, weight in kernel]
+
+    for t in range(steps):
+        # Rows whose x = t - skew * y falls inside the image form one contiguous run
+        first = max(0, -(-(t - width + 1) // skew))
+        last = min(height, t // skew + 1)
+        values = skewed[t, first:last]
+        quantized = np.where(values >= 128, 255.0, 0.0)
+        error = values - quantized
+        values[:] = quantized
+        for dy, dt, weight in weights:
+            skewed[t + dt, first + dy:last + dy] += error * weight
+
+    below = height + np.arange(depth)[:, None]
+    spill = skewed[columns + skew * below, below]
+    # A band shorter than the kernel passes on what it did not take in itself
+    spill[:depth - received] += carried[received:]
+    return (skewed[columns + skew * rows, rows] > 0).astype(np.uint8) * 255, spill
+
+
+def _serpentine_diffusion(gray, kernel, divisor, carried, first_row):
+    # Serpentine scanning reverses direction every row, so rows cannot overlap; the
+    # scan along a row is scalar but spreading into the rows below is vectorized.
+    # carried holds the error already spread into the next rows and is updated in place.
+    height, width = gray.shape
+    reach = max(abs(dx) for _, dx, _ in kernel)
+    dithered = np.zeros((height, width), dtype=np.uint8)
+    same_row = [(dx, weight / divisor) for dy, dx, weight in kernel if dy == 0]
+    below = [(dy, dx, weight / divisor) for dy, dx, weight in kernel if dy > 0]
+
+    for y in range(height):
+        values = (gray[y] + carried[0, reach:reach + width]).tolist()
+        errors = [0.0] * width
+        reverse = (first_row + y) % 2 == 1
+        for x in (range(width - 1, -1, -1) if reverse else range(width)):
+            value = values[x]
+            quantized = 255.0 if value >= 128 else 0.0
+            error = value - quantized
+            errors[x] = error
+            values[x] = quantized
+            for dx, weight in same_row:
+                target = x - dx if reverse else x + dx
+                if 0 <= target < width:
+                    values[target] += error * weight
+        dithered[y] = values
+
+        row_errors = np.asarray(errors, dtype=np.float32)
+        carried[:-1] = carried[1:]
+        carried[-1] = 0
+        for dy, dx, weight in below:
+            shift = -dx if reverse else dx
+            carried[dy - 1, reach + shift:reach + shift + width] += row_errors * weight
+    return dithered
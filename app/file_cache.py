@@ -0,0 +1,65 @@
+import os
+import time
+import uuid
+
+# What the preview and raster caches share: one file per key in a directory of their own,
+# written under a private name and renamed into place so other processes never see a
+# partial entry, with the least recently used removed once the directory outgrows its
+# budget. Every process keeps a running total of each directory instead of measuring it
+# on each write; the total is measured again when it goes over the budget and every
+# RESCAN_SECONDS, which is when the writes of other processes count.
+RESCAN_SECONDS = 60
+
+# Directory -> (bytes it holds as far as this process knows, when it was last measured)
+_sizes = {}
+
+
+def entry_path(directory, key, suffix):
+    # Keys are hex digests; anything else never touches the filesystem
+    if not key or not all(c in '0123456789abcdef' for c in key):
+        return None
+    return os.path.join(directory, f'{key}.{suffix}')
+
+
+def write_atomic(path, write, max_bytes):
+    # write(f) fills the entry through an open binary file
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    partial = os.path.join(directory, f'.{uuid.uuid4().hex}')
+    with open(partial, 'wb') as f:
+        write(f)
+        size = f.tell()
+    try:
+        replaced = os.path.getsize(path)
+    except OSError:
+        replaced = 0
+    os.replace(partial, path)
+
+    total, measured_at = _sizes.get(directory, (None, 0))
+    if total is None or time.monotonic() - measured_at > RESCAN_SECONDS or total + size - replaced > max_bytes:
+        evict(directory, max_bytes)
+    else:
+        _sizes[directory] = (total + size - replaced, measured_at)
+
+
+def evict(directory, max_bytes):
+    entries = []
+    for name in os.listdir(directory):
+        if name.startswith('.'):
+            continue
+        try:
+            stat = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+        total -= size
+    _sizes[directory] = (total, time.monotonic())
@@ -0,0 +1,99 @@
+import logging
+import time
+
+PRINTER_BYTES_PER_SECOND = 86400  # Starting estimate: 150 mm/s of 576-dot raster at 8 dots/mm
+PRINTER_BUFFER_BYTES = 16384  # How far the send may run ahead of the modelled print head
+CHUNK_BYTES = 4608  # Bytes per write; 64 rows of 576-dot raster
+STATUS_POLL = False  # Ask the printer for real-time status (DLE EOT) after every raster command
+
+BLOCKED_THRESHOLD = 0.005  # A write slower than this means the printer pushed back
+CALIBRATION_WEIGHT = 0.3  # Weight of a new rate measurement in the running estimate
+PROBE_FACTOR = 1.1  # Speed-up tried when a whole job went through without backpressure
+PROBE_CEILING = 1.25  # Probing stops at this multiple of the last measured rate (or the starting estimate)
+STATUS_TIMEOUT = 30  # Seconds to wait for an offline printer to come back
+
+DLE_EOT_PRINTER = b'\x10\x04\x01'  # DLE EOT 1: transmit printer status
+STATUS_OFFLINE = 0x08
+
+
+class FlowControl:
+    def __init__(self, bytes_per_second=PRINTER_BYTES_PER_SECOND, buffer_bytes=PRINTER_BUFFER_BYTES,
+                 chunk_bytes=CHUNK_BYTES, status_poll=STATUS_POLL):
+        self.bytes_per_second = bytes_per_second
+        # The rate the printer last drained at, or the starting estimate before any pushback
+        self.reference_bytes_per_second = bytes_per_second
+        self.buffer_bytes = buffer_bytes
+        self.chunk_bytes = chunk_bytes
+        self.status_poll = status_poll
+
+    def send(self, printer, commands):
+        # commands is a list or other iterable of complete ESC/POS commands (or one bytes
+        # object); a generator is only asked for the next command when it is due. Status polls
+        # go in between commands: inside one, the printer would take them as command data.
+        if isinstance(commands, (bytes, bytearray)):
+            commands = [commands]
+        start = clock = time.perf_counter()
+        sent = 0
+        printed = 0.0  # Bytes the modelled print head has got through
+        paced = 0.0
+        samples = []
+        for data in commands:
+            for offset in range(0, len(data), self.chunk_bytes):
+                chunk = data[offset:offset + self.chunk_bytes]
+
+                # Wait until the modelled printer buffer has room for this chunk. The head
+                # only prints what it was sent: time spent waiting on a slow generator
+                # drains the buffer, but cannot bank room for a burst after it.
+                now = time.perf_counter()
+                printed = min(sent, printed + (now - clock) * self.bytes_per_second)
+                clock = now
+                wait = (sent - printed + len(chunk) - self.buffer_bytes) / self.bytes_per_second
+                if wait > 0:
+                    time.sleep(wait)
+                    paced += wait
+
+                write_start = time.perf_counter()
+                printer._raw(chunk)
+                write_time = time.perf_counter() - write_start
+                sent += len(chunk)
+
+                # A write that blocks is the printer draining its buffer at its real feed rate
+                if write_time > BLOCKED_THRESHOLD:
+                    samples.append(len(chunk) / write_time)
+            if self.status_poll:
+                self.wait_until_online(printer)
+
+        elapsed = time.perf_counter() - start
+        self.calibrate(samples, paced)
+        return {
+            'bytes': sent,
+            'seconds': round(elapsed, 3),
+            'bytes_per_second': round(sent / elapsed) if elapsed > 0 else None,
+            'model_bytes_per_second': round(self.bytes_per_second),
+        }
+
+    def calibrate(self, samples, paced):
+        if samples:
+            # The printer pushed back: move the model towards the rate it actually drained at
+            measured = sorted(samples)[len(samples) // 2]
+            self.bytes_per_second += CALIBRATION_WEIGHT * (measured - self.bytes_per_second)
+            self.reference_bytes_per_second = measured
+        elif paced > 0:
+            # Only our own pacing slowed the job down, so try a little faster next time. Jobs
+            # that fit the printer's buffer never push back, so without a ceiling a run of
+            # them would compound the rate far past anything the printer can do.
+            self.bytes_per_second = min(self.bytes_per_second * PROBE_FACTOR,
+                                        self.reference_bytes_per_second * PROBE_CEILING)
+
+    def wait_until_online(self, printer):
+        deadline = time.monotonic() + STATUS_TIMEOUT
+        while True:
+            printer._raw(DLE_EOT_PRINTER)
+            # The printer answers once it has received everything sent before the request
+            status = printer._read()
+            if not status or not status[-1] & STATUS_OFFLINE:
+                return
+            if time.monotonic() > deadline:
+                raise TimeoutError("Printer stayed offline")
+            logging.warning("Printer is offline, waiting before sending more")
+            time.sleep(0.5)
@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+from io import BytesIO
+
+from .runtime_dir import RUNTIME_DIR, private_dir
+
+# The latest e-ink frame, shared by every gunicorn worker. The directory is in the
+# runtime directory, on tmpfs where available; FRAME_STORE_DIR moves it. Each update
+# replaces the state file atomically, so readers never take a lock and never see a
+# half-written frame. Reading needs nothing but the files; numpy and Pillow are
+# imported by the functions that publish a frame.
+FRAME_STORE_DIR = os.environ.get('FRAME_STORE_DIR') or os.path.join(RUNTIME_DIR, 'frames')
+STATE_FILE = 'current.json'
+FRAME_POLL_INTERVAL = 1  # Seconds between checks while a subscriber waits for a new frame
+FRAME_HISTORY = 8  # Frame images kept on disk behind the current one
+FRAME_TILE_SIZE = 32  # Side of the square tiles compared between consecutive frames
+DELTA_MAX_CHANGED = 0.5  # Past this share of changed tiles viewers get the whole frame instead
+
+FRAME_FIELDS = ['last_update_time', 'current_frame', 'total_frames', 'estimated_runtime']
+
+# Per-process (file identity, state) of the last read, swapped in as one tuple
+_cached = (None, None)
+# Per-process ((version, suffix), bytes) of the last frame file read
+_cached_image = (None, None)
+
+
+def _state_path():
+    return os.path.join(FRAME_STORE_DIR, STATE_FILE)
+
+
+def _image_path(version, suffix='png'):
+    return os.path.join(FRAME_STORE_DIR, f'frame-{version}.{suffix}')
+
+
+def _write_atomic(path, data):
+    partial = os.path.join(FRAME_STORE_DIR, f'.{uuid.uuid4().hex}')
+    with open(partial, 'wb') as f:
+        f.write(data)
+    os.replace(partial, path)
+
+
+def frame_png(data):
+    # Frames arrive as PNG, stored as they are, or as a 1-bit Netpbm bitmap (P4), stored
+    # as PNG once so every read serves the bytes unchanged
+    from PIL import Image
+
+    try:
+        frame = Image.open(BytesIO(data))
+        frame.load()
+    except (OSError, ValueError, Image.DecompressionBombError):
+        raise ValueError("Frame is not a readable image.")
+    if frame.format == 'PNG':
+        return data
+    if frame.format == 'PPM' and frame.mode == '1':
+        buffer = BytesIO()
+        frame.save(buffer, 'PNG')
+        return buffer.getvalue()
+    raise ValueError("Frame must be a PNG or a 1-bit bitmap (P4).")
+
+
+def decode_frame(image):
+    import numpy as np
+    from PIL import Image
+
+    frame = Image.open(BytesIO(image))
+    return np.asarray(frame.convert('L' if frame.mode in ('1', 'L') else 'RGB'))
+
+
+def encode_delta(previous, current, limit=None, tile_size=FRAME_TILE_SIZE):
+    # A PNG the size of the frame holding only the tiles that changed; everything else is
+    # transparent, so drawing it over the previous frame gives the current one. Returns
+    # (png bytes, changed tiles), or None when the whole frame is the better thing to send:
+    # too many tiles changed, or the delta would be no smaller than limit bytes.
+    import numpy as np
+    from PIL import Image
+
+    if previous.shape != current.shape:
+        return None
+    height, width = current.shape[:2]
+    rows, columns = -(-height // tile_size), -(-width // tile_size)
+
+    changed = previous != current
+    if changed.ndim == 3:
+        changed = changed.any(axis=2)
+    padded = np.zeros((rows * tile_size, columns * tile_size), dtype=bool)
+    padded[:height, :width] = changed
+    tiles = padded.reshape(rows, tile_size, columns, tile_size).any(axis=(1, 3))
+    if tiles.mean() > DELTA_MAX_CHANGED:
+        return None
+
+    mask = np.repeat(np.repeat(tiles, tile_size, axis=0), tile_size, axis=1)[:height, :width]
+    alpha = Image.fromarray(mask.astype(np.uint8) * 255)
+    # Unchanged pixels are zeroed too, so the transparent area compresses to almost nothing
+    bands = Image.fromarray(np.where(mask[..., None] if current.ndim == 3 else mask, current, 0)).split()
+    delta = Image.merge('LA' if current.ndim == 2 else 'RGBA', bands + (alpha,))
+    buffer = BytesIO()
+    delta.save(buffer, 'PNG')
+    if limit is not None and buffer.tell() >= limit:
+        return None
+    return buffer.getvalue(), int(tiles.sum())
+
+
+def _delta_from(previous, image):
+    if not previous or not previous.get('etag') or not image:
+        return None
+    previous_image = read_frame_image(previous['version'])
+    if previous_image is None:
+        return None
+    try:
+        return encode_delta(decode_frame(previous_image), decode_frame(image), len(image))
+    except (OSError, ValueError):
+        # Frames that do not decode still go out whole
+        return None
+
+
+def publish_frame(data, image):
+    previous = read_frame()
+    state = {field: data.get(field) for field in FRAME_FIELDS}
+    # Versions name immutable image URLs, so they start from the clock rather than 1
+    # and never repeat after the store is wiped
+    state['version'] = max(previous['version'] + 1 if previous else 0, int(time.time()))
+    state['etag'] = hashlib.sha256(image).hexdigest()[:32] if image else None
+    state['frame_size'] = len(image) if image else 0
+
+    delta = _delta_from(previous, image)
+    state['delta_base'] = previous['version'] if delta else None
+    state['delta_etag'] = hashlib.sha256(delta[0]).hexdigest()[:32] if delta else None
+    state['delta_size'] = len(delta[0]) if delta else 0
+    state['delta_tiles'] = delta[1] if delta else None
+
+    private_dir(FRAME_STORE_DIR)
+    # The images go in first so the state never points at a missing file
+    if image:
+        _write_atomic(_image_path(state['version']), image)
+    if delta:
+        _write_atomic(_image_path(state['version'], 'delta.png'), delta[0])
+    _write_atomic(_state_path(), json.dumps(state).encode('utf-8'))
+    _prune(state['version'])
+    return state
+
+
+def _prune(current_version):
+    files = []
+    for name in os.listdir(FRAME_STORE_DIR):
+        if name.startswith('frame-') and name.endswith('.png'):
+            try:
+                files.append((int(name[len('frame-'):].split('.')[0]), name))
+            except ValueError:
+                continue
+    keep = sorted({version for version, _ in files})[-(FRAME_HISTORY + 1):]
+    for version, name in files:
+        if version not in keep and version != current_version:
+            try:
+                os.remove(os.path.join(FRAME_STORE_DIR, name))
+            except OSError:
+                pass
+
+
+def read_frame_image(version, suffix='png'):
+    global _cached_image
+    cached_key, cached_bytes = _cached_image
+    if (version, suffix) == cached_key:
+        return cached_bytes
+    try:
+        with open(_image_path(int(version), suffix), 'rb') as f:
+            image = f.read()
+    except (OSError, ValueError):
+        return None
+    _cached_image = ((version, suffix), image)
+    return image
+
+
+def read_frame():
+    global _cached
+    try:
+        stat = os.stat(_state_path())
+    except FileNotFoundError:
+        return None
+
+    # A replaced file has a new inode, so one stat tells us whether our copy is current
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached_key, cached_state = _cached
+    if key != cached_key:
+        try:
+            with open(_state_path()) as f:
+                cached_state = json.load(f)
+        except (OSError, ValueError):
+            return cached_state
+        _cached = (key, cached_state)
+    return cached_state
+
+
+def wait_for_frame(since_version, timeout):
+    # Block until the store holds a newer frame than since_version, or the timeout passes.
+    # Each check is one stat(), and time.sleep yields under gevent.
+    deadline = time.monotonic() + timeout
+    while True:
+        state = read_frame()
+        if state and state['version'] > since_version:
+            return state
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(FRAME_POLL_INTERVAL, remaining))
+
+
+def frame_summary(state):
+    # Everything about the frame except the image itself
+    current_frame = state.get('current_frame')
+    total_frames = state.get('total_frames')
+    # Calculate the percentage of the movie completed
+    percentage_completed = (current_frame / total_frames) * 100 if current_frame and total_frames else 0
+    version = state.get('version', 0)
+    return {
+        "version": version,
+        "frame_url": f"/frames/{version}.png" if state.get('etag') else None,
+        # Only for viewers already showing delta_base
+        "delta_url": f"/frames/{version}.delta.png" if state.get('delta_base') else None,
+        "delta_base": state.get('delta_base'),
+        "last_update_time": state.get('last_update_time'),
+        "current_frame": current_frame,
+        "total_frames": total_frames,
+        "estimated_runtime": state.get('estimated_runtime'),
+        "percentage_completed": percentage_completed
+    }
@@ -1,8 +1,21 @@
+import logging
+
 import cv2
 from PIL import Image, ImageEnhance
 import numpy as np
 
+from .dithering import ERROR_DIFFUSION_KERNELS, blue_noise_matrix, error_diffusion_dither
+from .metrics import StageTimer
+
 PRINTER_WIDTH = 576  # Width in pixels for your printer
+RESIZE_FIRST = True  # Decode and shrink uploads to print width before the expensive stages
+COMPOSITE_ROWS = 256  # Rows composited onto white at a time
+STREAM_MIN_HEIGHT = 2048  # Uploads at least this many rows tall at print width are printed band by band
+REDUCE_MODES = ('RGB', 'RGBA', 'L', 'LA', 'CMYK')  # Modes box-reduced as they are
+
+# Every value the dither form field accepts; anything else falls back to Floyd-Steinberg
+DITHER_OPTIONS = ['FLOYDSTEINBERG', 'BAYER_2x2', 'BAYER_4x4', 'BAYER_8x8', 'BLUE_NOISE',
+                  'FLOYDSTEINBERG_SERPENTINE', 'ATKINSON', 'JARVIS', 'STUCKI', 'THRESHOLD']
 
 # Define settings for light, dark, super bright, and super dark images
 settings = {
@@ -72,21 +85,74 @@ BAYER_8x8 = np.array([
     [42, 26, 38, 22, 41, 25, 37, 21]
 ]) * (255 // 64)
 
-def apply_bayer_dithering(image, bayer_matrix):
-    width, height = image.size
-    bayer_pattern = np.tile(bayer_matrix, (height // bayer_matrix.shape[0] + 1, width // bayer_matrix.shape[1] + 1))
-    bayer_pattern = bayer_pattern[:height, :width]
+# Ordered-dither threshold rows tiled out to a given width, keyed by (matrix id, width)
+_threshold_rows = {}
+
+def threshold_rows(matrix, width):
+    key = (id(matrix), width)
+    cached = _threshold_rows.get(key)
+    if cached is None:
+        rows = np.tile(matrix, (1, width // matrix.shape[1] + 1))[:, :width].astype(np.uint8)
+        # Keep the matrix alive with its rows so its id cannot be reused
+        cached = _threshold_rows[key] = (matrix, rows)
+    return cached[1]
+
+def apply_bayer_dithering(image, bayer_matrix, top=0):
+    # top is the row the image starts at in a taller one, keeping a band in phase with the matrix
+    image_array = np.asarray(image)
+    height, width = image_array.shape
+    rows = threshold_rows(bayer_matrix, width)
+    tile_height = rows.shape[0]
+    if top % tile_height:
+        rows = np.roll(rows, -(top % tile_height), axis=0)
 
-    image_array = np.array(image)
-    dithered_array = (image_array > bayer_pattern).astype(np.uint8) * 255
+    # Compare whole bands of tile_height rows against the cached rows without building
+    # a full-size threshold image, writing the booleans straight into the output
+    dithered_array = np.empty((height, width), dtype=np.uint8)
+    flags = dithered_array.view(np.bool_)
+    whole = height - height % tile_height
+    np.greater(image_array[:whole].reshape(-1, tile_height, width), rows,
+               out=flags[:whole].reshape(-1, tile_height, width))
+    np.greater(image_array[whole:], rows[:height - whole], out=flags[whole:])
+    dithered_array *= 255
     return Image.fromarray(dithered_array, mode='L')
 
+def apply_dither(pil_image, dither_option):
+    timer = StageTimer('thermv2_image_stage_seconds')
+    if dither_option == 'BAYER_2x2':
+        pil_image = apply_bayer_dithering(pil_image, BAYER_2x2)
+    elif dither_option == 'BAYER_4x4':
+        pil_image = apply_bayer_dithering(pil_image, BAYER_4x4)
+    elif dither_option == 'BAYER_8x8':
+        pil_image = apply_bayer_dithering(pil_image, BAYER_8x8)
+    elif dither_option == 'BLUE_NOISE':
+        pil_image = apply_bayer_dithering(pil_image, blue_noise_matrix())
+    elif dither_option in ERROR_DIFFUSION_KERNELS:
+        pil_image = error_diffusion_dither(pil_image, dither_option)
+    elif dither_option == 'THRESHOLD':
+        pil_image = pil_image.point(lambda p: 255 if p > 128 else 0, mode='1')
+    elif is_tall(*pil_image.size, pil_image.width):
+        # Tall images print band by band through ErrorDiffuser (see app/strips.py), which
+        # Pillow's Floyd-Steinberg does not match dot for dot
+        pil_image = error_diffusion_dither(pil_image, 'FLOYDSTEINBERG')
+    else:
+        pil_image = pil_image.convert('1', dither=Image.FLOYDSTEINBERG)
+    timer.lap('dither')
+    return pil_image
+
+def is_tall(width, height, print_width=PRINTER_WIDTH):
+    # Uploads this tall at print width are printed band by band (app/strips.py)
+    return height * print_width / width >= STREAM_MIN_HEIGHT
+
 def analyze_image(image):
     avg_brightness = np.mean(image)
     return avg_brightness
 
 def enhance_edges(image):
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return enhance_gray_edges(gray)
+
+def enhance_gray_edges(gray):
     thresh = cv2.threshold(gray, 180, 255, cv2.THRESH_BINARY)[1]
     kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (5, 5))
     dilate = cv2.morphologyEx(thresh, cv2.MORPH_DILATE, kernel)
@@ -94,26 +160,106 @@ def enhance_edges(image):
     edges = 255 - diff
     return edges
 
-def process_image(image_path, dither_option, edge_enhance):
-    image = Image.open(image_path).convert("RGBA")
-    # Create a white background image
-    white_bg = Image.new("RGBA", image.size, "WHITE")
-    # Composite the image with the white background
-    image = Image.alpha_composite(white_bg, image).convert("RGB")
-
-    image = np.array(image)
-    gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    avg_brightness = analyze_image(gray_image)
-    print(f"Average brightness: {avg_brightness}")
-
+def classify_brightness(avg_brightness):
     if avg_brightness < 50:
-        current_settings = settings['super_dark']
+        return 'super_dark'
     elif avg_brightness < 118:
-        current_settings = settings['dark']
+        return 'dark'
     elif avg_brightness > 200:
-        current_settings = settings['super_bright']
-    else:
-        current_settings = settings['bright']
+        return 'super_bright'
+    return 'bright'
+
+# Settings profiles compiled to lookup tables, built once per process
+_compiled_settings = {}
+
+def compile_settings(profile):
+    compiled = _compiled_settings.get(profile)
+    if compiled is None:
+        current_settings = settings[profile]
+        levels = np.arange(256, dtype=np.uint8).reshape(1, 256)
+
+        # Brightness then contrast, run once over every gray level
+        def tone(values):
+            values = cv2.convertScaleAbs(values, alpha=current_settings['brightness'])
+            return cv2.convertScaleAbs(values, alpha=current_settings['contrast'], beta=0)
+
+        blended = [cv2.addWeighted(levels, 0.8, np.full_like(levels, edge), 0.2, 0) for edge in (0, 255)]
+        compiled = {
+            'tone_lut': tone(levels).ravel(),
+            'edge_lut': np.concatenate([tone(values).ravel() for values in blended]),
+            'sharpness': current_settings['sharpness'],
+        }
+        _compiled_settings[profile] = compiled
+    return compiled
+
+def warm_caches():
+    # Build every per-process table up front: run in the gunicorn master before it forks,
+    # so workers share one copy instead of each building its own on first use
+    for profile in settings:
+        compile_settings(profile)
+    for matrix in (BAYER_2x2, BAYER_4x4, BAYER_8x8, blue_noise_matrix()):
+        threshold_rows(matrix, PRINTER_WIDTH)
+
+def composite_gray(image):
+    # Onto a white background and down to grayscale a band of rows at a time, so only the
+    # decoded image and the grayscale result are ever held at full size
+    width, height = image.size
+    gray_image = np.empty((height, width), dtype=np.uint8)
+    for top in range(0, height, COMPOSITE_ROWS):
+        band = image.crop((0, top, width, min(height, top + COMPOSITE_ROWS))).convert("RGBA")
+        white_bg = Image.new("RGBA", band.size, "WHITE")
+        band = np.asarray(Image.alpha_composite(white_bg, band).convert("RGB"))
+        gray_image[top:top + band.shape[0]] = cv2.cvtColor(band, cv2.COLOR_BGR2GRAY)
+    return gray_image
+
+def load_image(image_path, resize_first, print_width=PRINTER_WIDTH):
+    timer = StageTimer('thermv2_image_stage_seconds')
+    image = Image.open(image_path)
+    # Final print size, worked out from the full-resolution dimensions
+    width, height = image.size
+    target_size = (print_width, int(height * (print_width / width)))
+
+    if resize_first and width > print_width:
+        # JPEGs decode straight at 1/2, 1/4 or 1/8 scale while staying at least print width
+        image.draft('RGB', target_size)
+        # Anything still twice the print width or more is box-reduced before compositing
+        factor = image.size[0] // print_width
+        if factor > 1:
+            # reduce() refuses palette, 1-bit and 16-bit images; anything but the plain
+            # modes goes to RGBA first, as compositing would take it anyway
+            if image.mode not in REDUCE_MODES:
+                image = image.convert('RGBA')
+            image = image.reduce(factor)
+
+    image.load()
+    timer.lap('decode')
+    gray_image = composite_gray(image)
+    timer.lap('composite')
+    if resize_first and width > print_width:
+        gray_image = cv2.resize(gray_image, target_size, interpolation=cv2.INTER_AREA)
+        timer.lap('resize')
+    return gray_image, target_size
+
+def preprocess_image(image_path, edge_enhance, resize_first=RESIZE_FIRST, profile=None, print_width=PRINTER_WIDTH):
+    # Everything up to dithering: a sharpened grayscale image at print width. A profile
+    # given by name is used as is instead of the one the brightness picks.
+    gray_image, target_size = load_image(image_path, resize_first, print_width)
+    if is_tall(*target_size, print_width):
+        # Tall uploads print band by band through app/strips.py; the preview is made the
+        # same way so it shows exactly what the paper will
+        from .strips import Strips
+        if gray_image.shape[::-1] != target_size:
+            gray_image = cv2.resize(gray_image, target_size, interpolation=cv2.INTER_AREA)
+        strips = Strips(gray_image, None, edge_enhance, profile)
+        return Image.fromarray(strips.pre_dither()), strips.profile
+    timer = StageTimer('thermv2_image_stage_seconds')
+    if profile is None:
+        avg_brightness = analyze_image(gray_image)
+        logging.debug("Average brightness: %s", avg_brightness)
+        profile = classify_brightness(avg_brightness)
+    current_settings = settings[profile]
+    compiled = compile_settings(profile)
+    timer.lap('classify')
 
     if current_settings['equalize']:
         if current_settings['equalize_method'] == 'CLAHE':
@@ -123,33 +269,37 @@ def process_image(image_path, dither_option, edge_enhance):
             processed_image = cv2.equalizeHist(gray_image)
         else:
             processed_image = gray_image
+        timer.lap('clahe')
     else:
         processed_image = gray_image
 
     if edge_enhance or current_settings['edge_enhance']:
-        edges = enhance_edges(image)
-        processed_image = cv2.addWeighted(processed_image, 0.8, edges, 0.2, 0)
-
-    processed_image = cv2.convertScaleAbs(processed_image, alpha=current_settings['brightness'])
-    processed_image = cv2.convertScaleAbs(processed_image, alpha=current_settings['contrast'], beta=0)
+        # Edges are pure black or white, so the blend and the tone curve are one
+        # 512-entry lookup indexed by (edge bit, gray level)
+        edges = enhance_gray_edges(gray_image)
+        timer.lap('edges')
+        index = np.right_shift(edges, 7).astype(np.uint16)
+        index <<= 8
+        index |= processed_image
+        processed_image = compiled['edge_lut'].take(index)
+    else:
+        processed_image = cv2.LUT(processed_image, compiled['tone_lut'])
+    timer.lap('tone')
 
-    aspect_ratio = PRINTER_WIDTH / processed_image.shape[1]
-    new_height = int(processed_image.shape[0] * aspect_ratio)
-    processed_image = cv2.resize(processed_image, (PRINTER_WIDTH, new_height), interpolation=cv2.INTER_AREA)
+    if processed_image.shape[::-1] != target_size:
+        processed_image = cv2.resize(processed_image, target_size, interpolation=cv2.INTER_AREA)
+        timer.lap('resize')
 
     pil_image = Image.fromarray(processed_image)
-    enhancer = ImageEnhance.Sharpness(pil_image)
-    pil_image = enhancer.enhance(current_settings['sharpness'])
+    if compiled['sharpness'] != 1:
+        enhancer = ImageEnhance.Sharpness(pil_image)
+        pil_image = enhancer.enhance(compiled['sharpness'])
+        timer.lap('sharpen')
 
-    if dither_option == 'BAYER_2x2':
-        pil_image = apply_bayer_dithering(pil_image, BAYER_2x2)
-    elif dither_option == 'BAYER_4x4':
-        pil_image = apply_bayer_dithering(pil_image, BAYER_4x4)
-    elif dither_option == 'BAYER_8x8':
-        pil_image = apply_bayer_dithering(pil_image, BAYER_8x8)
-    elif dither_option == 'THRESHOLD':
-        pil_image = pil_image.point(lambda p: 255 if p > 128 else 0, mode='1')
-    else:
-        pil_image = pil_image.convert('1', dither=Image.FLOYDSTEINBERG)
+    return pil_image, profile
 
-    return pil_image, current_settings['edge_enhance']
\ No newline at end of file
+def process_image(image_path, dither_option, edge_enhance, resize_first=RESIZE_FIRST, profile=None):
+    pil_image, profile = preprocess_image(image_path, edge_enhance, resize_first, profile)
+    # Without a dither option the profile's own one is used
+    pil_image = apply_dither(pil_image, dither_option or settings[profile]['dither'])
+    return pil_image, settings[profile]['edge_enhance']
\ No newline at end of file
@@ -0,0 +1,266 @@
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+
+from .runtime_dir import RUNTIME_DIR, private_dir
+
+try:
+    import fcntl
+except ImportError:  # Windows: files of exited processes are kept, and still counted
+    fcntl = None
+
+# Counters, histograms and gauges kept in memory by each process (gunicorn workers, the
+# spooler, processing pools). Each process copies its values to its own file here a few
+# seconds after they change, and once more when it exits; a scrape adds the files up.
+# They go in the runtime directory unless METRICS_DIR says otherwise.
+METRICS_DIR = os.environ.get('METRICS_DIR') or os.path.join(RUNTIME_DIR, 'metrics')
+METRICS_FLUSH_INTERVAL = 5  # Seconds between copies to the shared directory
+EXITED_FILE = 'exited.json'  # Counts of exited processes, folded together by scrapes
+SCRAPE_LOCK_FILE = 'scrape.lock'  # Held by a scrape while it reads and folds the files
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRICS = {
+    'thermv2_image_stage_seconds': ('histogram', "Time spent in each image processing stage."),
+    'thermv2_print_stage_seconds': ('histogram', "Time spent in each stage of sending a job to the printer."),
+    'thermv2_printer_bytes_sent_total': ('counter', "Raster bytes sent to the printer."),
+    'thermv2_jobs_total': ('counter', "Spooler jobs finished, by type and outcome."),
+    'thermv2_spooler_jobs': ('gauge', "Spooler jobs currently in each state."),
+    'thermv2_printer_healthy': ('gauge', "Whether each printer in the pool is taking jobs."),
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+_dirty = False
+_flusher = None
+_token = uuid.uuid4().hex[:8]
+# Called as listener(name, stage, seconds) on every lap; the benchmarks use it per stage
+stage_listeners = []
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, amount=1, **labels):
+    global _dirty
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+        _dirty = True
+    _start_flusher()
+
+
+def observe(name, value, **labels):
+    global _dirty
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(STAGE_BUCKETS), 0.0, 0]
+        for index, bound in enumerate(STAGE_BUCKETS):
+            if value <= bound:
+                histogram[0][index] += 1
+                break
+        histogram[1] += value
+        histogram[2] += 1
+        _dirty = True
+    _start_flusher()
+
+
+def set_gauge(name, value, **labels):
+    global _dirty
+    with _lock:
+        _gauges[_key(name, labels)] = value
+        _dirty = True
+    _start_flusher()
+
+
+class StageTimer:
+    # Each lap records the time since the previous one under its stage label
+    def __init__(self, name):
+        self.name = name
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        observe(self.name, now - self.last, stage=stage)
+        for listener in stage_listeners:
+            listener(self.name, stage, now - self.last)
+        self.last = now
+
+
+def _snapshot():
+    global _dirty
+    with _lock:
+        _dirty = False
+        return {
+            'pid': os.getpid(),
+            'counters': [[name, labels, value] for (name, labels), value in _counters.items()],
+            'histograms': [[name, labels, buckets[:], total, count]
+                           for (name, labels), (buckets, total, count) in _histograms.items()],
+            'gauges': [[name, labels, value] for (name, labels), value in _gauges.items()],
+        }
+
+
+def _write():
+    private_dir(METRICS_DIR)
+    partial = os.path.join(METRICS_DIR, f'.{uuid.uuid4().hex}')
+    with open(partial, 'w') as f:
+        json.dump(_snapshot(), f)
+    os.replace(partial, os.path.join(METRICS_DIR, f'{os.getpid()}-{_token}.json'))
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        _write_if_dirty()
+
+
+@atexit.register
+def _write_if_dirty():
+    # At exit too, so a worker that is replaced between flushes loses nothing. Processes
+    # killed by a signal (the spooler, pool processes) keep what the last flush wrote.
+    if _dirty:
+        try:
+            _write()
+        except OSError:
+            pass
+
+
+def _start_flusher():
+    global _flusher
+    if _flusher is None:
+        with _lock:
+            if _flusher is not None:
+                return
+            _flusher = threading.Thread(target=_flush_loop, name='metrics-flusher', daemon=True)
+        # Started outside the lock: under gevent start() switches to other requests, and
+        # the lock, made before the worker was patched, would block them all
+        _flusher.start()
+
+
+def _reset_after_fork():
+    # A forked child starts counting from zero under its own file
+    global _lock, _counters, _histograms, _gauges, _dirty, _flusher, _token
+    _lock = threading.Lock()
+    _counters, _histograms, _gauges = {}, {}, {}
+    _dirty, _flusher, _token = False, None, uuid.uuid4().hex[:8]
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+def _add(snapshot, counters, histograms):
+    for metric, labels, value in snapshot['counters']:
+        key = (metric, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+    for metric, labels, buckets, total, count in snapshot['histograms']:
+        key = (metric, tuple(map(tuple, labels)))
+        merged = histograms.setdefault(key, [[0] * len(STAGE_BUCKETS), 0.0, 0])
+        merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+        merged[1] += total
+        merged[2] += count
+
+
+def _read_snapshots():
+    snapshots = {}
+    for name in os.listdir(METRICS_DIR):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snapshots[name] = json.load(f)
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _fold_exited(snapshots):
+    # Add the counts of exited processes to EXITED_FILE and remove their own files, so the
+    # directory does not grow with every worker restart. Only under the scrape lock: two
+    # scrapes folding the same file would count it twice.
+    exited = [name for name, snapshot in snapshots.items()
+              if snapshot['pid'] is not None and not _alive(snapshot['pid'])]
+    if not exited:
+        return
+    counters, histograms = {}, {}
+    for name in exited + ([EXITED_FILE] if EXITED_FILE in snapshots else []):
+        _add(snapshots.pop(name), counters, histograms)
+    snapshots[EXITED_FILE] = {
+        'pid': None,
+        'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+        'histograms': [[name, labels, buckets, total, count]
+                       for (name, labels), (buckets, total, count) in histograms.items()],
+        'gauges': [],
+    }
+    partial = os.path.join(METRICS_DIR, f'.{uuid.uuid4().hex}')
+    with open(partial, 'w') as f:
+        json.dump(snapshots[EXITED_FILE], f)
+    os.replace(partial, os.path.join(METRICS_DIR, EXITED_FILE))
+    for name in exited:
+        os.remove(os.path.join(METRICS_DIR, name))
+
+
+def render_metrics():
+    # This process's values are current; the others' are at most METRICS_FLUSH_INTERVAL old
+    _write()
+    with open(os.path.join(METRICS_DIR, SCRAPE_LOCK_FILE), 'a') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        snapshots = _read_snapshots()
+        if fcntl:
+            _fold_exited(snapshots)
+
+    counters, histograms, gauges = {}, {}, {}
+    for snapshot in snapshots.values():
+        _add(snapshot, counters, histograms)
+        # Counts from exited processes still add up; their gauges no longer mean anything
+        if snapshot['pid'] is not None and _alive(snapshot['pid']):
+            for metric, labels, value in snapshot['gauges']:
+                key = (metric, tuple(map(tuple, labels)))
+                gauges[key] = gauges.get(key, 0) + value
+
+    lines = []
+    for metric, (kind, description) in METRICS.items():
+        lines.append(f'# HELP {metric} {description}')
+        lines.append(f'# TYPE {metric} {kind}')
+        if kind == 'histogram':
+            for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+                if name != metric:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(STAGE_BUCKETS, buckets):
+                    cumulative += bucket
+                    lines.append(f'{metric}_bucket{_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{metric}_bucket{_labels(labels, [("le", "+Inf")])} {count}')
+                lines.append(f'{metric}_sum{_labels(labels)} {total}')
+                lines.append(f'{metric}_count{_labels(labels)} {count}')
+        else:
+            for (name, labels), value in sorted((counters if kind == 'counter' else gauges).items()):
+                if name == metric:
+                    lines.append(f'{metric}{_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
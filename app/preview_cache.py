@@ -0,0 +1,42 @@
+import hashlib
+import os
+
+import numpy as np
+from PIL import Image
+
+from .file_cache import entry_path, write_atomic
+from .runtime_dir import RUNTIME_DIR, private_dir
+
+# Pre-dither grayscale images keyed by the hash of the upload. The directory is in the
+# runtime directory, on tmpfs where available, so it stays in memory and every gunicorn
+# worker shares it; PREVIEW_CACHE_DIR moves it.
+PREVIEW_CACHE_DIR = os.environ.get('PREVIEW_CACHE_DIR') or os.path.join(RUNTIME_DIR, 'previews')
+PREVIEW_CACHE_BYTES = 64 * 1024 * 1024  # Least recently used entries are evicted beyond this
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_preview(key):
+    path = entry_path(PREVIEW_CACHE_DIR, key, 'npz')
+    if path is None:
+        return None
+    try:
+        with np.load(path) as entry:
+            image = Image.fromarray(entry['image'])
+            profile = str(entry['profile'])
+        # Mark the entry as recently used
+        os.utime(path)
+    except (OSError, ValueError, KeyError):
+        return None
+    return image, profile
+
+
+def put_preview(key, image, profile):
+    path = entry_path(PREVIEW_CACHE_DIR, key, 'npz')
+    if path is None:
+        return
+    private_dir(PREVIEW_CACHE_DIR)
+    write_atomic(path, lambda f: np.savez(f, image=np.asarray(image), profile=np.array(profile)),
+                 PREVIEW_CACHE_BYTES)
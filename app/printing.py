@@ -1,48 +1,52 @@
-from escpos.printer import Network
-import time
-import os
 import base64
+import os
+import struct
 from io import BytesIO
-from PIL import Image  # Ensure this import is included
+import numpy as np
+from PIL import Image, ImageOps  # Ensure this import is included
 
-PRINTER_IP = "192.168.1.128"
-PRINTER_PORT = 9100
-PRINTER_WIDTH = 576
-FRAGMENT_HEIGHT = 256  # Height of each image fragment
+from .image_processing import apply_dither, is_tall, preprocess_image
+from .metrics import StageTimer, increment
+from .preview_cache import content_hash
+from .raster_cache import get_commands, get_raster, put_commands, put_raster, raster_key
+from .records import read_raster, record_image, record_reprint, record_text
+from .spooler import submit_job
+from .strips import open_strips
 
-import datetime
-def save_processed_image(image, name, original_filename):
-    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-    short_filename = os.path.splitext(original_filename)[0][:5]
-    filename = f'records/images/{name}_{timestamp}_{short_filename}.png'
-    image.save(filename)
-
-    
-def save_text_record(name, message):
-    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f'records/messages/{timestamp}_{name}.txt'
-    with open(filename, 'w') as f:
-        f.write(f"Name: {name}\n{message}\n")
-
-def save_image_record(image):
-    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f'records/images/{timestamp}.png'
-    image.save(filename)
+# Overridable so the app can print to benchmarks/printer_emulator.py instead
+PRINTER_IP = os.environ.get('PRINTER_IP', "192.168.1.128")
+PRINTER_PORT = int(os.environ.get('PRINTER_PORT', 9100))
+PRINTER_WIDTH = 576
+FRAGMENT_HEIGHT = 256  # Height of each raster block; send pacing is set in flow_control.py
 
+def parse_printers(spec):
+    # PRINTERS="host:port[:width[:impl]],..." -- each printer with its own paper width in dots
+    # and raster command ('bitImageRaster' or 'graphics')
+    printers = []
+    for index, entry in enumerate(part.strip() for part in spec.split(',')):
+        if not entry:
+            continue
+        fields = entry.split(':')
+        printers.append({
+            'name': f'printer{index + 1}',
+            'host': fields[0],
+            'port': int(fields[1]) if len(fields) > 1 and fields[1] else PRINTER_PORT,
+            'width': int(fields[2]) if len(fields) > 2 and fields[2] else PRINTER_WIDTH,
+            'impl': fields[3] if len(fields) > 3 and fields[3] else 'bitImageRaster',
+        })
+    return printers
 
+# The spooler's printer pool; without PRINTERS it is the single PRINTER_IP printer
+PRINTERS = parse_printers(os.environ.get('PRINTERS') or f'{PRINTER_IP}:{PRINTER_PORT}')
+# The drawing canvas fits the narrowest paper, so any printer in the pool can take a drawing
+DRAWING_WIDTH = min((printer['width'] for printer in PRINTERS), default=PRINTER_WIDTH)
+DRAWING_MAX_HEIGHT = 4096  # Rows accepted in one packed drawing upload
 
 def print_text(name, message):
     try:
-        printer = Network(PRINTER_IP, PRINTER_PORT)
-        reset_printer(printer)
-        printer.text(f"Name: {name}\n")
-        printer.text(f"{message}\n")
-        printer.cut(mode='PART', feed=True)
-        save_text_record(name, message)
+        return submit_job({'type': 'text', 'name': name, 'message': message})
     except Exception as e:
         print(f"Error printing text: {e}")
-    finally:
-        printer.close()
 
 
 def fragment_image(image, fragment_height):
@@ -59,6 +63,213 @@ def reset_printer(printer):
     printer._raw(b'\x1b\x40')  # ESC @ (Initialize printer)
     printer._raw(b'\x1b\x63\x30\x02')  # ESC c 0 2 (Reset printer mode)
 
+def raster_bits(image):
+    # Packed 1-bit rows, MSB first, with a set bit meaning a black dot;
+    # None when the image is not black and white yet
+    if image.mode == '1':
+        return np.packbits(~np.asarray(image), axis=1)
+    if image.mode == 'L':
+        gray = np.asarray(image)
+        if not np.any((gray != 0) & (gray != 255)):
+            return np.packbits(gray == 0, axis=1)
+    return None
+
+def dithered_raster_bits(image):
+    # The same conversion python-escpos applies to anything that is not black and white
+    rgba = image.convert('RGBA')
+    flattened = Image.new('RGB', rgba.size, (255, 255, 255))
+    flattened.paste(rgba, mask=rgba.split()[3])
+    return np.packbits(np.asarray(ImageOps.invert(flattened.convert('L')).convert('1')), axis=1)
+
+def image_bits(image):
+    bits = raster_bits(image)
+    return dithered_raster_bits(image) if bits is None else bits
+
+def raster_commands(image, fragment_height=FRAGMENT_HEIGHT, impl='bitImageRaster'):
+    # One complete ESC/POS command per fragment, so nothing gets sent in between a command's bytes
+    bits = raster_bits(image)
+    if bits is None:
+        # python-escpos dithers each fragment on its own, so do the same to match it dot for dot
+        blocks = [dithered_raster_bits(fragment) for fragment in fragment_image(image, fragment_height)]
+        return [block_command(block, image.width, impl) for block in blocks]
+    return bits_commands(bits, image.width, fragment_height, impl)
+
+def bits_commands(bits, width, fragment_height=FRAGMENT_HEIGHT, impl='bitImageRaster'):
+    # Packed rows that are already black and white go to the printer as they are
+    return [block_command(bits[top:top + fragment_height], width, impl)
+            for top in range(0, bits.shape[0], fragment_height)]
+
+def block_command(block, width, impl):
+    rows, width_bytes = block.shape
+    if impl == 'bitImageRaster':
+        # GS v 0 m xL xH yL yH d1...dk
+        return b'\x1dv0\x00' + struct.pack('<HH', width_bytes, rows) + block.tobytes()
+    if impl == 'graphics':
+        # GS ( L fn 112: store the raster in the print buffer, then fn 50: print it
+        data_length = 10 + block.size
+        return (b'\x1d(L' + struct.pack('<H', data_length) + b'0p0\x01\x011' +
+                struct.pack('<HH', width, rows) + block.tobytes() + b'\x1d(L\x02\x0002')
+    raise ValueError(f"Unknown raster implementation: {impl}")
+
+def encode_raster(image, fragment_height=FRAGMENT_HEIGHT, impl='bitImageRaster'):
+    return b''.join(raster_commands(image, fragment_height, impl))
+
+def write_text(printer, name, message):
+    timer = StageTimer('thermv2_print_stage_seconds')
+    printer.text(f"Name: {name}\n")
+    printer.text(f"{message}\n")
+    timer.lap('send')
+    printer.cut(mode='PART', feed=True)
+    timer.lap('cut')
+
+def cached_commands(cache_key, impl, encode):
+    # The commands this raster was sent as before on a printer using impl, if any;
+    # otherwise encode() them and keep them for the next time
+    commands = get_commands(cache_key, impl) if cache_key else None
+    if commands is None:
+        commands = encode()
+        if cache_key:
+            put_commands(cache_key, impl, commands)
+    return commands
+
+def write_image(printer, pil_image, flow, impl='bitImageRaster', cache_key=None):
+    # Encode every fragment up front, then let flow control pace it to the printer's feed rate
+    timer = StageTimer('thermv2_print_stage_seconds')
+    commands = cached_commands(cache_key, impl, lambda: raster_commands(pil_image, impl=impl))
+    timer.lap('encode')
+    return send_raster(printer, commands, flow, timer)
+
+def write_raster(printer, bits, width, flow, impl='bitImageRaster', cache_key=None):
+    timer = StageTimer('thermv2_print_stage_seconds')
+    commands = cached_commands(cache_key, impl, lambda: bits_commands(bits, width, impl=impl))
+    timer.lap('encode')
+    return send_raster(printer, commands, flow, timer)
+
+def write_strips(printer, strips, flow, impl='bitImageRaster'):
+    # Each band is encoded and sent as soon as it is ready; while flow control waits for
+    # it the printer drains what it already has, and no more
+    timer = StageTimer('thermv2_print_stage_seconds')
+    commands = (command for band in strips.bands() for command in bits_commands(band, strips.width, impl=impl))
+    return send_raster(printer, commands, flow, timer)
+
+def send_raster(printer, commands, flow, timer):
+    stats = flow.send(printer, commands)
+    timer.lap('send')
+    increment('thermv2_printer_bytes_sent_total', stats['bytes'])
+
+    # Perform a partial cut instead of a full cut
+    printer.cut(mode='PART', feed=True)
+    timer.lap('cut')
+    return stats
+
+def prepare_job(job, job_id=None, print_width=PRINTER_WIDTH):
+    # Called by the spooler's processing pool, off the HTTP request path; uploads are
+    # processed print_width dots wide, which the spooler picks from its printers
+    if job['type'] == 'upload':
+        cache_key = raster_key(content_hash(job['data']), job['dither'], None, print_width)
+        cached = get_raster(cache_key)
+        if cached is not None:
+            # Printed before: the raster, and likely its commands, are ready to send
+            bits, width, profile = cached
+            record_image(bits, width, 'image', job['name'], job_id, dither=job['dither'], profile=profile,
+                         original=job['filename'], cache_key=cache_key)
+            return {'type': 'raster', 'name': job['name'], 'bits': bits, 'width': width, 'cache_key': cache_key}
+
+        with Image.open(BytesIO(job['data'])) as image:
+            tall = is_tall(*image.size, print_width)
+        if tall:
+            # Processed band by band while it prints; recorded and cached once the last band is out
+            strips = open_strips(BytesIO(job['data']), job['dither'], print_width=print_width)
+
+            def on_complete(bits):
+                record_image(bits, strips.width, 'image', job['name'], job_id, dither=job['dither'],
+                             profile=strips.profile, original=job['filename'], cache_key=cache_key)
+                put_raster(cache_key, bits, strips.width, strips.profile)
+            strips.on_complete = on_complete
+            return {'type': 'strips', 'strips': strips}
+        gray_image, profile = preprocess_image(BytesIO(job['data']), False, print_width=print_width)
+        processed_image = apply_dither(gray_image, job['dither'])
+        bits = image_bits(processed_image)
+        record_image(bits, processed_image.width, 'image', job['name'], job_id,
+                     dither=job['dither'], profile=profile, original=job['filename'], cache_key=cache_key)
+        put_raster(cache_key, bits, processed_image.width, profile)
+        return {'type': 'image', 'image': processed_image, 'cache_key': cache_key}
+    if job['type'] == 'reprint':
+        # A record printed again as it came out the first time, from the cache or, once
+        # evicted there, from the raster archived with the record
+        record = job['record']
+        cached = get_raster(record['cache_key']) if record['cache_key'] else None
+        bits, width = cached[:2] if cached is not None else read_raster(record['path'])
+        record_reprint(record, job_id)
+        return {'type': 'raster', 'name': record['name'], 'bits': bits, 'width': width,
+                'cache_key': record['cache_key']}
+    if job['type'] == 'text':
+        record_text(job['name'], job['message'], job_id)
+    elif job['type'] == 'image':
+        image = job['image']
+        record_image(image_bits(image), image.width, job.get('name') or 'image', job.get('name'), job_id)
+    elif job['type'] == 'raster':
+        # Drawings come ready as rasters and the record keeps a copy, so only the encoded
+        # commands are cached for them
+        cache_key = raster_key(content_hash(job['bits'].tobytes()), None, None, job['width'])
+        record_image(job['bits'], job['width'], job.get('name') or 'image', job.get('name'), job_id,
+                     cache_key=cache_key)
+        return dict(job, cache_key=cache_key)
+    return job
+
+def run_job(printer, job, flow, impl='bitImageRaster'):
+    # Called by the spooler, which owns the printer connections
+    if job['type'] == 'text':
+        write_text(printer, job['name'], job['message'])
+    elif job['type'] == 'image':
+        return write_image(printer, job['image'], flow, impl, job.get('cache_key'))
+    elif job['type'] == 'raster':
+        return write_raster(printer, job['bits'], job['width'], flow, impl, job.get('cache_key'))
+    elif job['type'] == 'strips':
+        return write_strips(printer, job['strips'], flow, impl)
+    else:
+        raise ValueError(f"Unknown job type: {job['type']}")
+
+def drawing_bits(image):
+    # The canvas is black strokes on transparency: flatten it onto white paper and threshold,
+    # the same thing drawing.js does before a packed upload
+    flattened = Image.new('RGBA', image.size, (255, 255, 255, 255))
+    flattened.alpha_composite(image.convert('RGBA'))
+    return np.packbits(np.asarray(flattened.convert('L')) < 128, axis=1)
+
+def unpack_bits(data, size):
+    # PackBits (as in TIFF and Apple's MacPaint): a header byte n < 128 is followed by n + 1
+    # literal bytes, n > 128 by one byte repeated 257 - n times, and 128 does nothing
+    out = bytearray()
+    position = 0
+    while position < len(data) and len(out) < size:
+        header = data[position]
+        position += 1
+        if header < 128:
+            out += data[position:position + header + 1]
+            position += header + 1
+        elif header > 128:
+            out += data[position:position + 1] * (257 - header)
+            position += 1
+    if len(out) != size or position != len(data):
+        raise ValueError("Drawing data does not unpack to the size given.")
+    return bytes(out)
+
+def unpack_drawing(data, width, height, encoding=None):
+    # A packed upload is the raster itself: rows of 1-bit pixels, MSB first, 1 = black,
+    # each row padded to whole bytes, optionally compressed with PackBits
+    max_width = max(printer['width'] for printer in PRINTERS)
+    if not 0 < width <= max_width or not 0 < height <= DRAWING_MAX_HEIGHT:
+        raise ValueError(f"Drawing must be at most {max_width}x{DRAWING_MAX_HEIGHT} dots.")
+    size = -(-width // 8) * height
+    if encoding == 'packbits':
+        data = unpack_bits(data, size)
+    elif encoding:
+        raise ValueError(f"Unknown drawing encoding: {encoding}")
+    elif len(data) != size:
+        raise ValueError(f"Drawing should be {size} bytes, got {len(data)}.")
+    return np.frombuffer(data, dtype=np.uint8).reshape(height, -1)
+
 def print_drawing(drawing_data_url):
     # Decode the base64 image data
     drawing_data = drawing_data_url.split(',')[1]
@@ -69,32 +280,24 @@ def print_drawing(drawing_data_url):
         print("Error: No drawing to print.")
         return
 
-    # Fragment the image
-    fragments = fragment_image(drawing_image, FRAGMENT_HEIGHT)
+    bits = drawing_bits(drawing_image)
+    return print_raster(bits, drawing_image.width, 'drawing')
 
+def print_raster(bits, width, name):
     try:
-        # Connect to the printer
-        printer = Network(PRINTER_IP, PRINTER_PORT)
-        
-        # Set the media width in the printer profile
-        printer.profile.profile_data['media']['width']['pixels'] = PRINTER_WIDTH
-        
-        # Reset the printer before printing
-        reset_printer(printer)
-        
-        # Send each fragment to the printer with a delay
-        for fragment in fragments:
-            printer.image(fragment)
-            time.sleep(0.1)  # Add a small delay between fragments
-        
-        # Perform a partial cut instead of a full cut
-        printer.cut(mode='PART', feed=True)
+        # Hand the packed raster to the spooler, which sends it without converting it again
+        return submit_job({'type': 'raster', 'name': name, 'bits': bits, 'width': width})
     except Exception as e:
         print(f"Error printing drawing: {e}")
-    finally:
-        # Reset and close the connection
-        reset_printer(printer)
-        printer.close()
+
+def reprint(record):
+    try:
+        if record['kind'] == 'text':
+            return submit_job({'type': 'text', 'name': record['name'], 'message': record['message']})
+        # Skips the upload, processing and, once a printer has sent it, encoding
+        return submit_job({'type': 'reprint', 'name': record['name'], 'record': record})
+    except Exception as e:
+        print(f"Error reprinting record {record['id']}: {e}")
 
 def print_image(pil_image):
     # Check if the processed image is valid
@@ -102,30 +305,21 @@ def print_image(pil_image):
         print("Error: No image to print.")
         return
 
-    # Fragment the image
-    fragments = fragment_image(pil_image, FRAGMENT_HEIGHT)
+    try:
+        # Hand the image to the spooler, which prints jobs one at a time
+        return submit_job({'type': 'image', 'image': pil_image})
+    except Exception as e:
+        print(f"Error printing image: {e}")
 
+def print_upload(data, dither, name, original_filename):
     try:
-        # Connect to the printer
-        printer = Network(PRINTER_IP, PRINTER_PORT)
-        
-        # Set the media width in the printer profile
-        printer.profile.profile_data['media']['width']['pixels'] = PRINTER_WIDTH
-        
-        # Reset the printer before printing
-        reset_printer(printer)
-        
-        # Send each fragment to the printer with a delay
-        for fragment in fragments:
-            printer.image(fragment)
-            time.sleep(0.1)  # Add a small delay between fragments
-        
-        # Perform a partial cut instead of a full cut
-        printer.cut(mode='PART', feed=True)
+        # Processing happens in the spooler, so this returns as soon as the job is queued
+        return submit_job({
+            'type': 'upload',
+            'data': data,
+            'dither': dither,
+            'name': name,
+            'filename': original_filename,
+        })
     except Exception as e:
         print(f"Error printing image: {e}")
-    finally:
-        # Reset and close the connection
-        reset_printer(printer)
-        printer.close()
-        
\ No newline at end of file
@@ -0,0 +1,76 @@
+import hashlib
+import os
+import struct
+
+import numpy as np
+
+from .file_cache import entry_path, write_atomic
+
+# Finished 1-bit rasters, and the ESC/POS commands encoded from them for each raster
+# command set, so printing the same photo or drawing again skips processing and encoding.
+# Entries live on disk next to the records, so they outlast spooler restarts; the least
+# recently used go once the directory outgrows RASTER_CACHE_BYTES.
+RASTER_CACHE_DIR = 'records/rasters'
+RASTER_CACHE_BYTES = 256 * 1024 * 1024
+
+
+def raster_key(content_hash, dither, profile, width):
+    # Everything the printed raster depends on; profile is None when it is picked from
+    # the image itself, which the content hash already pins down
+    return hashlib.sha256(f'{content_hash}:{dither}:{profile or "auto"}:{width}'.encode('ascii')).hexdigest()
+
+
+def get_raster(key):
+    # (packed bits, width, profile) or None
+    path = entry_path(RASTER_CACHE_DIR, key, 'npz')
+    if path is None:
+        return None
+    try:
+        with np.load(path) as entry:
+            raster = entry['bits'], int(entry['width']), str(entry['profile']) or None
+        # Mark the entry as recently used
+        os.utime(path)
+    except (OSError, ValueError, KeyError):
+        return None
+    return raster
+
+
+def put_raster(key, bits, width, profile=None):
+    path = entry_path(RASTER_CACHE_DIR, key, 'npz')
+    if path is None:
+        return
+    write_atomic(path, lambda f: np.savez(f, bits=bits, width=np.array(width), profile=np.array(profile or '')),
+                 RASTER_CACHE_BYTES)
+
+
+def get_commands(key, impl):
+    # The commands as a list, one complete ESC/POS command per entry, or None
+    path = entry_path(RASTER_CACHE_DIR, key, f'{impl}.escpos')
+    if path is None:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path)
+    except OSError:
+        return None
+    commands = []
+    position = 0
+    while position < len(data):
+        length, = struct.unpack_from('<I', data, position)
+        commands.append(data[position + 4:position + 4 + length])
+        position += 4 + length
+    return commands
+
+
+def put_commands(key, impl, commands):
+    path = entry_path(RASTER_CACHE_DIR, key, f'{impl}.escpos')
+    if path is None:
+        return
+
+    # Each command behind its length, so flow control can still poll status in between
+    def write(f):
+        for command in commands:
+            f.write(struct.pack('<I', len(command)))
+            f.write(command)
+    write_atomic(path, write, RASTER_CACHE_BYTES)
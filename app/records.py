@@ -0,0 +1,227 @@
+import atexit
+import datetime
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+from werkzeug.utils import secure_filename
+
+ARCHIVE_FOLDER = 'records/images'
+MESSAGES_FOLDER = 'records/messages'
+RECORDS_DB = 'records/records.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    name TEXT,
+    created_at REAL NOT NULL,
+    job_id INTEGER,
+    dither TEXT,
+    profile TEXT,
+    width INTEGER,
+    height INTEGER,
+    bytes INTEGER,
+    path TEXT,
+    original TEXT,
+    message TEXT,
+    print_seconds REAL,
+    cache_key TEXT
+);
+CREATE INDEX IF NOT EXISTS records_created_at ON records (created_at);
+CREATE INDEX IF NOT EXISTS records_name ON records (name, created_at);
+CREATE INDEX IF NOT EXISTS records_job_id ON records (job_id);
+'''
+
+RECORD_FIELDS = ['id', 'kind', 'name', 'created_at', 'job_id', 'dither', 'profile', 'width', 'height',
+                 'bytes', 'path', 'original', 'message', 'print_seconds', 'cache_key']
+
+# Writes queued here happen on a background thread, off the request path. The thread
+# owns the only writing SQLite connection in its process.
+_writes = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def connect():
+    db = sqlite3.connect(RECORDS_DB, timeout=10)
+    # WAL lets history queries run while the writer is busy
+    db.execute('PRAGMA journal_mode=WAL')
+    db.executescript(SCHEMA)
+    # Databases from before the raster cache lack its column
+    if 'cache_key' not in {row[1] for row in db.execute('PRAGMA table_info(records)')}:
+        try:
+            db.execute('ALTER TABLE records ADD COLUMN cache_key TEXT')
+        except sqlite3.OperationalError:
+            pass  # Another process added it first
+    return db
+
+
+def _write_loop():
+    db = None
+    while True:
+        write, args = _writes.get()
+        try:
+            if db is None:
+                db = connect()
+            write(db, *args)
+            db.commit()
+        except (OSError, sqlite3.Error) as e:
+            print(f"Error writing record: {e}")
+        finally:
+            _writes.task_done()
+
+
+def _submit(write, *args):
+    global _writer
+    writer = None
+    with _writer_lock:
+        # A writer without an ident is still being started; one that has an ident and is
+        # not alive was inherited across a fork
+        if _writer is None or _writer.ident is not None and not _writer.is_alive():
+            writer = _writer = threading.Thread(target=_write_loop, name='records-writer', daemon=True)
+    # Started outside the lock, as in metrics._start_flusher
+    if writer is not None:
+        writer.start()
+    _writes.put((write, args))
+
+
+@atexit.register
+def flush():
+    # Let queued writes land before the process exits
+    if _writer is not None and _writer.is_alive():
+        _writes.join()
+
+
+def unique_filename(original_filename):
+    # Timestamp plus a random suffix, so records in the same second never collide
+    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    name = secure_filename(original_filename) or 'record'
+    return f'{timestamp}_{uuid.uuid4().hex[:8]}_{name}'
+
+
+def _write_file(db, path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def archive_upload(data, original_filename):
+    path = os.path.join(ARCHIVE_FOLDER, unique_filename(original_filename))
+    _submit(_write_file, path, data)
+    return path
+
+
+def _insert(db, fields):
+    columns = ', '.join(fields)
+    placeholders = ', '.join('?' for _ in fields)
+    db.execute(f'INSERT INTO records ({columns}) VALUES ({placeholders})', list(fields.values()))
+
+
+def _write_raster(db, path, bits, width, fields):
+    # Netpbm P4 is exactly the printer's raster: packed rows, MSB first, 1 = black
+    height = bits.shape[0]
+    with open(path, 'wb') as f:
+        f.write(f'P4\n{width} {height}\n'.encode('ascii'))
+        f.write(bits.tobytes())
+    _insert(db, fields)
+
+
+def read_raster(path):
+    # (packed bits, width) from a P4 file written by _write_raster
+    import numpy as np
+
+    with open(path, 'rb') as f:
+        magic, size, data = f.read().split(b'\n', 2)
+    if magic != b'P4':
+        raise ValueError(f"{path} is not a P4 bitmap.")
+    width, height = map(int, size.split())
+    return np.frombuffer(data, dtype=np.uint8).reshape(height, -(-width // 8)), width
+
+
+def record_image(bits, width, kind, name, job_id=None, dither=None, profile=None, original=None, cache_key=None):
+    path = os.path.join(ARCHIVE_FOLDER, unique_filename(f'{name or kind}.pbm'))
+    fields = {
+        'kind': kind,
+        'name': name,
+        'created_at': time.time(),
+        'job_id': job_id,
+        'dither': dither,
+        'profile': profile,
+        'width': width,
+        'height': bits.shape[0],
+        'bytes': bits.size,
+        'path': path,
+        'original': original,
+        'cache_key': cache_key,
+    }
+    _submit(_write_raster, path, bits, width, fields)
+
+
+def record_reprint(record, job_id=None):
+    # A new history entry for the same print, pointing at the raster already on disk
+    fields = {field: record[field] for field in RECORD_FIELDS if field not in ('id', 'print_seconds')}
+    fields.update(created_at=time.time(), job_id=job_id)
+    _submit(_insert, fields)
+
+
+def _write_text(db, path, name, message, fields):
+    with open(path, 'w') as f:
+        f.write(f"Name: {name}\n{message}\n")
+    _insert(db, fields)
+
+
+def record_text(name, message, job_id=None):
+    path = os.path.join(MESSAGES_FOLDER, unique_filename(f'{name}.txt'))
+    fields = {
+        'kind': 'text',
+        'name': name,
+        'created_at': time.time(),
+        'job_id': job_id,
+        'bytes': len(message.encode('utf-8')),
+        'path': path,
+        'message': message,
+    }
+    _submit(_write_text, path, name, message, fields)
+
+
+def _update_print(db, job_id, seconds):
+    # Job ids restart with the spooler, so the newest record with the id is the one
+    db.execute('UPDATE records SET print_seconds = ? '
+               'WHERE id = (SELECT max(id) FROM records WHERE job_id = ?)', (seconds, job_id))
+
+
+def record_print(job_id, seconds):
+    _submit(_update_print, job_id, seconds)
+
+
+def get_record(record_id):
+    db = connect()
+    try:
+        row = db.execute(f"SELECT {', '.join(RECORD_FIELDS)} FROM records WHERE id = ?", (record_id,)).fetchone()
+    finally:
+        db.close()
+    return dict(zip(RECORD_FIELDS, row)) if row else None
+
+
+def query_records(name=None, kind=None, before=None, limit=50):
+    clauses, params = [], []
+    if name:
+        clauses.append('name = ?')
+        params.append(name)
+    if kind:
+        clauses.append('kind = ?')
+        params.append(kind)
+    if before:
+        clauses.append('created_at < ?')
+        params.append(before)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    db = connect()
+    try:
+        rows = db.execute(f"SELECT {', '.join(RECORD_FIELDS)} FROM records {where} "
+                          'ORDER BY created_at DESC LIMIT ?', params + [limit]).fetchall()
+    finally:
+        db.close()
+    return [dict(zip(RECORD_FIELDS, row)) for row in rows]
@@ -1,20 +1,23 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, send_file
-import requests
+from flask import Blueprint, Response, render_template, request, redirect, url_for, flash, jsonify, send_file
 from io import BytesIO
-from PIL import Image
-import time
 import base64
-import logging 
-bp = Blueprint('main', __name__)
+import hashlib
+import json
+import logging
+
+# Only light modules here: pages, the live display and the job routes never touch numpy,
+# OpenCV, Pillow or python-escpos, so the image and print routes import what they need
+# when first called. Under gunicorn those are loaded once in the master instead (see
+# gunicorn_config.py).
+from .frame_store import frame_png, frame_summary, publish_frame, read_frame, read_frame_image, wait_for_frame
+from .metrics import render_metrics
+from .records import archive_upload, get_record, query_records
+from .spooler import get_job, list_jobs, list_printers
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+bp = Blueprint('main', __name__)
 
-# Global variables to store frame data and metadata
-last_update_time = None
-current_frame = None
-estimated_runtime = None
-frame_data = None
+FRAME_STREAM_HEARTBEAT = 15  # Seconds between keep-alive comments on an idle event stream
+FRAME_LONG_POLL_TIMEOUT = 25  # Seconds a long-poll request waits before answering 204
 
 @bp.route('/')
 def index():
@@ -22,84 +25,234 @@ def index():
 
 @bp.route('/drawing')
 def drawing_page():
-    return render_template('drawing.html')
+    from .printing import DRAWING_WIDTH
+    return render_template('drawing.html', width=DRAWING_WIDTH)
 
 @bp.route('/print_text', methods=['POST'])
 def print_text_route():
+    from .printing import print_text
+
     name = request.form.get('name')
     message = request.form.get('message')
     if not name or not message:
         flash('Name and message are required.')
         return redirect(url_for('main.index'))
-    print_text(name, message)
-    return redirect(url_for('main.index'))
+    job = print_text(name, message)
+    return job_response(job)
 
 @bp.route('/print_image', methods=['POST'])
 def print_image_route():
     if 'image' not in request.files or request.files['image'].filename == '':
         flash('No image uploaded.')
         return redirect(url_for('main.index'))
+    from .printing import print_upload
+
     file = request.files['image']
     image_name = request.form.get('image_name', 'anon')
-    image_path = os.path.join('records/images', file.filename)
-    file.save(image_path)
+    data = file.read()
+    archive_upload(data, file.filename)
     dither = request.form.get('dither', 'FLOYDSTEINBERG')
-    processed_image, _ = process_image(image_path, dither, False)
-    save_processed_image(processed_image, image_name, file.filename)
-    print_image(processed_image)
-    return redirect(url_for('main.index'))
+    job = print_upload(data, dither, image_name, file.filename)
+    return job_response(job)
+
+@bp.route('/print_drawing', methods=['POST'])
+def print_drawing_route():
+    from .printing import print_drawing, print_raster, unpack_drawing
+
+    if request.mimetype == 'application/octet-stream':
+        # Packed 1-bit rows from drawing.js, sized by the X-Drawing-* headers
+        width = request.headers.get('X-Drawing-Width', type=int)
+        height = request.headers.get('X-Drawing-Height', type=int)
+        if width is None or height is None:
+            return jsonify({"error": "X-Drawing-Width and X-Drawing-Height are required."}), 400
+        try:
+            bits = unpack_drawing(request.get_data(cache=False), width, height,
+                                  request.headers.get('X-Drawing-Encoding'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return job_response(print_raster(bits, width, 'drawing'))
+
+    # The original JSON form with the canvas as a PNG data URL
+    data = request.get_json(silent=True) or {}
+    if not data.get('image'):
+        return jsonify({"error": "No drawing received."}), 400
+    job = print_drawing(data['image'])
+    return job_response(job)
+
+@bp.route('/jobs', methods=['GET'])
+def jobs_route():
+    try:
+        return jsonify(list_jobs()), 200
+    except Exception as e:
+        logging.error(f"Error: {e}")
+        return jsonify({"error": "Printer spooler is unavailable."}), 503
+
+@bp.route('/jobs/<int:job_id>', methods=['GET'])
+def job_route(job_id):
+    try:
+        job = get_job(job_id)
+    except Exception as e:
+        logging.error(f"Error: {e}")
+        return jsonify({"error": "Printer spooler is unavailable."}), 503
+    if job is None:
+        return jsonify({"error": f"Unknown job {job_id}."}), 404
+    return jsonify(job), 200
+
+@bp.route('/printers', methods=['GET'])
+def printers_route():
+    # The spooler's printer pool with each printer's health and queued work
+    try:
+        return jsonify(list_printers()), 200
+    except Exception as e:
+        logging.error(f"Error: {e}")
+        return jsonify({"error": "Printer spooler is unavailable."}), 503
+
+@bp.route('/records', methods=['GET'])
+def records_route():
+    # Print history from the records index, newest first
+    records = query_records(
+        name=request.args.get('name'),
+        kind=request.args.get('kind'),
+        before=request.args.get('before', type=float),
+        limit=min(request.args.get('limit', 50, type=int), 500),
+    )
+    return jsonify(records), 200
+
+@bp.route('/reprint/<int:record_id>', methods=['POST'])
+def reprint_route(record_id):
+    # Print a record again straight from the raster cache, skipping the upload and processing
+    from .printing import reprint
+
+    record = get_record(record_id)
+    if record is None:
+        return jsonify({"error": f"Unknown record {record_id}."}), 404
+    return job_response(reprint(record))
+
+def job_response(job):
+    # Print routes return as soon as the spooler has queued the job
+    if job is None:
+        return jsonify({"error": "Printer spooler is unavailable."}), 503
+    return jsonify(job), 202
+
+def load_preview():
+    # The pre-dither image for this request, from the cache when the upload was seen before
+    from .image_processing import preprocess_image
+    from .preview_cache import content_hash, get_preview, put_preview
+
+    image_hash = request.form.get('image_hash')
+    file = request.files.get('image')
+
+    if file is None or file.filename == '':
+        # A dither change only sends the hash of an image we have already seen
+        cached = get_preview(image_hash) if image_hash else None
+        if cached is None:
+            return None, image_hash
+        return cached[0], image_hash
+
+    data = file.read()
+    image_hash = content_hash(data)
+    cached = get_preview(image_hash)
+    if cached is not None:
+        return cached[0], image_hash
+
+    # Process straight from memory; the original is archived in the background
+    archive_upload(data, file.filename)
+    gray_image, profile = preprocess_image(BytesIO(data), False)
+    put_preview(image_hash, gray_image, profile)
+    return gray_image, image_hash
 
 @bp.route('/process_image', methods=['POST'])
 def process_image_route():
-    if 'image' not in request.files or request.files['image'].filename == '':
-        flash('No image uploaded.')
-        return redirect(url_for('main.index'))
-    file = request.files['image']
-    image_path = os.path.join('records/images', file.filename)
-    file.save(image_path)
+    from .image_processing import apply_dither
+
     dither = request.form.get('dither', 'FLOYDSTEINBERG')
-    processed_image, _ = process_image(image_path, dither, False)
-    
+    gray_image, image_hash = load_preview()
+    if gray_image is None:
+        return jsonify({"error": "Image not in preview cache."}), 404
+
+    processed_image = apply_dither(gray_image, dither)
     img_io = BytesIO()
     processed_image.save(img_io, 'PNG')
     img_io.seek(0)
-    return send_file(img_io, mimetype='image/png')
+    response = send_file(img_io, mimetype='image/png')
+    response.headers['X-Image-Hash'] = image_hash
+    return response
+
+@bp.route('/process_image/variants', methods=['POST'])
+def process_image_variants_route():
+    from .image_processing import DITHER_OPTIONS
+    from .variants import VARIANT_COLUMNS, render_variants
+
+    gray_image, image_hash = load_preview()
+    if gray_image is None:
+        return jsonify({"error": "Image not in preview cache."}), 404
+
+    # Every dither option side by side in one sprite sheet, in DITHER_OPTIONS order
+    sprite, (width, height) = render_variants(gray_image)
+    img_io = BytesIO()
+    sprite.save(img_io, 'PNG')
+    img_io.seek(0)
+    response = send_file(img_io, mimetype='image/png')
+    response.headers['X-Image-Hash'] = image_hash
+    response.headers['X-Dither-Variants'] = ','.join(DITHER_OPTIONS)
+    response.headers['X-Variant-Size'] = f'{width}x{height}'
+    response.headers['X-Variant-Columns'] = str(VARIANT_COLUMNS)
+    return response
 
 @bp.route('/live_display')
 def live_display():
     return render_template('live_frame.html')
 
+# Frame details sent as headers alongside a binary frame body
+FRAME_HEADERS = {
+    'last_update_time': 'X-Frame-Updated',
+    'current_frame': 'X-Frame-Current',
+    'total_frames': 'X-Frame-Total',
+    'estimated_runtime': 'X-Frame-Runtime',
+}
+
+def frame_field(value, field):
+    # Form fields and headers are strings; frame counters are numbers in the store
+    if value is None or field not in ('current_frame', 'total_frames'):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{field} must be a whole number.")
+
+def read_posted_frame():
+    # Returns (details, frame bytes). Binary bodies skip base64 and JSON entirely.
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('frame')
+        data = {field: frame_field(request.form.get(field), field) for field in FRAME_HEADERS}
+        return data, upload.read() if upload else None
+    if request.mimetype in ('application/octet-stream', 'image/png', 'image/x-portable-bitmap'):
+        data = {field: frame_field(request.headers.get(header), field) for field, header in FRAME_HEADERS.items()}
+        return data, request.get_data(cache=False) or None
+
+    # The original JSON form with the image as base64 in frame_data
+    data = request.get_json()
+    frame_data = data.get('frame_data')
+    return data, base64.b64decode(frame_data) if frame_data else None
+
 @bp.route('/notify_new_frame', methods=['POST'])
 def notify_new_frame():
-    global last_update_time, current_frame, total_frames, estimated_runtime, frame_data
     try:
-        data = request.get_json()
-        logging.debug(f"Received data: {data}")
-        
-        last_update_time = data.get('last_update_time')
-        current_frame = data.get('current_frame')
-        total_frames = data.get('total_frames')
-        estimated_runtime = data.get('estimated_runtime')
-        frame_data = data.get('frame_data')
-
-        # Log the values of the global variables
-        logging.debug(f"Set last_update_time: {last_update_time}")
-        logging.debug(f"Set current_frame: {current_frame}")
-        logging.debug(f"Set total_frames: {total_frames}")
-        logging.debug(f"Set estimated_runtime: {estimated_runtime}")
-        if frame_data:
-            logging.debug(f"Set frame_data: {frame_data[:30]}...")  # Log only the first 30 characters of frame_data
-        else:
-            logging.debug("Set frame_data: None")
+        data, image = read_posted_frame()
+        # Validated and written once to the shared frame store; every worker serves it from there
+        state = publish_frame(data, frame_png(image) if image else None)
+        logging.debug("Stored frame %s/%s as version %s", state['current_frame'], state['total_frames'], state['version'])
 
         response = {
             "message": "Frame data received successfully.",
-            "last_update_time": last_update_time,
-            "current_frame": current_frame,
-            "total_frames": total_frames,
-            "estimated_runtime": estimated_runtime
+            "last_update_time": state['last_update_time'],
+            "current_frame": state['current_frame'],
+            "total_frames": state['total_frames'],
+            "estimated_runtime": state['estimated_runtime']
         }
         return jsonify(response), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logging.error(f"Error: {e}")
         return jsonify({"error": str(e)}), 500
@@ -107,28 +260,82 @@ def notify_new_frame():
 @bp.route('/get_current_frame', methods=['GET'])
 def get_current_frame():
     try:
-        # Log the values of the global variables before returning them
-        logging.debug(f"Returning last_update_time: {last_update_time}")
-        logging.debug(f"Returning current_frame: {current_frame}")
-        logging.debug(f"Returning total_frames: {total_frames}")
-        logging.debug(f"Returning estimated_runtime: {estimated_runtime}")
-        if frame_data:
-            logging.debug(f"Returning frame_data: {frame_data[:30]}...")  # Log only the first 30 characters of frame_data
-        else:
-            logging.debug("Returning frame_data: None")
-        
-        # Calculate the percentage of the movie completed
-        percentage_completed = (current_frame / total_frames) * 100 if total_frames else 0
-
-        response = {
-            "last_update_time": last_update_time,
-            "current_frame": current_frame,
-            "total_frames": total_frames,
-            "estimated_runtime": estimated_runtime,
-            "frame_data": frame_data,
-            "percentage_completed": percentage_completed
-        }
+        # Kept for older clients; new ones use /frames/status and /frames/<n>.png
+        state = read_frame() or {}
+        response = frame_summary(state)
+        image = read_frame_image(state['version']) if state.get('etag') else None
+        response["frame_data"] = base64.b64encode(image).decode('ascii') if image else None
         return jsonify(response), 200
     except Exception as e:
         logging.error(f"Error: {e}")
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
+
+@bp.route('/frames/status', methods=['GET'])
+def frame_status():
+    state = read_frame() or {}
+    response = jsonify(frame_summary(state))
+    # Cheap to revalidate: the version is the ETag
+    response.set_etag(str(state.get('version', 0)))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def immutable_frame_response(image, etag):
+    # A version's image never changes, so browsers and proxies can keep it for good
+    response = Response(image, mimetype='image/png')
+    response.set_etag(etag or hashlib.sha256(image).hexdigest()[:32])
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response.make_conditional(request)
+
+@bp.route('/frames/<int:version>.png', methods=['GET'])
+def frame_image(version):
+    state = read_frame()
+    image = read_frame_image(version)
+    if image is None:
+        return jsonify({"error": f"Frame {version} is not available."}), 404
+    return immutable_frame_response(image, state['etag'] if state and state['version'] == version else None)
+
+@bp.route('/frames/<int:version>.delta.png', methods=['GET'])
+def frame_delta(version):
+    # Tiles that changed since the previous version, drawn over it by the live page
+    state = read_frame()
+    delta = read_frame_image(version, 'delta.png')
+    if delta is None:
+        return jsonify({"error": f"No delta for frame {version}; fetch the whole frame."}), 404
+    return immutable_frame_response(delta, state['delta_etag'] if state and state['version'] == version else None)
+
+@bp.route('/frames/stream', methods=['GET'])
+def frame_stream():
+    # Server-Sent Events: one small event per new frame, a comment line to keep idle
+    # connections open. Served by gevent or gthread workers (see gunicorn_config.py).
+    since = request.args.get('since', type=int)
+    if since is None:
+        since = request.headers.get('Last-Event-ID', -1, type=int)
+
+    def events(version):
+        yield 'retry: 5000\n\n'
+        while True:
+            state = wait_for_frame(version, FRAME_STREAM_HEARTBEAT)
+            if state is None:
+                yield ': keep-alive\n\n'
+                continue
+            version = state['version']
+            yield f"id: {version}\nevent: frame\ndata: {json.dumps(frame_summary(state))}\n\n"
+
+    response = Response(events(since), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@bp.route('/frames/wait', methods=['GET'])
+def frame_wait():
+    # Long-poll fallback for clients without EventSource
+    since = request.args.get('since', -1, type=int)
+    state = wait_for_frame(since, FRAME_LONG_POLL_TIMEOUT)
+    if state is None:
+        return '', 204
+    return jsonify(frame_summary(state)), 200
+
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus text format, summed over every process
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,23 @@
+import os
+import tempfile
+
+# Files the gunicorn workers, the spooler and the batch CLI share go under one directory
+# of this user's that nobody else may open: the spooler's socket and key, the preview
+# cache, the live frame store and the metrics files. Others could plant files in a
+# shared path made first, or read what is there. It is on tmpfs where there is one.
+RUNTIME_DIR = os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or ('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()),
+    f'thermv2-{os.getuid()}' if hasattr(os, 'getuid') else 'thermv2')
+
+
+def private_dir(path=RUNTIME_DIR):
+    # Makes the directory if need be and refuses to use one someone else owns or can get
+    # into; the runtime directory itself is checked first for any directory inside it
+    if os.path.dirname(os.path.normpath(path)) == os.path.normpath(RUNTIME_DIR):
+        private_dir(RUNTIME_DIR)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if hasattr(os, 'getuid'):
+        stat = os.stat(path)
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+            raise RuntimeError(f"{path} must belong to this user and be closed to everyone else.")
+    return path
@@ -0,0 +1,548 @@
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import select
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener, answer_challenge, deliver_challenge, wait
+
+from .flow_control import FlowControl
+from .metrics import StageTimer, increment, set_gauge
+from .records import record_print
+from .runtime_dir import RUNTIME_DIR, private_dir
+
+# Every gunicorn worker (and the batch CLI) hands jobs to the spooler as pickles, so only
+# this user may reach it: by default over a Unix socket in a directory nobody else can
+# open, always behind a random key the spooler makes when it starts and leaves in a file
+# only this user can read. SPOOLER_ADDRESS="host:port" (or a socket path) moves it;
+# SPOOLER_AUTHKEY (hex) sets the key for processes that cannot read the file.
+SPOOLER_DIR = RUNTIME_DIR
+SPOOLER_KEY_FILE = os.path.join(SPOOLER_DIR, 'spooler.key')
+SPOOLER_START_TIMEOUT = 30  # Seconds start_spooler waits for the spooler to answer
+REQUEST_TIMEOUT = 10  # Seconds a client waits on each step of a request
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return (host, int(port)) if host and port.isdigit() else address
+
+
+SPOOLER_ADDRESS = parse_address(os.environ.get('SPOOLER_ADDRESS') or (
+    os.path.join(SPOOLER_DIR, 'spooler.sock') if hasattr(socket, 'AF_UNIX') else '127.0.0.1:9101'))
+
+HEALTH_CHECK_INTERVAL = 30  # Seconds of idle time between connection checks
+RECONNECT_DELAY = 1  # First retry delay in seconds, doubled up to RECONNECT_DELAY_MAX
+RECONNECT_DELAY_MAX = 30
+JOB_ATTEMPTS = 2  # Tries on a fresh connection before the job moves to another printer
+JOB_HISTORY = 200  # Finished jobs kept for the /jobs endpoints
+PROCESSING_THREADS = 2
+
+
+class PrinterConnection:
+    def __init__(self, name, host, port, width, impl='bitImageRaster'):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.width = width
+        self.impl = impl  # Raster command the printer understands (see encode_raster)
+        self.printer = None
+        # Pacing model, calibrated for this printer as jobs go through
+        self.flow = FlowControl()
+        # Dispatch state, guarded by the spooler's dispatch lock
+        self.healthy = False
+        self.outstanding = 0  # Raster bytes queued or printing here
+        self.jobs = queue.Queue()
+
+    def connect(self):
+        from escpos.printer import Network
+
+        from .printing import reset_printer
+
+        timer = StageTimer('thermv2_print_stage_seconds')
+        printer = Network(self.host, self.port, timeout=10)
+        printer.open()
+        # Set the media width in the printer profile
+        printer.profile.profile_data['media']['width']['pixels'] = self.width
+        # Reset once per connection instead of once per job
+        reset_printer(printer)
+        timer.lap('connect')
+        self.printer = printer
+        logging.info(f"Spooler connected to printer {self.name} at {self.host}:{self.port}")
+
+    def close(self):
+        if self.printer is not None:
+            try:
+                self.printer.close()
+            except Exception:
+                pass
+        self.printer = None
+
+    def is_alive(self):
+        if self.printer is None or not self.printer._device:
+            return False
+        sock = self.printer._device
+        try:
+            readable, _, errored = select.select([sock], [], [sock], 0)
+            if errored:
+                return False
+            if readable:
+                # A readable socket that returns no data means the printer hung up;
+                # anything else is unsolicited status we can drop
+                return sock.recv(64) != b''
+        except OSError:
+            return False
+        return True
+
+    def try_connect(self):
+        # One attempt; the caller decides how long to wait before the next
+        if self.is_alive():
+            return True
+        self.close()
+        try:
+            self.connect()
+            return True
+        except Exception as e:
+            logging.error(f"Spooler could not connect to printer {self.name}: {e}")
+            return False
+
+
+def job_width(job):
+    # Dots the job needs across the paper; text reflows to any printer
+    if job['type'] == 'image':
+        return job['image'].width
+    if job['type'] == 'raster':
+        return job['width']
+    if job['type'] == 'strips':
+        return job['strips'].width
+    return 0
+
+
+def job_bytes(job):
+    if job['type'] == 'image':
+        return -(-job['image'].width // 8) * job['image'].height
+    if job['type'] == 'raster':
+        return job['bits'].size
+    if job['type'] == 'strips':
+        return -(-job['strips'].width // 8) * job['strips'].height
+    return len(job.get('message') or '')
+
+
+class Spooler:
+    def __init__(self, connections):
+        self.connections = connections
+        self.jobs = {}
+        self.payloads = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.ids = itertools.count(1)
+        # Image processing runs here so the HTTP workers never wait for it
+        self.executor = ThreadPoolExecutor(max_workers=PROCESSING_THREADS)
+        # Printers are picked under their own lock; jobs no healthy printer can take wait here
+        self.dispatch_lock = threading.Lock()
+        self.waiting = []
+
+    def submit(self, job):
+        from .printing import prepare_job
+
+        with self.lock:
+            job_id = next(self.ids)
+            record = {
+                'id': job_id,
+                'type': job['type'],
+                'name': job.get('name'),
+                'status': 'queued',
+                'error': None,
+                'printer': None,
+                'queued_at': time.time(),
+                'processing_at': None,
+                'processed_at': None,
+                'printing_at': None,
+                'finished_at': None,
+                'throughput': None,
+            }
+            self.jobs[job_id] = record
+            # Forget the oldest finished jobs once the history is full
+            while len(self.jobs) > JOB_HISTORY:
+                oldest = min(self.jobs)
+                if self.jobs[oldest]['status'] not in ('done', 'failed'):
+                    break
+                del self.jobs[oldest]
+        self.payloads[job_id] = self.executor.submit(self._prepare, job_id, prepare_job, job)
+        self.queue.put(job_id)
+        self._update_gauges()
+        return self.status(job_id)
+
+    def _prepare(self, job_id, prepare_job, job):
+        self._set(job_id, status='processing', processing_at=time.time())
+        prepared = prepare_job(job, job_id, self.print_width())
+        self._set(job_id, processed_at=time.time())
+        return prepared
+
+    def _set(self, job_id, **fields):
+        with self.lock:
+            if job_id in self.jobs:
+                self.jobs[job_id].update(fields)
+                if fields.get('status') in ('done', 'failed'):
+                    increment('thermv2_jobs_total', type=self.jobs[job_id]['type'], status=fields['status'])
+        self._update_gauges()
+
+    def _update_gauges(self):
+        with self.lock:
+            counts = dict.fromkeys(('queued', 'processing', 'printing'), 0)
+            for record in self.jobs.values():
+                if record['status'] in counts:
+                    counts[record['status']] += 1
+        for status, count in counts.items():
+            set_gauge('thermv2_spooler_jobs', count, status=status)
+
+    def status(self, job_id):
+        with self.lock:
+            record = self.jobs.get(job_id)
+            if record is None:
+                return None
+            record = dict(record)
+        record['timings'] = _timings(record)
+        return record
+
+    def list(self):
+        with self.lock:
+            job_ids = sorted(self.jobs, reverse=True)
+        return [record for record in map(self.status, job_ids) if record is not None]
+
+    def print_width(self):
+        # Uploads are processed for the narrowest printer that is up, so any of those can
+        # print them; with none up, for the narrowest of all
+        with self.dispatch_lock:
+            healthy = [connection.width for connection in self.connections if connection.healthy]
+            return min(healthy or [connection.width for connection in self.connections])
+
+    def printers(self):
+        with self.dispatch_lock:
+            return [{
+                'name': connection.name,
+                'host': connection.host,
+                'port': connection.port,
+                'width': connection.width,
+                'healthy': connection.healthy,
+                'queued': connection.jobs.qsize(),
+                'outstanding_bytes': connection.outstanding,
+                'bytes_per_second': round(connection.flow.bytes_per_second),
+            } for connection in self.connections]
+
+    def order_loop(self):
+        # Jobs are dispatched in the order they were submitted, whichever finished processing first
+        while True:
+            job_id = self.queue.get()
+            try:
+                job = self.payloads.pop(job_id).result()
+            except Exception as e:
+                logging.error(f"Spooler job {job_id} failed while processing: {e}")
+                self._set(job_id, status='failed', error=str(e), finished_at=time.time())
+                continue
+            self.dispatch(job_id, job, set())
+
+    def dispatch(self, job_id, job, tried):
+        # Least loaded means the least modelled print time already queued on the printer;
+        # among equals the narrowest printer that fits, keeping wide paper free for wide jobs
+        width = job_width(job)
+        with self.dispatch_lock:
+            fits = [connection for connection in self.connections
+                    if connection.width >= width and connection.name not in tried]
+            candidates = [connection for connection in fits if connection.healthy]
+            if candidates:
+                target = min(candidates, key=lambda connection: (
+                    connection.outstanding / connection.flow.bytes_per_second, connection.width))
+                target.outstanding += job_bytes(job)
+                target.jobs.put((job_id, job, tried))
+                return
+            if fits:
+                # Every printer that could take it is down for now
+                self._set(job_id, status='queued')
+                self.waiting.append((job_id, job, tried))
+                return
+        if not width:
+            error = "No printer left to try for this job" if tried else "No printer to print on"
+        elif tried:
+            error = f"No printer left to try for a job {width} dots wide"
+        else:
+            error = f"No printer is {width} dots wide"
+        logging.error(f"Spooler job {job_id} failed: {error}")
+        self._set(job_id, status='failed', error=error, finished_at=time.time())
+
+    def _dispatch_waiting(self):
+        with self.dispatch_lock:
+            waiting, self.waiting = self.waiting, []
+        for job_id, job, tried in waiting:
+            self.dispatch(job_id, job, tried)
+
+    def _set_health(self, connection, healthy):
+        drained = []
+        with self.dispatch_lock:
+            if connection.healthy == healthy:
+                return
+            connection.healthy = healthy
+            if not healthy:
+                # Drain: whatever was queued here goes to the other printers
+                while True:
+                    try:
+                        drained.append(connection.jobs.get_nowait())
+                    except queue.Empty:
+                        break
+                connection.outstanding = 0
+        set_gauge('thermv2_printer_healthy', int(healthy), printer=connection.name)
+        logging.log(logging.INFO if healthy else logging.WARNING,
+                    f"Printer {connection.name} is {'healthy' if healthy else 'down'}")
+        if healthy:
+            self._dispatch_waiting()
+        for job_id, job, tried in drained:
+            self.dispatch(job_id, job, tried)
+
+    def _recover(self, connection):
+        delay = RECONNECT_DELAY
+        while not connection.try_connect():
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_DELAY_MAX)
+        self._set_health(connection, True)
+
+    def _cut_partial(self, connection):
+        # Whatever the failed job got onto the paper is cut off, so the next job starts on
+        # a page of its own; it stopped between whole commands, so the printer takes this
+        try:
+            connection.printer.cut(mode='PART', feed=True)
+        except Exception as e:
+            logging.error(f"Printer {connection.name} did not take the cut after a failed job: {e}")
+            connection.close()
+
+    def printer_loop(self, connection):
+        from .printing import run_job
+
+        self._recover(connection)
+        while True:
+            try:
+                job_id, job, tried = connection.jobs.get(timeout=HEALTH_CHECK_INTERVAL)
+            except queue.Empty:
+                # Idle: make sure the connection is still there before the next job arrives
+                if not connection.try_connect():
+                    self._set_health(connection, False)
+                    self._recover(connection)
+                continue
+
+            printing_at = time.time()
+            self._set(job_id, status='printing', printing_at=printing_at, printer=connection.name)
+            finished = False
+            reached = False  # Whether any of the job got to this printer
+            for attempt in range(JOB_ATTEMPTS):
+                if not connection.try_connect():
+                    break
+                reached = True
+                try:
+                    throughput = run_job(connection.printer, job, connection.flow, connection.impl)
+                    finished_at = time.time()
+                    self._set(job_id, status='done', finished_at=finished_at, throughput=throughput)
+                    record_print(job_id, round(finished_at - printing_at, 3))
+                    finished = True
+                    break
+                except OSError as e:
+                    # The connection went (sockets raise OSError, timeouts included)
+                    logging.error(f"Spooler job {job_id} failed on {connection.name} (attempt {attempt + 1}): {e}")
+                    self._set(job_id, error=str(e))
+                    connection.close()
+                except Exception as e:
+                    # The job itself is broken, say a band that failed to process: another
+                    # printer would do no better, and this one is fine
+                    logging.error(f"Spooler job {job_id} failed on {connection.name}: {e}")
+                    self._set(job_id, status='failed', error=str(e), finished_at=time.time())
+                    finished = True
+                    self._cut_partial(connection)
+                    break
+
+            with self.dispatch_lock:
+                connection.outstanding = max(0, connection.outstanding - job_bytes(job))
+            if not finished:
+                # Take this printer out of rotation and give the job to another one. A job
+                # that never got here may come back once the printer does, so this one
+                # only counts as tried if the job failed on it
+                self._set(job_id, printer=None)
+                self._set_health(connection, False)
+                self.dispatch(job_id, job, tried | {connection.name} if reached else tried)
+                self._recover(connection)
+
+    def client_loop(self, conn):
+        try:
+            while True:
+                request = conn.recv()
+                if request['op'] == 'submit':
+                    conn.send(self.submit(request['job']))
+                elif request['op'] == 'status':
+                    conn.send(self.status(request['id']))
+                elif request['op'] == 'list':
+                    conn.send(self.list())
+                elif request['op'] == 'printers':
+                    conn.send(self.printers())
+                else:
+                    conn.send(None)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+
+def _timings(record):
+    def elapsed(start, end):
+        if record[start] is None or record[end] is None:
+            return None
+        return round(record[end] - record[start], 3)
+
+    return {
+        'queued': elapsed('queued_at', 'processing_at'),
+        'processing': elapsed('processing_at', 'processed_at'),
+        'printing': elapsed('printing_at', 'finished_at'),
+        'total': elapsed('queued_at', 'finished_at'),
+    }
+
+
+def _remove_stale_socket(address):
+    # A socket file left by a spooler that died; a live one makes the bind fail below
+    if isinstance(address, str) and os.path.exists(address):
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(address)
+        except ConnectionRefusedError:
+            os.unlink(address)
+        finally:
+            probe.close()
+
+
+def _write_authkey(authkey):
+    private_dir(SPOOLER_DIR)
+    partial = f'{SPOOLER_KEY_FILE}.{os.getpid()}'
+    fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+    os.replace(partial, SPOOLER_KEY_FILE)
+
+
+def read_authkey():
+    if os.environ.get('SPOOLER_AUTHKEY'):
+        return bytes.fromhex(os.environ['SPOOLER_AUTHKEY'])
+    with open(SPOOLER_KEY_FILE, 'rb') as f:
+        return f.read()
+
+
+def _default_signals():
+    # A spooler the gunicorn master starts again is forked with the arbiter's signal
+    # handlers, and would take the SIGTERM that stops it as a message for the arbiter
+    for name in ('SIGHUP', 'SIGQUIT', 'SIGTERM', 'SIGTTIN', 'SIGTTOU', 'SIGUSR1', 'SIGUSR2', 'SIGWINCH', 'SIGCHLD'):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+
+def run_spooler(printers=None, ready=None):
+    from .printing import PRINTERS
+
+    if threading.current_thread() is threading.main_thread():
+        _default_signals()
+    authkey = bytes.fromhex(os.environ['SPOOLER_AUTHKEY']) if os.environ.get('SPOOLER_AUTHKEY') else os.urandom(32)
+    try:
+        if isinstance(SPOOLER_ADDRESS, str):
+            private_dir(SPOOLER_DIR)
+            _remove_stale_socket(SPOOLER_ADDRESS)
+        listener = Listener(SPOOLER_ADDRESS, authkey=authkey)
+    except OSError as e:
+        # Another spooler already owns the printers, or something else has the address
+        raise RuntimeError(f"Spooler cannot listen on {SPOOLER_ADDRESS}: {e}") from e
+    # Only once the address is ours, so a spooler that failed to start leaves the key alone
+    if not os.environ.get('SPOOLER_AUTHKEY'):
+        _write_authkey(authkey)
+    if ready is not None:
+        ready.set()
+
+    connections = [PrinterConnection(printer['name'], printer['host'], printer['port'], printer['width'],
+                                     printer.get('impl', 'bitImageRaster'))
+                   for printer in printers or PRINTERS]
+    spooler = Spooler(connections)
+    threading.Thread(target=spooler.order_loop, daemon=True).start()
+    # One thread per printer, each with its own connection and queue
+    for connection in connections:
+        threading.Thread(target=spooler.printer_loop, args=(connection,), name=f'printer-{connection.name}',
+                         daemon=True).start()
+
+    logging.info(f"Spooler listening on {SPOOLER_ADDRESS}")
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:
+            logging.error(f"Spooler rejected connection: {e}")
+            continue
+        threading.Thread(target=spooler.client_loop, args=(conn,), daemon=True).start()
+
+
+def start_spooler():
+    # Returns once the spooler is listening, so the workers forked after it find it
+    # running; raises if it could not start
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=run_spooler, kwargs={'ready': ready}, name='thermv2-spooler',
+                                      daemon=True)
+    process.start()
+    deadline = time.monotonic() + SPOOLER_START_TIMEOUT
+    while not ready.wait(0.1):
+        if not process.is_alive():
+            raise RuntimeError(f"Spooler exited on start (code {process.exitcode}); see the log above.")
+        if time.monotonic() > deadline:
+            process.terminate()
+            raise RuntimeError(f"Spooler did not start listening on {SPOOLER_ADDRESS} "
+                               f"within {SPOOLER_START_TIMEOUT}s.")
+    return process
+
+
+def spooler_exited(process):
+    # Whoever reaps it: the gunicorn master waits on all of its children, the spooler
+    # included, which leaves is_alive() saying True for good. The sentinel closes anyway.
+    return bool(wait([process.sentinel], 0))
+
+
+def _wait(conn):
+    if not conn.poll(REQUEST_TIMEOUT):
+        raise TimeoutError(f"No answer from the spooler on {SPOOLER_ADDRESS} within {REQUEST_TIMEOUT}s.")
+
+
+def _request(request):
+    # Client() with a deadline on every read, so whatever else may be listening on the
+    # address cannot hang a worker
+    conn = Client(SPOOLER_ADDRESS)
+    try:
+        # Under gevent the socket Client() detaches is left non-blocking, and the plain
+        # reads and writes of a Connection give up with EAGAIN on a full buffer
+        if os.name == 'posix':
+            os.set_blocking(conn.fileno(), True)
+        authkey = read_authkey()
+        _wait(conn)
+        answer_challenge(conn, authkey)
+        deliver_challenge(conn, authkey)
+        conn.send(request)
+        _wait(conn)
+        return conn.recv()
+    finally:
+        conn.close()
+
+
+def submit_job(job):
+    return _request({'op': 'submit', 'job': job})
+
+
+def get_job(job_id):
+    return _request({'op': 'status', 'id': job_id})
+
+
+def list_jobs():
+    return _request({'op': 'list'})
+
+
+def list_printers():
+    return _request({'op': 'printers'})
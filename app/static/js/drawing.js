@@ -17,8 +17,8 @@ document.addEventListener('DOMContentLoaded', function() {
     let history = []; // To store the history of drawings
 
     // Set the canvas resolution and scaling factor
-    const canvasWidth = 576; // Set to printer width
-    const canvasHeight = 576;
+    const canvasWidth = drawingCanvas.width; // Set by the page to the narrowest printer's width
+    const canvasHeight = drawingCanvas.height;
     const scaleFactor = 1; // Increase this value to make pixels bigger
 
     drawingCanvas.width = canvasWidth;
@@ -218,18 +218,70 @@ document.addEventListener('DOMContentLoaded', function() {
         link.click();
     });
 
+    // Pack the canvas into 1-bit rows, MSB first, 1 = black: strokes flattened onto white
+    // paper and thresholded, which is all the printer can show anyway
+    function packCanvas() {
+        const pixels = ctx.getImageData(0, 0, canvasWidth, canvasHeight).data;
+        const rowBytes = Math.ceil(canvasWidth / 8);
+        const packed = new Uint8Array(rowBytes * canvasHeight);
+        for (let y = 0; y < canvasHeight; y++) {
+            for (let x = 0; x < canvasWidth; x++) {
+                const i = (y * canvasWidth + x) * 4;
+                const alpha = pixels[i + 3];
+                const luma = (pixels[i] * 299 + pixels[i + 1] * 587 + pixels[i + 2] * 114) / 1000;
+                // Grey level once composited over white
+                if (luma * alpha / 255 + 255 - alpha < 128) {
+                    packed[y * rowBytes + (x >> 3)] |= 0x80 >> (x & 7);
+                }
+            }
+        }
+        return packed;
+    }
+
+    // PackBits: n < 128 is followed by n + 1 literal bytes, n > 128 by one byte repeated 257 - n times
+    function packBits(data) {
+        const out = [];
+        let i = 0;
+        while (i < data.length) {
+            let run = 1;
+            while (run < 128 && i + run < data.length && data[i + run] === data[i]) run++;
+            if (run > 1) {
+                out.push(257 - run, data[i]);
+                i += run;
+                continue;
+            }
+            // Literals up to the next run of three or more
+            let end = i + 1;
+            while (end < data.length && end - i < 128 &&
+                   !(end + 2 < data.length && data[end] === data[end + 1] && data[end] === data[end + 2])) {
+                end++;
+            }
+            out.push(end - i - 1);
+            for (let j = i; j < end; j++) out.push(data[j]);
+            i = end;
+        }
+        return new Uint8Array(out);
+    }
+
     printDrawingButton.addEventListener('click', () => {
         flashMessages.innerHTML = '<p>Drawing is being printed...</p>';
-        const dataURL = drawingCanvas.toDataURL('image/png');
+        const packed = packCanvas();
+        const compressed = packBits(packed);
+        const headers = {
+            'Content-Type': 'application/octet-stream',
+            'X-Drawing-Width': canvasWidth,
+            'X-Drawing-Height': canvasHeight
+        };
+        if (compressed.length < packed.length) {
+            headers['X-Drawing-Encoding'] = 'packbits';
+        }
         fetch('/print_drawing', {
             method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({ image: dataURL })
+            headers: headers,
+            body: headers['X-Drawing-Encoding'] ? compressed : packed
         }).then(response => {
             if (response.ok) {
-                flashMessages.innerHTML = '<p>Drawing printed successfully!</p>';
+                response.json().then(job => watchJob(job, flashMessages, 'Drawing'));
             } else {
                 flashMessages.innerHTML = '<p>Failed to print drawing.</p>';
             }
@@ -0,0 +1,34 @@
+// Print routes return a job as soon as it is queued; poll it until the printer is done
+const JOB_MESSAGES = {
+    queued: 'is queued',
+    processing: 'is being processed',
+    printing: 'is being printed',
+    done: 'printed successfully!',
+    failed: 'failed to print.'
+};
+
+function watchJob(job, flashMessages, label) {
+    if (!(job.status in JOB_MESSAGES)) {
+        flashMessages.innerHTML = `<p>${label} status is unknown: ${job.error || job.status}</p>`;
+        return;
+    }
+    flashMessages.innerHTML = `<p>${label} ${JOB_MESSAGES[job.status]}...</p>`;
+    if (job.status === 'done' || job.status === 'failed') {
+        flashMessages.innerHTML = `<p>${label} ${JOB_MESSAGES[job.status]}</p>`;
+        return;
+    }
+    setTimeout(() => {
+        fetch(`/jobs/${job.id}`)
+            .then(response => response.json().then(updated => {
+                // The spooler went away or forgot the job: stop polling rather than ask forever
+                if (!response.ok) {
+                    throw new Error(updated.error || `HTTP ${response.status}`);
+                }
+                watchJob(updated, flashMessages, label);
+            }))
+            .catch(error => {
+                console.error('Error:', error);
+                flashMessages.innerHTML = `<p>${label} status is unknown: ${error.message}</p>`;
+            });
+    }, 1000);
+}
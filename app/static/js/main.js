@@ -13,6 +13,29 @@ document.addEventListener('DOMContentLoaded', function() {
     const flashMessages = document.getElementById('flash-messages');
     const messageInput = document.getElementById('message');
     const nameInput = document.getElementById('name');
+    const compareDitherButton = document.getElementById('compare-dither-button');
+    const variantsContainer = document.getElementById('dither-variants');
+
+    let imageHash = null; // Hash of the current file once the server has cached it
+
+    function requestPreview(formData) {
+        return fetch('/process_image', {
+            method: 'POST',
+            body: formData
+        })
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`Preview failed with status ${response.status}`);
+            }
+            imageHash = response.headers.get('X-Image-Hash');
+            return response.blob();
+        })
+        .then(blob => {
+            const url = URL.createObjectURL(blob);
+            preview.src = url;
+            printImageButton.disabled = false; // Enable the button
+        });
+    }
 
     function updatePreview() {
         const file = imageInput.files[0];
@@ -22,21 +45,75 @@ document.addEventListener('DOMContentLoaded', function() {
             const formData = new FormData();
             formData.append('image', file);
             formData.append('dither', dither);
+            requestPreview(formData).catch(error => console.error('Error:', error));
+        }
+    }
 
-            fetch('/process_image', {
-                method: 'POST',
-                body: formData
-            })
-            .then(response => response.blob())
-            .then(blob => {
-                const url = URL.createObjectURL(blob);
-                preview.src = url;
-                printImageButton.disabled = false; // Enable the button
-            })
-            .catch(error => console.error('Error:', error));
+    function updateDither() {
+        if (!imageHash) {
+            updatePreview();
+            return;
         }
+        // Only the dither changed: send the hash and fall back to the file if the cache lost it
+        const formData = new FormData();
+        formData.append('image_hash', imageHash);
+        formData.append('dither', ditherSelect.value);
+        requestPreview(formData).catch(() => {
+            imageHash = null;
+            updatePreview();
+        });
     }
 
+    function showVariants() {
+        const file = imageInput.files[0];
+        if (!file && !imageHash) {
+            return;
+        }
+        const formData = new FormData();
+        if (imageHash) {
+            formData.append('image_hash', imageHash);
+        } else {
+            formData.append('image', file);
+        }
+
+        fetch('/process_image/variants', {
+            method: 'POST',
+            body: formData
+        })
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`Variants failed with status ${response.status}`);
+            }
+            imageHash = response.headers.get('X-Image-Hash');
+            const variants = response.headers.get('X-Dither-Variants').split(',');
+            const [width, height] = response.headers.get('X-Variant-Size').split('x').map(Number);
+            const columns = Number(response.headers.get('X-Variant-Columns'));
+            return response.blob().then(blob => ({ blob, variants, width, height, columns }));
+        })
+        .then(({ blob, variants, width, height, columns }) => {
+            // One sprite sheet holds every variant; each tile shows its slice of it
+            const url = URL.createObjectURL(blob);
+            variantsContainer.innerHTML = '';
+            variants.forEach((variant, index) => {
+                const tile = document.createElement('div');
+                tile.className = 'dither-variant';
+                tile.title = variant;
+                tile.style.width = `${width}px`;
+                tile.style.height = `${height}px`;
+                tile.style.backgroundImage = `url(${url})`;
+                tile.style.backgroundPosition = `-${(index % columns) * width}px -${Math.floor(index / columns) * height}px`;
+                tile.addEventListener('click', () => {
+                    ditherSelect.value = variant;
+                    updateDither();
+                });
+                variantsContainer.appendChild(tile);
+            });
+        })
+        .catch(error => console.error('Error:', error));
+    }
+
+    compareDitherButton.addEventListener('click', showVariants);
+
     uploadImageButton.addEventListener('click', () => {
         imageInput.click();
     });
@@ -63,8 +140,12 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 
-    imageInput.addEventListener('change', updatePreview);
-    ditherSelect.addEventListener('change', updatePreview);
+    imageInput.addEventListener('change', () => {
+        imageHash = null;
+        variantsContainer.innerHTML = '';
+        updatePreview();
+    });
+    ditherSelect.addEventListener('change', updateDither);
 
     form.addEventListener('submit', (event) => {
         event.preventDefault(); // Prevent the default form submission
@@ -76,10 +157,11 @@ document.addEventListener('DOMContentLoaded', function() {
         })
         .then(response => {
             if (response.ok) {
-                flashMessages.innerHTML = '<p>Image printed successfully!</p>';
+                response.json().then(job => watchJob(job, flashMessages, 'Image'));
                 // Clear the uploaded image and preview
                 imageInput.value = '';
                 preview.src = '';
+                variantsContainer.innerHTML = '';
                 printImageButton.disabled = true; // Disable the button
             } else {
                 flashMessages.innerHTML = '<p>Failed to print image.</p>';
@@ -101,7 +183,7 @@ document.addEventListener('DOMContentLoaded', function() {
         })
         .then(response => {
             if (response.ok) {
-                flashMessages.innerHTML = '<p>Message printed successfully!</p>';
+                response.json().then(job => watchJob(job, flashMessages, 'Message'));
                 // Clear the message field but keep the name
                 messageInput.value = '';
             } else {
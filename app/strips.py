@@ -0,0 +1,214 @@
+import queue
+import threading
+
+import cv2
+import numpy as np
+from PIL import Image, ImageEnhance
+
+from .dithering import ErrorDiffuser, blue_noise_matrix
+from .image_processing import (BAYER_2x2, BAYER_4x4, BAYER_8x8, PRINTER_WIDTH, analyze_image, apply_bayer_dithering,
+                               classify_brightness, compile_settings, enhance_gray_edges, load_image, settings)
+from .metrics import StageTimer
+
+# Tall uploads (long receipts, panoramas) are processed and printed band by band, so the
+# first band reaches the paper while the rest is still being worked on and nothing past
+# the decoded grayscale is ever held at full height
+STRIP_HEIGHT = 256  # Rows per band; a multiple of DIFFUSION_ROWS and of every threshold matrix
+STRIP_LOOKAHEAD = 2  # Bands processed ahead of the one being sent
+CLAHE_TILE = PRINTER_WIDTH // 8  # Square CLAHE tiles; eight to the image height would be far too tall
+EDGE_REACH = 2  # Rows the 5x5 dilate in enhance_gray_edges reads past each side
+SHARPEN_REACH = 1  # Rows the 3x3 smoothing behind ImageEnhance.Sharpness reads past each side
+
+ORDERED_DITHERS = {'BAYER_2x2': BAYER_2x2, 'BAYER_4x4': BAYER_4x4, 'BAYER_8x8': BAYER_8x8}
+
+
+def open_strips(image_path, dither_option, edge_enhance=False, profile=None, print_width=PRINTER_WIDTH):
+    # Decoding still needs the whole file; everything after it works a band at a time
+    gray_image, target_size = load_image(image_path, True, print_width)
+    if gray_image.shape[::-1] != target_size:
+        gray_image = cv2.resize(gray_image, target_size, interpolation=cv2.INTER_AREA)
+    return Strips(gray_image, dither_option, edge_enhance, profile)
+
+
+def equalize_lut(gray):
+    # cv2.equalizeHist as a lookup table, from the histogram of the whole image
+    histogram = np.bincount(gray.ravel(), minlength=256)
+    first = np.flatnonzero(histogram)[0]
+    if histogram[first] == gray.size:
+        return np.full(256, first, dtype=np.uint8)
+    scale = np.float32(255 / (gray.size - histogram[first]))
+    counts = np.cumsum(histogram) - histogram[first]
+    return np.clip(np.rint(counts * scale), 0, 255).astype(np.uint8)
+
+
+def clahe_maps(gray, clip_limit=2.0):
+    # Contrast-limited equalization maps for every CLAHE_TILE square, worked out the way
+    # OpenCV does: clip each histogram, hand the excess back evenly, then accumulate.
+    # Only the histograms need the whole image, and they take one pass over it.
+    height, width = gray.shape
+    tiles_y, tiles_x = -(-height // CLAHE_TILE), -(-width // CLAHE_TILE)
+    maps = np.empty((tiles_y, tiles_x, 256), dtype=np.uint8)
+    columns = np.minimum(np.arange(width) // CLAHE_TILE, tiles_x - 1) * 256
+    for ty in range(tiles_y):
+        rows = gray[ty * CLAHE_TILE:(ty + 1) * CLAHE_TILE]
+        histograms = np.bincount((columns + rows).ravel(), minlength=tiles_x * 256).reshape(tiles_x, 256)
+        # Tiles on the right and bottom edges can be smaller than the rest
+        areas = histograms.sum(axis=1, keepdims=True)
+        limits = np.maximum((clip_limit * areas / 256).astype(np.int64), 1)
+        excess = np.maximum(histograms - limits, 0).sum(axis=1, keepdims=True)
+        histograms = np.minimum(histograms, limits) + excess // 256
+        for tx, residual in enumerate((excess % 256).ravel()):
+            if residual:
+                histograms[tx, ::max(256 // residual, 1)][:residual] += 1
+        scale = (np.float32(255) / areas.astype(np.float32))
+        maps[ty] = np.clip(np.rint(np.cumsum(histograms, axis=1) * scale), 0, 255)
+    return maps
+
+
+class Strips:
+    def __init__(self, gray_image, dither_option, edge_enhance=False, profile=None, band_height=STRIP_HEIGHT):
+        # gray_image is the whole upload in grayscale at print width; the profile is picked
+        # from its brightness, as preprocess_image does
+        self.gray = gray_image
+        self.height, self.width = gray_image.shape
+        if profile is None:
+            profile = classify_brightness(analyze_image(gray_image))
+        self.profile = profile
+        self.dither_option = dither_option or settings[profile]['dither']
+        self.edge_enhance = edge_enhance or settings[profile]['edge_enhance']
+        self.band_height = band_height
+        self.on_complete = None  # Called once with all the packed rows after the first full pass
+        self.equalize_lut = None
+        self.clahe_maps = None
+        if settings[profile]['equalize'] and settings[profile]['equalize_method'] == 'HISTOGRAM':
+            self.equalize_lut = equalize_lut(gray_image)
+
+    def bands(self):
+        # Packed 1-bit bands (MSB first, 1 = black), worked out on a thread of their own at
+        # most STRIP_LOOKAHEAD ahead of the reader. Every call starts again from the top, so
+        # a job moved to another printer prints all of it.
+        ready = queue.Queue(maxsize=STRIP_LOOKAHEAD)
+        stop = threading.Event()
+
+        def offer(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for band in self.process():
+                    if not offer(band):
+                        return
+                offer(None)
+            except Exception as e:
+                offer(e)
+
+        threading.Thread(target=produce, name='strips', daemon=True).start()
+        printed = []
+        try:
+            while True:
+                band = ready.get()
+                if band is None:
+                    break
+                if isinstance(band, Exception):
+                    raise band
+                printed.append(band)
+                yield band
+        finally:
+            # The reader stopped early (the printer failed): let the producer go
+            stop.set()
+        if self.on_complete is not None:
+            on_complete, self.on_complete = self.on_complete, None
+            on_complete(np.vstack(printed))
+
+    def process(self):
+        # The same bands as bands(), on the calling thread
+        dither = self.ditherer()
+        for top, sharpened, timer in self.gray_bands():
+            dithered = dither(sharpened, top)
+            timer.lap('dither')
+            yield np.packbits(dithered == 0, axis=1)
+
+    def gray_bands(self):
+        # (first row, gray rows ready for dithering, stage timer) for each band
+        for top in range(0, self.height, self.band_height):
+            bottom = min(self.height, top + self.band_height)
+            start, end = max(0, top - SHARPEN_REACH), min(self.height, bottom + SHARPEN_REACH)
+            timer = StageTimer('thermv2_image_stage_seconds')
+            toned = self.tone(start, end, timer)
+            yield top, self.sharpen(toned, timer)[top - start:bottom - start], timer
+
+    def pre_dither(self):
+        # The whole image ready for dithering, exactly as the bands print it
+        return np.vstack([rows for _, rows, _ in self.gray_bands()])
+
+    def tone(self, start, end, timer):
+        # Equalization, edges and the tone curve for rows start to end, as in preprocess_image
+        current_settings = settings[self.profile]
+        compiled = compile_settings(self.profile)
+        processed = self.gray[start:end]
+        if self.equalize_lut is not None:
+            processed = cv2.LUT(processed, self.equalize_lut)
+            timer.lap('clahe')
+        elif current_settings['equalize'] and current_settings['equalize_method'] == 'CLAHE':
+            processed = self.clahe(start, end)
+            timer.lap('clahe')
+
+        if self.edge_enhance:
+            low, high = max(0, start - EDGE_REACH), min(self.height, end + EDGE_REACH)
+            edges = enhance_gray_edges(self.gray[low:high])[start - low:end - low]
+            timer.lap('edges')
+            index = np.right_shift(edges, 7).astype(np.uint16)
+            index <<= 8
+            index |= processed
+            processed = compiled['edge_lut'].take(index)
+        else:
+            processed = cv2.LUT(processed, compiled['tone_lut'])
+        timer.lap('tone')
+        return processed
+
+    def clahe(self, start, end):
+        # Each row is blended between the tile maps above and below it, by its absolute
+        # position, so a band comes out the same however the image is cut
+        if self.clahe_maps is None:
+            self.clahe_maps = clahe_maps(self.gray)
+        maps = self.clahe_maps
+        tiles_y, tiles_x = maps.shape[:2]
+        y = np.arange(start, end, dtype=np.float32) / CLAHE_TILE - np.float32(0.5)
+        x = np.arange(self.width, dtype=np.float32) / CLAHE_TILE - np.float32(0.5)
+        y1, x1 = np.floor(y).astype(np.intp), np.floor(x).astype(np.intp)
+        ya, xa = (y - y1)[:, None], (x - x1)[None, :]
+        y1, y2 = np.clip(y1, 0, tiles_y - 1)[:, None], np.clip(y1 + 1, 0, tiles_y - 1)[:, None]
+        x1, x2 = np.clip(x1, 0, tiles_x - 1)[None, :], np.clip(x1 + 1, 0, tiles_x - 1)[None, :]
+        values = self.gray[start:end]
+        above = maps[y1, x1, values] * (1 - xa) + maps[y1, x2, values] * xa
+        below = maps[y2, x1, values] * (1 - xa) + maps[y2, x2, values] * xa
+        return np.rint(above * (1 - ya) + below * ya).astype(np.uint8)
+
+    def sharpen(self, processed, timer):
+        sharpness = compile_settings(self.profile)['sharpness']
+        if sharpness == 1:
+            return processed
+        sharpened = np.asarray(ImageEnhance.Sharpness(Image.fromarray(processed)).enhance(sharpness))
+        timer.lap('sharpen')
+        return sharpened
+
+    def ditherer(self):
+        # A function from (gray rows, row they start at) to 0/255 rows, carrying whatever
+        # the dither needs from one band to the next
+        option = self.dither_option
+        if option in ORDERED_DITHERS or option == 'BLUE_NOISE':
+            matrix = blue_noise_matrix() if option == 'BLUE_NOISE' else ORDERED_DITHERS[option]
+            return lambda rows, top: np.asarray(apply_bayer_dithering(rows, matrix, top))
+        if option == 'THRESHOLD':
+            return lambda rows, top: np.where(rows > 128, 255, 0).astype(np.uint8)
+        # Error diffusion, including plain Floyd-Steinberg: Pillow's cannot pick up where
+        # the last band stopped, so it runs the same kernel through ErrorDiffuser (and
+        # apply_dither does the same for tall images)
+        diffuser = ErrorDiffuser(option, self.width)
+        return lambda rows, top: diffuser.dither(rows)
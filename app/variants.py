@@ -0,0 +1,113 @@
+import multiprocessing
+import os
+from multiprocessing.connection import wait
+
+import numpy as np
+from PIL import Image
+
+from .image_processing import DITHER_OPTIONS, apply_dither
+
+VARIANT_REDUCE = 3  # Previews are the full-width dither box-reduced by this factor
+VARIANT_COLUMNS = 5  # Previews per row of the sprite sheet
+# Processes in each gunicorn worker's pool. The pools of all workers share the CPUs, so
+# each gets its share (gunicorn_config.py leaves the worker count in WEB_CONCURRENCY);
+# with fewer CPUs than workers there is no pool and the worker renders them itself.
+VARIANT_PROCESSES = min(len(DITHER_OPTIONS), 4,
+                        (os.cpu_count() or 1) // max(1, int(os.environ.get('WEB_CONCURRENCY') or 1)))
+
+# Each worker's pool: (process, connection) pairs, started on first use. The processes
+# come from a fork server with this module already imported, never from the worker
+# itself: a fork of a process running other threads can inherit a lock one of them
+# holds. Requests talk to them over plain pipes, with no helper threads, since under
+# gevent those are greenlets that block each other on full pipes.
+_idle = []
+_started = 0
+
+
+def _context():
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+def _serve(connection):
+    # In a pool process: render the options sent until the worker closes the pipe
+    while True:
+        try:
+            gray_array, options = connection.recv()
+        except EOFError:
+            return
+        connection.send([render_variant(gray_array, option) for option in options])
+
+
+def _checkout():
+    # Every idle pool process, topped up to VARIANT_PROCESSES; empty while other requests
+    # have them all
+    global _started
+    processes = []
+    while True:
+        try:
+            processes.append(_idle.pop())
+        except IndexError:
+            break
+    while _started < VARIANT_PROCESSES:
+        _started += 1
+        connection, child = multiprocessing.Pipe()
+        # Under gevent the socket pair behind the pipe is non-blocking, which a
+        # Connection's plain reads and writes do not expect
+        if os.name == 'posix':
+            os.set_blocking(connection.fileno(), True)
+            os.set_blocking(child.fileno(), True)
+        process = _context().Process(target=_serve, args=(child,), name='variants', daemon=True)
+        process.start()
+        child.close()
+        processes.append((process, connection))
+    return processes
+
+
+def render_variant(gray_array, dither_option):
+    # Dither at print width so the pattern is the real one, then shrink for the preview
+    dithered = apply_dither(Image.fromarray(gray_array), dither_option).convert('L')
+    return np.asarray(dithered.reduce(VARIANT_REDUCE))
+
+
+def _render_in_pool(gray_array):
+    global _started
+    processes = _checkout()
+    if not processes:
+        return {option: render_variant(gray_array, option) for option in DITHER_OPTIONS}
+
+    shares = [DITHER_OPTIONS[index::len(processes)] for index in range(len(processes))]
+    previews = {}
+    try:
+        # Each process is idle and reading, so every send completes
+        for (_, connection), options in zip(processes, shares):
+            connection.send((gray_array, options))
+        for (_, connection), options in zip(processes, shares):
+            wait([connection])  # Other requests run meanwhile under gevent
+            previews.update(zip(options, connection.recv()))
+    except BaseException:
+        # A pool process died, or this request stopped halfway through: either way the
+        # pipes are in an unknown state, so start fresh processes next time
+        for process, connection in processes:
+            connection.close()
+            process.terminate()
+        _started -= len(processes)
+        raise
+    _idle.extend(processes)
+    return previews
+
+
+def render_variants(gray_image):
+    previews = _render_in_pool(np.asarray(gray_image))
+    previews = [previews[option] for option in DITHER_OPTIONS]
+
+    height, width = previews[0].shape
+    rows = -(-len(previews) // VARIANT_COLUMNS)
+    sprite = np.full((rows * height, VARIANT_COLUMNS * width), 255, dtype=np.uint8)
+    for index, preview in enumerate(previews):
+        top, left = (index // VARIANT_COLUMNS) * height, (index % VARIANT_COLUMNS) * width
+        sprite[top:top + height, left:left + width] = preview
+    return Image.fromarray(sprite), (width, height)
@@ -0,0 +1,45 @@
+# Per-kernel dithering cost at printer width.
+# Run from the repository root: python -m benchmarks.bench_dithering
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from app.dithering import blue_noise_matrix
+from app.image_processing import DITHER_OPTIONS, PRINTER_WIDTH, apply_dither
+
+
+def synthetic_image(height, seed=0):
+    # A horizontal gradient with noise so every kernel has real error to diffuse
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, PRINTER_WIDTH)[None, :].repeat(height, axis=0)
+    noisy = gradient + rng.normal(0, 20, gradient.shape)
+    return Image.fromarray(np.clip(noisy, 0, 255).astype(np.uint8))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each dither mode at printer width.")
+    parser.add_argument('--heights', type=int, nargs='+', default=[576, 1500, 3000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # Build the blue-noise map up front so it is not charged to the first run
+    blue_noise_matrix()
+
+    print(f"{'mode':<28}" + ''.join(f"{f'{PRINTER_WIDTH}x{height}':>14}" for height in args.heights))
+    for mode in DITHER_OPTIONS:
+        row = f"{mode:<28}"
+        for height in args.heights:
+            image = synthetic_image(height)
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                apply_dither(image, mode)
+                timings.append(time.perf_counter() - start)
+            row += f"{min(timings) * 1000:>11.1f} ms"
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Upload size and server-side decode time of a canvas drawing sent as a base64 PNG data URL
+# (the original /print_drawing form) against packed 1-bit rows, raw and PackBits-compressed.
+# Run from the repository root:
+#     python -m benchmarks.bench_drawing_upload
+#     python -m benchmarks.bench_drawing_upload --strokes 400 --text "Happy birthday"
+import argparse
+import base64
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from app.printing import drawing_bits, unpack_drawing
+
+CANVAS_SIZE = 576  # drawing.js draws on a square canvas the printer's width
+
+
+def synthetic_drawing(strokes, text, seed=0):
+    # Black strokes and text on a transparent canvas, like drawing.js leaves it
+    rng = np.random.default_rng(seed)
+    image = Image.new('RGBA', (CANVAS_SIZE, CANVAS_SIZE), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    points = rng.integers(0, CANVAS_SIZE, (strokes + 1, 2))
+    for start, end in zip(points[:-1], points[1:]):
+        draw.line((*start, *end), fill=(0, 0, 0, 255), width=int(rng.integers(2, 8)))
+    if text:
+        try:
+            font = ImageFont.truetype('DejaVuSans.ttf', 54)
+        except OSError:
+            font = ImageFont.load_default(54)
+        draw.text((20, CANVAS_SIZE // 2), text, fill=(0, 0, 0, 255), font=font)
+    return image
+
+
+def pack_bits(data):
+    # The PackBits encoder drawing.js uses
+    out = bytearray()
+    position = 0
+    while position < len(data):
+        run = 1
+        while run < 128 and position + run < len(data) and data[position + run] == data[position]:
+            run += 1
+        if run > 1:
+            out += bytes((257 - run, data[position]))
+            position += run
+            continue
+        end = position + 1
+        while end < len(data) and end - position < 128 and not (
+                end + 2 < len(data) and data[end] == data[end + 1] == data[end + 2]):
+            end += 1
+        out.append(end - position - 1)
+        out += data[position:end]
+        position = end
+    return bytes(out)
+
+
+def timed(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        samples.append(time.perf_counter() - start)
+    return result, sorted(samples)[len(samples) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare drawing upload formats for /print_drawing.")
+    parser.add_argument('--strokes', type=int, default=60, help="Random pencil strokes in the drawing")
+    parser.add_argument('--text', default="Hello!", help="Text drawn on the canvas; empty for none")
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    drawing = synthetic_drawing(args.strokes, args.text)
+    buffer = BytesIO()
+    drawing.save(buffer, 'PNG')
+    data_url = 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+    expected = drawing_bits(drawing)
+    packed = expected.tobytes()
+    compressed = pack_bits(packed)
+
+    def from_data_url():
+        image = Image.open(BytesIO(base64.b64decode(data_url.split(',')[1])))
+        return drawing_bits(image)
+
+    cases = [
+        ('base64 PNG data URL', len(data_url), lambda: from_data_url()),
+        ('packed 1-bit', len(packed), lambda: unpack_drawing(packed, CANVAS_SIZE, CANVAS_SIZE)),
+        ('packed 1-bit, PackBits', len(compressed),
+         lambda: unpack_drawing(compressed, CANVAS_SIZE, CANVAS_SIZE, 'packbits')),
+    ]
+    print(f"{'format':<26}{'upload':>12}{'decode p50':>14}")
+    for name, size, decode in cases:
+        bits, seconds = timed(decode, args.repeat)
+        assert np.array_equal(bits, expected), f"{name} did not decode to the same raster"
+        print(f"{name:<26}{size / 1024:>9.1f} KiB{seconds * 1000:>11.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
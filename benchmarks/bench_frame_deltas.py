@@ -0,0 +1,91 @@
+# Bytes per live-frame update with tile deltas against sending every frame whole.
+# Run from the repository root on a real frame sequence, either a folder of images
+# (sorted by name) or a video sampled the way the slow movie player advances:
+#     python -m benchmarks.bench_frame_deltas --video movie.mp4 --step 4
+#     python -m benchmarks.bench_frame_deltas --frames frames/
+import argparse
+import os
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from app.frame_store import FRAME_TILE_SIZE, decode_frame, encode_delta
+from app.image_processing import DITHER_OPTIONS, apply_dither
+
+DISPLAY_SIZE = (800, 480)  # The e-ink panel the player drives
+
+
+def video_frames(path, step, count, start):
+    capture = cv2.VideoCapture(path)
+    capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+    for _ in range(count):
+        ok, frame = capture.read()
+        if not ok:
+            break
+        yield Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        for _ in range(step - 1):
+            capture.grab()
+    capture.release()
+
+
+def folder_frames(path, count):
+    names = sorted(name for name in os.listdir(path) if not name.startswith('.'))
+    for name in names[:count]:
+        yield Image.open(os.path.join(path, name))
+
+
+def as_posted(frame, dither):
+    # The PNG the player would post: panel-sized grayscale, optionally dithered to 1-bit
+    frame = frame.convert('L').resize(DISPLAY_SIZE, Image.LANCZOS)
+    if dither:
+        frame = apply_dither(frame, dither)
+    buffer = BytesIO()
+    frame.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure bytes per live-frame update with tile deltas.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--video', help="Video file to sample frames from")
+    source.add_argument('--frames', help="Folder of frame images, in name order")
+    parser.add_argument('--step', type=int, default=4, help="Video frames between updates")
+    parser.add_argument('--start', type=int, default=0, help="First video frame")
+    parser.add_argument('--count', type=int, default=100, help="Updates to measure")
+    parser.add_argument('--dither', choices=DITHER_OPTIONS, help="Dither frames to 1-bit like an e-ink feed")
+    args = parser.parse_args()
+
+    frames = (video_frames(args.video, args.step, args.count, args.start) if args.video
+              else folder_frames(args.frames, args.count))
+
+    whole, sent, tiles, keyframes = [], [], [], 0
+    previous = None
+    for frame in frames:
+        image = as_posted(frame, args.dither)
+        current = decode_frame(image)
+        delta = encode_delta(previous, current, len(image)) if previous is not None else None
+        whole.append(len(image))
+        if delta:
+            sent.append(len(delta[0]))
+            tiles.append(delta[1])
+        else:
+            sent.append(len(image))
+            keyframes += 1
+        previous = current
+
+    if not whole:
+        parser.error("no frames found")
+    total_tiles = -(-DISPLAY_SIZE[0] // FRAME_TILE_SIZE) * -(-DISPLAY_SIZE[1] // FRAME_TILE_SIZE)
+    print(f"updates:                {len(whole)}")
+    print(f"keyframes:              {keyframes} (first frame plus {keyframes - 1} where a delta would not pay)")
+    if tiles:
+        print(f"changed tiles/delta:    {np.mean(tiles):.1f} of {total_tiles}")
+    print(f"whole frame bytes:      {np.mean(whole):>10.0f} per update")
+    print(f"with deltas bytes:      {np.mean(sent):>10.0f} per update")
+    print(f"saved:                  {100 * (1 - sum(sent) / sum(whole)):>9.1f} %")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+# Latency, peak memory and per-stage allocations of the image pipeline for every settings
+# profile and dither mode, on synthetic photos from 0.3 to 48 MP and any sample images given.
+# Run from the repository root:
+#     python -m benchmarks.bench_pipeline --save baseline
+#     python -m benchmarks.bench_pipeline --compare baseline [image ...]
+# Baselines are JSON files in benchmarks/baselines/; comparing exits non-zero on a regression.
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.compare_resize_first import peak_rss_kb, synthetic_photo
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+SYNTHETIC_MEGAPIXELS = [0.3, 2, 12, 24, 48]
+PERCENTILES = (50, 90, 99)
+# Changes smaller than these are timer and allocator noise, whatever the ratio
+NOISE_MS = 1
+NOISE_KB = 1024
+
+
+def percentiles(samples):
+    return {f'p{q}': round(float(np.percentile(samples, q)) * 1000, 2) for q in PERCENTILES}
+
+
+class StageAllocations:
+    # Peak traced allocation inside each stage on top of what was live when it started.
+    # tracemalloc sees NumPy and OpenCV arrays, not Pillow's own image buffers.
+    def __init__(self):
+        self.peaks = {}
+        self.start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+    def __call__(self, name, stage, seconds):
+        current, peak = tracemalloc.get_traced_memory()
+        self.peaks[stage] = max(self.peaks.get(stage, 0), peak - self.start)
+        self.start = current
+        tracemalloc.reset_peak()
+
+
+def run_case(path, profile, repeat, results):
+    # One image and profile in a fresh process, so the peak RSS belongs to this case alone
+    from io import BytesIO
+
+    from app import metrics
+    from app.image_processing import DITHER_OPTIONS, apply_dither, preprocess_image
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    # One untimed run so compiled profiles and threshold maps are not charged to the first sample
+    gray_image, _ = preprocess_image(BytesIO(data), False, profile=profile)
+    for option in DITHER_OPTIONS:
+        apply_dither(gray_image, option)
+
+    stage_times = {}
+    metrics.stage_listeners.append(lambda name, stage, seconds: stage_times.setdefault(stage, []).append(seconds))
+    baseline = peak_rss_kb()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        gray_image, _ = preprocess_image(BytesIO(data), False, profile=profile)
+        latencies.append(time.perf_counter() - start)
+    peak = peak_rss_kb() - baseline
+    metrics.stage_listeners.clear()
+
+    dither = {}
+    for option in DITHER_OPTIONS:
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            apply_dither(gray_image, option)
+            samples.append(time.perf_counter() - start)
+        dither[option] = percentiles(samples)
+
+    # Allocations get their own run, since tracing slows everything down
+    tracemalloc.start()
+    allocations = StageAllocations()
+    metrics.stage_listeners.append(allocations)
+    preprocess_image(BytesIO(data), False, profile=profile)
+    apply_dither(gray_image, 'FLOYDSTEINBERG_SERPENTINE')
+    tracemalloc.stop()
+
+    results.put({
+        'preprocess': percentiles(latencies),
+        'stages': {stage: {'p50': percentiles(samples)['p50'],
+                           'alloc_kb': round(allocations.peaks.get(stage, 0) / 1024)}
+                   for stage, samples in stage_times.items()},
+        'peak_rss_kb': peak,
+        'dither': dither,
+    })
+
+
+def measure(path, profile, repeat):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_case, args=(path, profile, repeat, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def synthetic_images(scratch, megapixels):
+    images = []
+    for mp in megapixels:
+        width = int((mp * 1e6 * 4 / 3) ** 0.5)
+        size = (width, width * 3 // 4)
+        path = os.path.join(scratch, f'synthetic_{mp:g}mp.jpg')
+        synthetic_photo(path, size)
+        images.append(path)
+    return images
+
+
+def report(name, case):
+    preprocess = case['preprocess']
+    print(f"{name:<40}{preprocess['p50']:>9.1f}{preprocess['p90']:>9.1f}{preprocess['p99']:>9.1f} ms"
+          f"{case['peak_rss_kb'] / 1024:>9.1f} MB  ({case['megapixels']:g} MP)")
+    for stage, values in case['stages'].items():
+        print(f"    {stage:<36}{values['p50']:>9.1f} ms{values['alloc_kb'] / 1024:>19.1f} MB allocated")
+    for option, values in case['dither'].items():
+        print(f"    dither {option:<29}{values['p50']:>9.1f}{values['p90']:>9.1f}{values['p99']:>9.1f} ms")
+
+
+def compare(current, baseline, tolerance):
+    # Latency p50s and peak RSS that grew by more than the tolerance
+    regressions = []
+    for name, case in current.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        checks = [('preprocess p50', case['preprocess']['p50'], before['preprocess']['p50'], NOISE_MS),
+                  ('peak RSS', case['peak_rss_kb'], before['peak_rss_kb'], NOISE_KB)]
+        checks += [(f'dither {option} p50', values['p50'], before['dither'].get(option, {}).get('p50'), NOISE_MS)
+                   for option, values in case['dither'].items()]
+        for label, now, then, noise in checks:
+            if then and now > then * (1 + tolerance) and now - then > noise:
+                regressions.append(f"{name}: {label} {then} -> {now} (+{(now / then - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main():
+    from app.image_processing import settings
+
+    parser = argparse.ArgumentParser(description="Benchmark the image pipeline across sizes, profiles and dither modes.")
+    parser.add_argument('images', nargs='*', help="Sample images to include besides the synthetic ones")
+    parser.add_argument('--megapixels', type=float, nargs='*', default=SYNTHETIC_MEGAPIXELS,
+                        help="Synthetic photo sizes; pass none to skip them")
+    parser.add_argument('--profiles', nargs='+', choices=list(settings), default=list(settings))
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--save', metavar='NAME', help="Write the results to benchmarks/baselines/NAME.json")
+    parser.add_argument('--compare', metavar='NAME', help="Check the results against a saved baseline")
+    parser.add_argument('--tolerance', type=float, default=0.15, help="Allowed slowdown before a regression")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as scratch:
+        images = synthetic_images(scratch, args.megapixels) + args.images
+        print(f"{'image / profile':<40}{'p50':>9}{'p90':>9}{'p99':>9}   {'peak RSS':>9}")
+        for path in images:
+            with Image.open(path) as image:
+                megapixels = round(image.width * image.height / 1e6, 1)
+            for profile in args.profiles:
+                name = f"{os.path.basename(path)}/{profile}"
+                case = measure(path, profile, args.repeat)
+                case['megapixels'] = megapixels
+                results[name] = case
+                report(name, case)
+
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(os.path.join(BASELINE_DIR, f'{args.save}.json'), 'w') as f:
+            json.dump({
+                'machine': {'python': platform.python_version(), 'numpy': np.__version__,
+                            'platform': platform.platform(), 'cpus': os.cpu_count()},
+                'repeat': args.repeat,
+                'results': results,
+            }, f, indent=2)
+
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f'{args.compare}.json')) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# End-to-end print throughput through the spooler into the printer emulator, plus a
+# dot-for-dot check that the paper holds exactly the raster each job asked for.
+# Run from the repository root:
+#     python -m benchmarks.bench_print_jobs --jobs 20 --height 1500
+#     python -m benchmarks.bench_print_jobs --bytes-per-second 0   # transport only, no feed limit
+#     python -m benchmarks.bench_print_jobs --printers 3   # a pool of emulators on consecutive free ports
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from multiprocessing import AuthenticationError
+
+import numpy as np
+from PIL import Image
+
+from app.flow_control import PRINTER_BUFFER_BYTES, PRINTER_BYTES_PER_SECOND
+from app.image_processing import DITHER_OPTIONS, PRINTER_WIDTH, apply_dither
+from app.printing import image_bits
+from app.spooler import SPOOLER_ADDRESS, get_job, list_jobs, run_spooler, submit_job
+from benchmarks.printer_emulator import EMULATOR_PORT, PrinterEmulator
+
+SPOOLER_START_TIMEOUT = 10
+
+
+def job_image(height, index):
+    # A noisy gradient dithered with a different mode per job
+    rng = np.random.default_rng(index)
+    gradient = np.linspace(0, 255, PRINTER_WIDTH)[None, :].repeat(height, axis=0)
+    gray = Image.fromarray(np.clip(gradient + rng.normal(0, 30, gradient.shape), 0, 255).astype(np.uint8))
+    return apply_dither(gray, DITHER_OPTIONS[index % len(DITHER_OPTIONS)])
+
+
+def emulator_ports(first, count):
+    # Consecutive ports from first, stepping over the spooler's own when it listens on TCP
+    taken = {SPOOLER_ADDRESS[1]} if isinstance(SPOOLER_ADDRESS, tuple) else set()
+    ports = []
+    port = first
+    while len(ports) < count:
+        if port not in taken:
+            ports.append(port)
+        port += 1
+    return ports
+
+
+def wait_for_spooler():
+    deadline = time.monotonic() + SPOOLER_START_TIMEOUT
+    while True:
+        try:
+            return list_jobs()
+        except (OSError, EOFError, AuthenticationError):
+            # Not listening yet, or its key not written yet
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure print jobs per minute against the printer emulator.")
+    parser.add_argument('--jobs', type=int, default=10)
+    parser.add_argument('--height', type=int, default=1000, help="Rows per printed image")
+    parser.add_argument('--port', type=int, default=EMULATOR_PORT)
+    parser.add_argument('--printers', type=int, default=1, help="Emulated printers in the spooler's pool")
+    parser.add_argument('--bytes-per-second', type=int, default=PRINTER_BYTES_PER_SECOND,
+                        help="Emulated feed rate; 0 takes data as fast as it arrives")
+    parser.add_argument('--buffer-bytes', type=int, default=PRINTER_BUFFER_BYTES)
+    parser.add_argument('--output', help="Also save the printed pages as PNGs here")
+    args = parser.parse_args()
+
+    emulators = [PrinterEmulator(port=port, bytes_per_second=args.bytes_per_second or None,
+                                 buffer_bytes=args.buffer_bytes,
+                                 output=args.output and os.path.join(args.output, f'printer{index + 1}')).start()
+                 for index, port in enumerate(emulator_ports(args.port, args.printers))]
+    printers = [{'name': f'printer{index + 1}', 'host': '127.0.0.1', 'port': emulator.port, 'width': PRINTER_WIDTH}
+                for index, emulator in enumerate(emulators)]
+    images = [job_image(args.height, index) for index in range(args.jobs)]
+
+    with tempfile.TemporaryDirectory() as scratch:
+        # The spooler archives every job; keep those records out of the repository
+        os.makedirs(os.path.join(scratch, 'records', 'images'))
+        os.makedirs(os.path.join(scratch, 'records', 'messages'))
+        os.chdir(scratch)
+        spooler = multiprocessing.Process(target=run_spooler, args=(printers,), daemon=True)
+        spooler.start()
+        wait_for_spooler()
+
+        start = time.perf_counter()
+        job_ids = [submit_job({'type': 'image', 'name': 'bench', 'image': image})['id'] for image in images]
+        deadline = time.monotonic() + 60 + args.jobs * args.height / 50
+        finished = False
+        while time.monotonic() < deadline:
+            if sum(len(emulator.pages) for emulator in emulators) >= len(images):
+                finished = True
+                break
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        records = [get_job(job_id) for job_id in job_ids]
+        spooler.terminate()
+
+    printed = sum(len(emulator.pages) for emulator in emulators)
+    if not finished:
+        print(f"Only {printed} of {len(images)} jobs were printed")
+    # Each printer's pages come out in the order its jobs were dispatched to it
+    pages = {printer['name']: list(emulator.pages) for printer, emulator in zip(printers, emulators)}
+    mismatches = 0
+    for index, (image, record) in enumerate(zip(images, records)):
+        if record['status'] != 'done':
+            continue
+        page = pages[record['printer']].pop(0)
+        expected = image_bits(image)
+        # The raster comes first, then blank feed before the cut
+        if not np.array_equal(page[:expected.shape[0]], expected) or page[expected.shape[0]:].any():
+            mismatches += 1
+            print(f"Job {index + 1} ({DITHER_OPTIONS[index % len(DITHER_OPTIONS)]}) did not print dot for dot")
+
+    received = sum(emulator.received for emulator in emulators)
+    print(f"jobs printed:      {printed} in {elapsed:.2f} s")
+    print(f"jobs per minute:   {printed / elapsed * 60:.1f}")
+    print(f"bytes received:    {received} ({received / elapsed / 1024:.0f} KiB/s)")
+    if len(emulators) > 1:
+        print(f"jobs per printer:  {', '.join(str(len(emulator.pages)) for emulator in emulators)}")
+    print(f"identical output:  {printed - mismatches} of {printed}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Spooler-side work before the first byte reaches the printer, for a photo printed the first
+# time (hash, process, encode, fill the raster cache) against the same photo again and a
+# /reprint of its record (read the cached raster and commands). Run from the repository root:
+#     python -m benchmarks.bench_reprint
+#     python -m benchmarks.bench_reprint --dither ATKINSON photo.jpg
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from io import BytesIO
+
+from app import raster_cache
+from app.image_processing import DITHER_OPTIONS, apply_dither, preprocess_image
+from app.preview_cache import content_hash
+from app.printing import PRINTER_WIDTH, cached_commands, image_bits, raster_commands
+from benchmarks.compare_resize_first import synthetic_photo
+
+IMPL = 'bitImageRaster'
+
+
+def first_print(data, dither):
+    key = raster_cache.raster_key(content_hash(data), dither, None, PRINTER_WIDTH)
+    gray_image, profile = preprocess_image(BytesIO(data), False)
+    image = apply_dither(gray_image, dither)
+    raster_cache.put_raster(key, image_bits(image), image.width, profile)
+    return key, cached_commands(key, IMPL, lambda: raster_commands(image, impl=IMPL))
+
+
+def print_again(data, dither):
+    key = raster_cache.raster_key(content_hash(data), dither, None, PRINTER_WIDTH)
+    # prepare_job loads the raster too, for the spooler to size the job
+    raster_cache.get_raster(key)
+    return key, cached_commands(key, IMPL, lambda: None)
+
+
+def reprint(key):
+    # The record already names the cache entry, so not even the upload is hashed
+    raster_cache.get_raster(key)
+    return key, cached_commands(key, IMPL, lambda: None)
+
+
+def timed(function, repeat, before=None):
+    samples = []
+    for _ in range(repeat):
+        if before:
+            before()
+        start = time.perf_counter()
+        result = function()
+        samples.append(time.perf_counter() - start)
+    return result, sorted(samples)[len(samples) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare first prints with cached prints and reprints.")
+    parser.add_argument('images', nargs='*', help="Photos to use instead of a synthetic 12 MP one")
+    parser.add_argument('--dither', choices=DITHER_OPTIONS, default='FLOYDSTEINBERG')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        raster_cache.RASTER_CACHE_DIR = os.path.join(scratch, 'rasters')
+        images = args.images
+        if not images:
+            images = [os.path.join(scratch, 'synthetic_4000x3000.jpg')]
+            synthetic_photo(images[0], (4000, 3000))
+        print(f"{'image':<28}{'first print':>13}{'same upload':>13}{'reprint':>11}{'bytes':>10}")
+        for path in images:
+            with open(path, 'rb') as f:
+                data = f.read()
+            (key, expected), first = timed(lambda: first_print(data, args.dither), args.repeat,
+                                           lambda: shutil.rmtree(raster_cache.RASTER_CACHE_DIR, ignore_errors=True))
+            (_, again_commands), again = timed(lambda: print_again(data, args.dither), args.repeat)
+            (_, reprint_commands), repeat = timed(lambda: reprint(key), args.repeat)
+            assert again_commands == reprint_commands == expected, "cached commands differ from the encoded ones"
+            print(f"{os.path.basename(path):<28}{first * 1000:>10.1f} ms{again * 1000:>10.1f} ms"
+                  f"{repeat * 1000:>8.2f} ms{sum(map(len, expected)):>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Time to the first raster command and peak memory for a tall upload, processed whole
+# (process_image, then raster_commands) against band by band (app/strips.py).
+# Run from the repository root:
+#     python -m benchmarks.bench_strips
+#     python -m benchmarks.bench_strips --height 40000 --dither ATKINSON
+#     python -m benchmarks.bench_strips receipt.png
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from benchmarks.compare_resize_first import peak_rss_kb, synthetic_photo
+
+STRIP_MODES = ('whole', 'strips')
+
+
+def run_case(path, mode, dither, results):
+    # One run per fresh process, so the peak RSS belongs to it alone
+    from app.image_processing import process_image
+    from app.printing import bits_commands, raster_commands
+    from app.strips import open_strips
+
+    baseline = peak_rss_kb()
+    start = time.perf_counter()
+    first = None
+    sent = 0
+    if mode == 'whole':
+        image, _ = process_image(path, dither, False)
+        for command in raster_commands(image):
+            first = first or time.perf_counter() - start
+            sent += len(command)
+    else:
+        strips = open_strips(path, dither)
+        for band in strips.process():
+            for command in bits_commands(band, strips.width):
+                first = first or time.perf_counter() - start
+                sent += len(command)
+    results.put({'first': first, 'total': time.perf_counter() - start, 'bytes': sent,
+                 'peak_rss_kb': peak_rss_kb() - baseline})
+
+
+def measure(path, mode, dither):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_case, args=(path, mode, dither, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    from app.image_processing import DITHER_OPTIONS
+
+    parser = argparse.ArgumentParser(description="Compare whole-image and band-by-band processing of tall uploads.")
+    parser.add_argument('images', nargs='*', help="Tall images to use instead of a synthetic one")
+    parser.add_argument('--width', type=int, default=1152, help="Width of the synthetic image")
+    parser.add_argument('--height', type=int, default=20000, help="Height of the synthetic image")
+    parser.add_argument('--dither', choices=DITHER_OPTIONS, default='FLOYDSTEINBERG_SERPENTINE')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        images = args.images
+        if not images:
+            path = os.path.join(scratch, f'synthetic_{args.width}x{args.height}.jpg')
+            synthetic_photo(path, (args.width, args.height))
+            images = [path]
+        print(f"{'image / mode':<44}{'first command':>14}{'total':>10}{'peak RSS':>12}")
+        for path in images:
+            for mode in STRIP_MODES:
+                result = measure(path, mode, args.dither)
+                print(f"{os.path.basename(path) + ' / ' + mode:<44}{result['first'] * 1000:>11.0f} ms"
+                      f"{result['total']:>9.2f}s{result['peak_rss_kb'] / 1024:>9.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
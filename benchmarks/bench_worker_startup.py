@@ -0,0 +1,171 @@
+# Import cost of the app and boot time and memory of gunicorn workers, with and without
+# preload_app. Run from the repository root:
+#     python -m benchmarks.bench_worker_startup
+#     python -m benchmarks.bench_worker_startup --workers 6
+# Worker memory is read from /proc right after boot and again once every worker has
+# processed an image (and so imported OpenCV and friends): PSS counts pages shared with
+# the master and the other workers once, split between them; USS is what each worker
+# holds on its own. The total is the PSS of the master and all its workers.
+import argparse
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import requests
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('numpy', 'cv2', 'PIL', 'escpos', 'requests')
+START_TIMEOUT = 60
+WARM_ROUNDS = 5  # Rounds of concurrent image requests sent at least
+WARM_ATTEMPTS = 50  # Rounds sent at most while some worker still has not imported OpenCV
+
+IMPORT_PROBE = '''
+import sys, time
+start = time.perf_counter()
+from app import create_app
+app = create_app()
+elapsed = time.perf_counter() - start
+rss = [int(line.split()[1]) for line in open('/proc/self/status') if line.startswith('VmRSS:')][0]
+print(elapsed, rss, ' '.join(name for name in {heavy!r} if name in sys.modules))
+'''
+
+
+def import_profile():
+    # A fresh interpreter each time, so nothing is already imported
+    output = subprocess.run([sys.executable, '-c', IMPORT_PROBE.format(heavy=HEAVY_MODULES)], cwd=ROOT,
+                            capture_output=True, text=True, check=True).stdout.split(maxsplit=2)
+    return float(output[0]), int(output[1]), output[2].split() if len(output) > 2 else []
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def memory_kb(pid):
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == 'kB':
+                values[fields[0].rstrip(':')] = int(fields[1])
+    return values['Rss'], values['Pss'], values['Private_Clean'] + values['Private_Dirty']
+
+
+def loaded_cv2(pid):
+    with open(f'/proc/{pid}/maps') as f:
+        return 'cv2' in f.read()
+
+
+def test_image():
+    buffer = BytesIO()
+    gradient = np.linspace(0, 255, 800 * 600).reshape(600, 800).astype(np.uint8)
+    Image.fromarray(gradient).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def process_in_every_worker(port, pids, workers):
+    # Requests go to whichever worker accepts first, so keep several in flight until
+    # every worker has handled one. Preloaded workers have OpenCV mapped from the start,
+    # so there the minimum number of rounds has to do.
+    image = test_image()
+
+    def post(_):
+        requests.post(f'http://127.0.0.1:{port}/process_image', files={'image': ('test.png', image)},
+                      data={'dither': 'BAYER_4x4'}, timeout=30).raise_for_status()
+
+    with ThreadPoolExecutor(workers * 4) as pool:
+        for attempt in range(WARM_ATTEMPTS):
+            if attempt >= WARM_ROUNDS and all(loaded_cv2(pid) for pid in pids):
+                return True
+            list(pool.map(post, range(workers * 4)))
+    return False
+
+
+def summary(pids, master):
+    memory = [memory_kb(pid) for pid in pids]
+    return {
+        'rss_kb': sum(rss for rss, _, _ in memory) / len(memory),
+        'pss_kb': sum(pss for _, pss, _ in memory) / len(memory),
+        'uss_kb': sum(uss for _, _, uss in memory) / len(memory),
+        'total_pss_kb': sum(pss for _, pss, _ in memory) + memory_kb(master)[1],
+    }
+
+
+def gunicorn_profile(preload, workers):
+    port = free_port()
+    env = dict(os.environ, PRELOAD_APP='1' if preload else '0')
+    # Run from a scratch directory so the uploads archived on the way land there
+    scratch = tempfile.TemporaryDirectory()
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn_config.py'),
+                               '--pythonpath', ROOT, '--bind', f'127.0.0.1:{port}', '--workers', str(workers),
+                               'run:app'], cwd=scratch.name, env=env, stderr=subprocess.PIPE, text=True)
+    booted = {}
+    try:
+        # gunicorn_config.py logs each worker once it can take requests
+        deadline = time.monotonic() + START_TIMEOUT
+        for line in server.stderr:
+            match = re.search(r'Worker (\d+) ready in (\d+) ms', line)
+            if match:
+                booted[int(match.group(1))] = int(match.group(2))
+            if len(booted) == workers or time.monotonic() > deadline:
+                break
+        ready = time.perf_counter() - start
+        first = time.perf_counter()
+        requests.get(f'http://127.0.0.1:{port}/drawing', timeout=10).raise_for_status()
+        first = time.perf_counter() - first
+        booted_memory = summary(booted, server.pid)
+        warm = process_in_every_worker(port, booted, workers)
+        warm_memory = summary(booted, server.pid)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=30)
+        scratch.cleanup()
+    return {
+        'ready': ready,
+        'boot_ms': sorted(booted.values()),
+        'first_request': first,
+        'booted': booted_memory,
+        'warm': warm_memory if warm else None,
+    }
+
+
+def memory_columns(memory):
+    if memory is None:
+        return f"{'not every worker reached':>36}"
+    return ''.join(f"{memory[key] / 1024:>7.1f}MB" for key in ('rss_kb', 'pss_kb', 'uss_kb', 'total_pss_kb'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure app import cost and gunicorn worker startup.")
+    parser.add_argument('--workers', type=int, default=3)
+    args = parser.parse_args()
+
+    elapsed, rss, heavy = import_profile()
+    print(f"create_app: {elapsed * 1000:.0f} ms, {rss / 1024:.1f} MB RSS, "
+          f"heavy modules loaded: {', '.join(heavy) or 'none'}")
+
+    print(f"{'gunicorn':<26}{'all ready':>10}{'worker boot':>14}{'first /drawing':>16}"
+          f"{'RSS':>9}{'PSS':>9}{'USS':>9}{'total':>9}")
+    for preload in (False, True):
+        result = gunicorn_profile(preload, args.workers)
+        boot = f"{min(result['boot_ms'])}-{max(result['boot_ms'])} ms"
+        name = 'preload' if preload else 'no preload'
+        print(f"{name + ', booted':<26}{result['ready']:>9.2f}s{boot:>14}"
+              f"{result['first_request'] * 1000:>13.0f} ms{memory_columns(result['booted'])}")
+        print(f"{name + ', images processed':<26}{'':>40}{memory_columns(result['warm'])}")
+
+
+if __name__ == '__main__':
+    main()
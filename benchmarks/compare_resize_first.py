@@ -0,0 +1,96 @@
+# Quality, latency and peak-memory check of resize-first processing against the
+# full-resolution path. Run from the repository root:
+#     python -m benchmarks.compare_resize_first [image ...]
+# Without arguments it uses synthetic photo-like JPEGs of 12, 24 and 48 MP.
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+SYNTHETIC_SIZES = [(4000, 3000), (5656, 4242), (8000, 6000)]
+
+
+def synthetic_photo(path, size, seed=0):
+    # Smooth shapes scaled up to full size plus sensor-like noise, saved as a JPEG
+    rng = np.random.default_rng(seed)
+    scene = np.zeros((300, 400, 3), dtype=np.float32)
+    scene += np.linspace(40, 200, 400)[None, :, None]
+    for _ in range(25):
+        center = (int(rng.integers(0, 400)), int(rng.integers(0, 300)))
+        cv2.circle(scene, center, int(rng.integers(10, 80)), rng.uniform(0, 255, 3).tolist(), -1)
+    scene = cv2.GaussianBlur(scene, (0, 0), 2)
+    photo = cv2.resize(scene, size, interpolation=cv2.INTER_CUBIC)
+    photo += rng.normal(0, 6, photo.shape).astype(np.float32)
+    Image.fromarray(np.clip(photo, 0, 255).astype(np.uint8)).save(path, quality=90)
+
+
+def peak_rss_kb():
+    # VmHWM starts fresh in a new process; ru_maxrss can carry over the parent's peak
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_preprocess(path, resize_first, results):
+    from app.image_processing import preprocess_image
+
+    baseline = peak_rss_kb()
+    start = time.perf_counter()
+    image, profile = preprocess_image(path, False, resize_first=resize_first)
+    elapsed = time.perf_counter() - start
+    peak = peak_rss_kb() - baseline
+    results.put((np.asarray(image), profile, elapsed, peak))
+
+
+def measure(path, resize_first):
+    # A fresh process per run so peak RSS belongs to this upload alone
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_preprocess, args=(path, resize_first, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare resize-first processing with the full-resolution path.")
+    parser.add_argument('images', nargs='*')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        images = args.images
+        if not images:
+            images = []
+            for size in SYNTHETIC_SIZES:
+                path = os.path.join(scratch, f'synthetic_{size[0]}x{size[1]}.jpg')
+                synthetic_photo(path, size)
+                images.append(path)
+
+        print(f"{'image':<32}{'full':>10}{'first':>10}{'full RSS':>12}{'first RSS':>12}{'PSNR':>8}  profile")
+        for path in images:
+            full, full_profile, full_time, full_peak = measure(path, False)
+            first, first_profile, first_time, first_peak = measure(path, True)
+            profile = full_profile if full_profile == first_profile else f"{full_profile} -> {first_profile}"
+            print(f"{os.path.basename(path)[:31]:<32}{full_time * 1000:>8.0f}ms{first_time * 1000:>8.0f}ms"
+                  f"{full_peak / 1024:>10.0f}MB{first_peak / 1024:>10.0f}MB{psnr(full, first):>8.1f}  {profile}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+# A stand-in for the network thermal printer. It accepts the ESC/POS stream app/printing.py
+# sends, renders each cut to a PNG, answers DLE EOT status requests, and takes data no
+# faster than a printer with the given feed rate and buffer would. Run from the repository root:
+#     python -m benchmarks.printer_emulator --output paper/
+#     PRINTER_IP=127.0.0.1 python run.py
+import argparse
+import codecs
+import logging
+import os
+import re
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+from escpos.capabilities import get_profile
+from PIL import Image, ImageDraw, ImageFont
+
+EMULATOR_PORT = 9100
+PAPER_WIDTH = 576  # Dots across the paper
+LINE_HEIGHT = 24  # Dots per text line and per ESC d feed line; font A is 12x24
+RECEIVE_BYTES = 4096
+KERNEL_BUFFER_BYTES = 65536
+STATUS_ONLINE = b'\x12'  # DLE EOT reply: fixed bits only, nothing wrong
+# Real-time status requests are answered on arrival, wherever they fall in the stream
+REAL_TIME_STATUS = re.compile(rb'\x10\x04[\x01-\x04]')
+
+# ESC commands and how many argument bytes follow them
+ESC_ARGUMENTS = {b'@': 0, b'!': 1, b'-': 1, b'2': 0, b'3': 1, b'E': 1, b'G': 1, b'J': 1, b'M': 1,
+                 b'a': 1, b'c': 2, b'd': 1, b't': 1, b'{': 1, b'p': 3}
+GS_ARGUMENTS = {b'!': 1, b'B': 1, b'H': 1, b'L': 2, b'W': 2, b'f': 1, b'h': 1, b'w': 1}
+
+
+def code_pages():
+    # ESC t numbers as python-escpos assigns them, for the ones Python has a codec for
+    pages = {}
+    for number, name in get_profile().profile_data['codePages'].items():
+        try:
+            pages[int(number)] = codecs.lookup(name).name
+        except LookupError:
+            continue
+    return pages
+
+
+CODE_PAGES = code_pages()
+
+
+def text_font():
+    # DejaVu covers the accented characters people send; Pillow's own font is the fallback
+    try:
+        return ImageFont.truetype('DejaVuSans.ttf', LINE_HEIGHT - 4)
+    except OSError:
+        return ImageFont.load_default(LINE_HEIGHT - 4)
+
+
+class Paper:
+    # Printed rows as packed bits, MSB first, 1 = black: the layout encode_raster sends
+    def __init__(self, width):
+        self.width = width
+        self.rows = []
+        self.line = []  # Characters of the text line being built
+        self.code_page = 'cp437'
+        self.stored = None  # Raster held by GS ( L until it is printed
+        self.font = text_font()
+
+    def raster(self, block):
+        # Blocks narrower than the paper are padded on the right
+        rows, width_bytes = block.shape
+        packed = np.zeros((rows, self.width // 8), dtype=np.uint8)
+        packed[:, :min(width_bytes, self.width // 8)] = block[:, :self.width // 8]
+        self.rows.append(packed)
+
+    def feed(self, lines):
+        self.flush_line()
+        self.rows.append(np.zeros((lines * LINE_HEIGHT, self.width // 8), dtype=np.uint8))
+
+    def flush_line(self, newline=False):
+        if not self.line and not newline:
+            return
+        text = ''.join(self.line)
+        self.line.clear()
+        line = Image.new('L', (self.width, LINE_HEIGHT), 255)
+        ImageDraw.Draw(line).text((0, 0), text, fill=0, font=self.font)
+        self.rows.append(np.packbits(np.asarray(line) < 128, axis=1))
+
+    def take(self):
+        self.flush_line()
+        rows = np.vstack(self.rows) if self.rows else np.zeros((0, self.width // 8), dtype=np.uint8)
+        self.rows = []
+        return rows
+
+
+def page_image(rows):
+    # Mode '1' stores 1 as white, so the bits are flipped on the way out
+    return Image.frombytes('1', (rows.shape[1] * 8, rows.shape[0]), np.invert(rows).tobytes())
+
+
+class PrinterEmulator:
+    def __init__(self, host='127.0.0.1', port=EMULATOR_PORT, width=PAPER_WIDTH,
+                 bytes_per_second=None, buffer_bytes=16384, output=None):
+        self.host = host
+        self.port = port
+        self.width = width
+        self.bytes_per_second = bytes_per_second  # None takes data as fast as it comes
+        self.buffer_bytes = buffer_bytes
+        self.output = output
+        self.pages = []  # One packed-bit array per cut
+        self.received = 0
+        self.cut_event = threading.Condition()
+        self.server = None
+
+    def start(self):
+        if self.server is None:
+            self.server = socket.create_server((self.host, self.port))
+        threading.Thread(target=self.serve_forever, name='printer-emulator', daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        if self.server is None:
+            self.server = socket.create_server((self.host, self.port))
+        # Like the real thing, one connection is served at a time
+        while True:
+            conn, address = self.server.accept()
+            logging.info(f"Emulator connected to {address[0]}:{address[1]}")
+            # Keep the kernel from hiding much of the printer's own buffer; going below one
+            # loopback segment (64 KiB) stalls every window on delayed ACKs
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, KERNEL_BUFFER_BYTES)
+            try:
+                self.serve(conn)
+            except OSError as e:
+                logging.error(f"Emulator connection failed: {e}")
+            finally:
+                conn.close()
+
+    def serve(self, conn):
+        paper = Paper(self.width)
+        pending = bytearray()
+        tail = b''
+        level, last = 0.0, time.monotonic()
+        while True:
+            if self.bytes_per_second:
+                # The buffer drains at the feed rate; nothing more is read while it is full
+                now = time.monotonic()
+                level = max(0.0, level - (now - last) * self.bytes_per_second)
+                last = now
+                room = self.buffer_bytes - level
+                if room < 1:
+                    time.sleep((1 - room) / self.bytes_per_second)
+                    continue
+                data = conn.recv(int(min(room, RECEIVE_BYTES)))
+                level += len(data)
+            else:
+                data = conn.recv(RECEIVE_BYTES)
+            if not data:
+                return
+            self.received += len(data)
+            # Like a real printer, answer DLE EOT as soon as it arrives, even inside another
+            # command's data, where it also still counts as data
+            window = tail + data
+            for _ in REAL_TIME_STATUS.finditer(window):
+                conn.sendall(STATUS_ONLINE)
+            tail = window[-2:]
+            pending += data
+            consumed = self.parse(pending, paper, conn)
+            del pending[:consumed]
+
+    def parse(self, data, paper, conn):
+        # Runs every complete command at the start of data and returns how many bytes it used
+        position = 0
+        while position < len(data):
+            used = self.command(data, position, paper, conn)
+            if used is None:
+                break
+            position += used
+        return position
+
+    def command(self, data, position, paper, conn):
+        # Bytes used by the command at position, or None when it has not all arrived yet
+        available = len(data) - position
+        byte = data[position]
+        if byte == 0x0a:
+            paper.flush_line(newline=True)
+            return 1
+        if byte == 0x0d:
+            return 1
+        if byte == 0x10:
+            # DLE EOT and friends were answered when they arrived
+            return 3 if available >= 3 else None
+        if byte == 0x1b:
+            if available < 2:
+                return None
+            command = bytes(data[position + 1:position + 2])
+            arguments = ESC_ARGUMENTS.get(command)
+            if arguments is None:
+                logging.warning(f"Emulator skipped unknown command ESC {command!r}")
+                return 2
+            if available < 2 + arguments:
+                return None
+            self.escape(command, data[position + 2:position + 2 + arguments], paper)
+            return 2 + arguments
+        if byte == 0x1d:
+            if available < 2:
+                return None
+            return self.group_separator(data, position, paper)
+        paper.line.append(bytes([byte]).decode(paper.code_page, errors='replace'))
+        return 1
+
+    def escape(self, command, arguments, paper):
+        if command == b'@':
+            paper.flush_line()
+            paper.code_page = 'cp437'
+        elif command == b'd':
+            paper.feed(arguments[0])
+        elif command == b'J':
+            paper.flush_line()
+            paper.rows.append(np.zeros((arguments[0], paper.width // 8), dtype=np.uint8))
+        elif command == b't':
+            paper.code_page = CODE_PAGES.get(arguments[0], 'cp437')
+
+    def group_separator(self, data, position, paper):
+        available = len(data) - position
+        command = bytes(data[position + 1:position + 2])
+        if command == b'v':
+            # GS v 0 m xL xH yL yH, then the raster
+            if available < 8:
+                return None
+            width_bytes, rows = struct.unpack_from('<HH', data, position + 4)
+            end = 8 + width_bytes * rows
+            if available < end:
+                return None
+            block = np.frombuffer(bytes(data[position + 8:position + end]), dtype=np.uint8)
+            paper.flush_line()
+            paper.raster(block.reshape(rows, width_bytes))
+            return end
+        if command == b'(':
+            # GS ( L pL pH m fn ...: fn 112 stores a raster, fn 50 prints what is stored
+            if available < 5:
+                return None
+            length = struct.unpack_from('<H', data, position + 3)[0]
+            if available < 5 + length:
+                return None
+            body = bytes(data[position + 5:position + 5 + length])
+            if data[position + 2:position + 3] == b'L' and body[1:2] == b'p':
+                width, rows = struct.unpack_from('<HH', body, 6)
+                paper.stored = np.frombuffer(body[10:], dtype=np.uint8).reshape(rows, -(-width // 8))
+            elif data[position + 2:position + 3] == b'L' and body[1:2] == b'2':
+                if paper.stored is not None:
+                    paper.flush_line()
+                    paper.raster(paper.stored)
+                    paper.stored = None
+            return 5 + length
+        if command == b'V':
+            # GS V m, with a feed amount after it for m = 65, 66, 97, 98
+            if available < 3:
+                return None
+            extra = 1 if data[position + 2] in (65, 66, 97, 98) else 0
+            if available < 3 + extra:
+                return None
+            self.cut(paper)
+            return 3 + extra
+        arguments = GS_ARGUMENTS.get(command)
+        if arguments is None:
+            logging.warning(f"Emulator skipped unknown command GS {command!r}")
+            return 2
+        if available < 2 + arguments:
+            return None
+        return 2 + arguments
+
+    def cut(self, paper):
+        rows = paper.take()
+        if self.output:
+            os.makedirs(self.output, exist_ok=True)
+            path = os.path.join(self.output, f'page-{len(self.pages) + 1:04d}.png')
+            page_image(rows).save(path)
+            logging.info(f"Emulator printed {path}")
+        with self.cut_event:
+            self.pages.append(rows)
+            self.cut_event.notify_all()
+
+    def wait_for_pages(self, count, timeout):
+        with self.cut_event:
+            return self.cut_event.wait_for(lambda: len(self.pages) >= count, timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate the network thermal printer.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=EMULATOR_PORT)
+    parser.add_argument('--width', type=int, default=PAPER_WIDTH, help="Paper width in dots")
+    parser.add_argument('--bytes-per-second', type=int, help="Feed rate; unlimited when not given")
+    parser.add_argument('--buffer-bytes', type=int, default=16384, help="Printer receive buffer")
+    parser.add_argument('--output', default='paper', help="Folder for the printed pages")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    emulator = PrinterEmulator(args.host, args.port, args.width, args.bytes_per_second,
+                               args.buffer_bytes, args.output)
+    logging.info(f"Emulating a {args.width}-dot printer on {args.host}:{args.port}")
+    emulator.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,80 @@
+import gc
+import os
+import time
+
 bind = "127.0.0.1:8085"
-workers = 3
\ No newline at end of file
+workers = 3
+
+# Live-display viewers hold an event stream open for as long as the page is up, so idle
+# connections must not each occupy a thread: gevent (in requirements_windows.txt) serves
+# them all from one. Threaded workers remain as a fallback, but there every viewer holds
+# one of the threads for good, and with workers * threads of them nothing else is served.
+try:
+    import gevent  # noqa: F401
+    worker_class = "gevent"
+    worker_connections = 1000
+except ImportError:
+    worker_class = "gthread"
+    threads = 64
+
+
+# Load the app in the master and fork the workers from it, so the libraries and tables
+# it holds are shared copy-on-write instead of built again by every worker. PRELOAD_APP=0
+# has each worker load its own.
+preload_app = os.environ.get('PRELOAD_APP', '1') != '0'
+
+
+def preload_shared_state():
+    # The image and print modules routes.py imports on first use, and the lookup tables
+    # they fill in lazily. Nothing here may start a thread: it would not survive the fork.
+    import app.preview_cache  # noqa: F401
+    import app.printing  # noqa: F401
+    import app.variants  # noqa: F401
+    from app.image_processing import warm_caches
+    warm_caches()
+
+
+def on_starting(server):
+    if server.cfg.worker_class_str == 'gthread':
+        server.log.warning("Threaded workers: each live-display viewer holds one of the %d threads",
+                           server.cfg.workers * server.cfg.threads)
+    # Per-worker pools (app/variants.py) size themselves by it; the workers inherit it
+    os.environ['WEB_CONCURRENCY'] = str(server.cfg.workers)
+    if server.cfg.preload_app:
+        preload_shared_state()
+    # One spooler process owns the printer connection for all workers
+    from app.spooler import start_spooler
+    server.spooler = start_spooler()
+    watch_spooler(server)
+    # Move everything loaded so far out of the collector's reach, so collections in the
+    # workers do not write to (and so copy) the pages they share with the master
+    gc.freeze()
+
+
+def watch_spooler(server):
+    # Gunicorn has no hook in its main loop, but the loop goes through manage_workers about
+    # once a second and as soon as a child exits, the spooler included: a spooler that
+    # died is started again there, by the master, with no threads of its own to fork from
+    from app.spooler import spooler_exited, start_spooler
+
+    manage_workers = server.manage_workers
+
+    def manage_workers_and_spooler():
+        if spooler_exited(server.spooler):
+            server.log.error("Spooler exited; starting it again")
+            try:
+                server.spooler = start_spooler()
+            except RuntimeError as e:
+                # Tried again on the next pass
+                server.log.error("Spooler did not start again: %s", e)
+        manage_workers()
+
+    server.manage_workers = manage_workers_and_spooler
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.monotonic()
+
+
+def post_worker_init(worker):
+    worker.log.info("Worker %s ready in %d ms", worker.pid, (time.monotonic() - worker.forked_at) * 1000)
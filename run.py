@@ -1,8 +1,15 @@
+import os
+
 from app import create_app
+from app.spooler import start_spooler
 from logging_config import setup_logging
 
 setup_logging()
 app = create_app()
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5001)
\ No newline at end of file
+    # Under gunicorn the spooler is started from gunicorn_config.py instead;
+    # with the reloader only the serving child starts it
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_spooler()
+    app.run(debug=True, port=5001)
@@ -0,0 +1,15 @@
+import pytest
+
+from app import frame_store, metrics, preview_cache
+
+
+@pytest.fixture(autouse=True)
+def runtime_dirs(tmp_path, monkeypatch):
+    # The preview cache, frame store and metrics of every test under its own tmp_path, in
+    # this process and any it starts, never in the ones a running server uses
+    for module, name, folder in ((preview_cache, 'PREVIEW_CACHE_DIR', 'previews'),
+                                 (frame_store, 'FRAME_STORE_DIR', 'frames'),
+                                 (metrics, 'METRICS_DIR', 'metrics')):
+        path = str(tmp_path / 'runtime' / folder)
+        monkeypatch.setattr(module, name, path)
+        monkeypatch.setenv(name, path)
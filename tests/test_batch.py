@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from app.batch import CHECKPOINT_FILE, load_checkpoint, run_batch
+
+
+def save_image(path, black_columns):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pixels = np.full((60, 80), 255, dtype=np.uint8)
+    pixels[:, black_columns] = 0
+    Image.fromarray(pixels).save(path)
+    return str(path)
+
+
+def test_same_names_from_different_folders(tmp_path):
+    left = save_image(tmp_path / 'photos' / 'cat.png', slice(0, 40))
+    right = save_image(tmp_path / 'scans' / 'cat.png', slice(40, 80))
+    dog = save_image(tmp_path / 'photos' / 'dog.png', slice(20, 60))
+    output = tmp_path / 'out'
+
+    # The dog is named twice, once on its own and once in its folder
+    finished, failed = run_batch([str(tmp_path / 'photos'), str(tmp_path / 'scans'), dog], str(output), workers=1)
+    assert (finished, failed) == (3, 0)
+
+    outputs = sorted(name for name in os.listdir(output) if name != CHECKPOINT_FILE)
+    assert len(outputs) == 3 and 'processed_dog.png' in outputs
+    cats = [name for name in outputs if name.startswith('processed_cat-')]
+    assert len(cats) == 2
+    # Each cat kept its own picture
+    first, second = (np.asarray(Image.open(output / name).convert('L')) for name in cats)
+    assert not np.array_equal(first, second)
+    assert {entry['path'] for entry in load_checkpoint(str(output))} == {
+        os.path.abspath(left), os.path.abspath(right), os.path.abspath(dog)}
+
+    # A resumed run finds every one of them done
+    assert run_batch([str(tmp_path / 'photos'), str(tmp_path / 'scans')], str(output), workers=1,
+                     resume=True) == (0, 0)
+
+
+def test_missing_input_fails_alone(tmp_path):
+    cat = save_image(tmp_path / 'cat.png', slice(0, 40))
+    output = tmp_path / 'out'
+    assert run_batch([cat, str(tmp_path / 'gone.png')], str(output), workers=1) == (1, 1)
+    assert run_batch([cat, str(tmp_path / 'gone.png')], str(output), workers=1, resume=True) == (0, 1)
@@ -0,0 +1,33 @@
+import os
+
+from app import file_cache
+from app.file_cache import entry_path, write_atomic
+
+ENTRY_BYTES = 1000
+
+
+def put(directory, index, max_bytes):
+    write_atomic(entry_path(str(directory), f'{index:064x}', 'bin'), lambda f: f.write(bytes(ENTRY_BYTES)), max_bytes)
+
+
+def test_least_recently_written_go_first(tmp_path):
+    for index in range(5):
+        put(tmp_path, index, 3 * ENTRY_BYTES)
+        # Distinct mtimes, oldest first
+        os.utime(entry_path(str(tmp_path), f'{index:064x}', 'bin'), (index, index))
+    assert sorted(os.listdir(tmp_path)) == [f'{index:064x}.bin' for index in (2, 3, 4)]
+
+
+def test_directory_measured_only_when_over_budget(tmp_path, monkeypatch):
+    scans = []
+    evict = file_cache.evict
+    monkeypatch.setattr(file_cache, 'evict', lambda *args: scans.append(args) or evict(*args))
+    for index in range(10):
+        put(tmp_path, index, 5 * ENTRY_BYTES)
+    # Once for the first write, then whenever the running total went past five entries
+    assert len(scans) == 6
+    assert len(os.listdir(tmp_path)) == 5
+
+
+def test_rejects_keys_that_are_not_digests(tmp_path):
+    assert entry_path(str(tmp_path), '../escape', 'bin') is None
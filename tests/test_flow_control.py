@@ -0,0 +1,57 @@
+import time
+
+import pytest
+
+from app.flow_control import PRINTER_BYTES_PER_SECOND, PROBE_CEILING, PROBE_FACTOR, FlowControl
+
+
+def test_probing_stops_at_the_ceiling():
+    flow = FlowControl()
+    rates = []
+    for _ in range(20):
+        # A job that only our own pacing slowed down
+        flow.calibrate([], paced=0.5)
+        rates.append(flow.bytes_per_second)
+    assert rates[0] == pytest.approx(PRINTER_BYTES_PER_SECOND * PROBE_FACTOR)
+    assert max(rates) == pytest.approx(PRINTER_BYTES_PER_SECOND * PROBE_CEILING)
+
+
+def test_ceiling_follows_the_measured_rate():
+    flow = FlowControl()
+    measured = PRINTER_BYTES_PER_SECOND / 2
+    for _ in range(20):
+        flow.calibrate([measured] * 3, paced=0)
+    for _ in range(20):
+        flow.calibrate([], paced=0.5)
+    assert flow.bytes_per_second == pytest.approx(measured * PROBE_CEILING)
+
+
+def test_jobs_without_pacing_leave_the_rate_alone():
+    flow = FlowControl()
+    flow.calibrate([], paced=0)
+    assert flow.bytes_per_second == PRINTER_BYTES_PER_SECOND
+
+
+class RecordingPrinter:
+    def __init__(self):
+        self.writes = []
+
+    def _raw(self, data):
+        self.writes.append((time.perf_counter(), len(data)))
+
+
+def test_stall_between_bands_banks_no_burst():
+    # The printer empties its buffer while the next band is worked on, then has to print
+    # the new band at its own rate
+    flow = FlowControl(bytes_per_second=10000, buffer_bytes=1000, chunk_bytes=100)
+    printer = RecordingPrinter()
+
+    def bands():
+        yield bytes(1000)
+        time.sleep(0.5)
+        yield bytes(3000)
+
+    flow.send(printer, bands())
+    after_stall = printer.writes[10:]
+    # The first buffer-full goes out at once, the other 2000 bytes take 0.2 s
+    assert after_stall[-1][0] - after_stall[0][0] >= 0.15
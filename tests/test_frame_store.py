@@ -0,0 +1,65 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.frame_store import DELTA_MAX_CHANGED, FRAME_TILE_SIZE, decode_frame, encode_delta
+
+SIZE = (490, 810)  # Rows and columns, neither a whole number of tiles
+
+
+def png(array):
+    buffer = BytesIO()
+    Image.fromarray(array).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def frames(count, channels=None):
+    # A noisy background with a square moving across it, the way a film scene changes
+    # little from one update to the next
+    rng = np.random.default_rng(0)
+    shape = SIZE + ((channels,) if channels else ())
+    background = rng.integers(0, 256, shape, dtype=np.uint8)
+    for index in range(count):
+        frame = background.copy()
+        frame[100:180, 40 + index * 30:120 + index * 30] = 255 - index * 20
+        yield decode_frame(png(frame))
+
+
+def composite(previous, delta):
+    # What a viewer shows once it draws the delta over the frame it has
+    drawn = np.asarray(Image.open(BytesIO(delta)))
+    opaque = drawn[..., -1] == 255
+    result = previous.copy()
+    result[opaque] = drawn[..., :-1][opaque].reshape(result[opaque].shape)
+    return result
+
+
+@pytest.mark.parametrize('channels', [None, 3])
+def test_delta_over_the_previous_frame_gives_the_next(channels):
+    sequence = list(frames(5, channels))
+    for previous, current in zip(sequence, sequence[1:]):
+        whole = png(current)
+        delta, tiles = encode_delta(previous, current, len(whole))
+        assert np.array_equal(composite(previous, delta), current)
+        assert 0 < tiles and len(delta) < len(whole)
+
+
+def test_whole_frame_once_most_tiles_change():
+    previous, current = frames(2)
+    changed = current.copy()
+    rows = int(SIZE[0] * (DELTA_MAX_CHANGED + 0.1)) // FRAME_TILE_SIZE * FRAME_TILE_SIZE
+    changed[:rows] = 255 - changed[:rows]
+    assert encode_delta(previous, changed) is None
+    # Just under the limit still makes a delta
+    changed = current.copy()
+    rows = int(SIZE[0] * (DELTA_MAX_CHANGED - 0.1)) // FRAME_TILE_SIZE * FRAME_TILE_SIZE
+    changed[:rows] = 255 - changed[:rows]
+    assert encode_delta(previous, changed) is not None
+
+
+def test_whole_frame_when_the_delta_is_no_smaller():
+    previous, current = frames(2)
+    delta, _ = encode_delta(previous, current)
+    assert encode_delta(previous, current, limit=len(delta)) is None
@@ -0,0 +1,181 @@
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip('gevent')
+pytest.importorskip('gunicorn')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VIEWERS = 300  # More event streams than a threaded worker has threads
+START_TIMEOUT = 60
+CONCURRENT = 8  # Requests sent at once
+
+GREENLET_PROBE = '''
+from app import metrics, records
+from gevent import monkey
+monkey.patch_all()
+import gevent
+metrics.METRICS_DIR = {metrics_dir!r}
+
+def first_request():
+    metrics.increment('thermv2_jobs_total', type='probe')
+    records._submit(lambda db: None)
+    print('done')
+
+gevent.joinall([gevent.spawn(first_request) for _ in range({greenlets})])
+records.flush()
+'''
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def server(tmp_path):
+    # One worker with gunicorn_config.py as deployed, its records, spooler socket and key
+    # under tmp_path, and a printer address nothing listens on
+    for folder in ('images', 'messages'):
+        (tmp_path / 'records' / folder).mkdir(parents=True)
+    env = {name: value for name, value in os.environ.items() if not name.startswith('SPOOLER_')}
+    env.update(XDG_RUNTIME_DIR=str(tmp_path), PRINTERS=f'127.0.0.1:{free_port()}')
+    port = free_port()
+    log = tmp_path / 'gunicorn.log'
+    with open(log, 'w') as stderr:
+        process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn_config.py'),
+                                    '--pythonpath', ROOT, '--bind', f'127.0.0.1:{port}', '--workers', '1', 'run:app'],
+                                   cwd=tmp_path, env=env, stderr=stderr)
+    try:
+        deadline = time.monotonic() + START_TIMEOUT
+        while not re.search(r'Worker \d+ ready', log.read_text()):
+            assert process.poll() is None and time.monotonic() < deadline, log.read_text()
+            time.sleep(0.1)
+        yield port, log
+    finally:
+        # SIGINT rather than SIGTERM: a graceful stop would wait for the event streams
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def post_image(port, path, array):
+    # The array as a PNG upload in a multipart form, like the upload page sends it
+    upload = BytesIO()
+    Image.fromarray(array).save(upload, 'PNG')
+    boundary = 'test-upload-boundary'
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="upload.png"\r\n'
+            f'Content-Type: image/png\r\n\r\n').encode() + upload.getvalue() + f'\r\n--{boundary}--\r\n'.encode()
+    return request(port, 'POST', path, body, {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+
+
+def request(port, method, path, body=None, headers=None):
+    connection = HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        connection.request(method, path, body, headers or {})
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def test_event_streams_leave_the_worker_free(server):
+    port, log = server
+    assert 'Using worker: gevent' in log.read_text()
+    viewers = []
+    try:
+        for _ in range(VIEWERS):
+            viewer = socket.create_connection(('127.0.0.1', port), timeout=10)
+            viewer.sendall(b'GET /frames/stream HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            viewers.append(viewer)
+        for viewer in viewers:
+            assert b'text/event-stream' in viewer.recv(4096)
+
+        assert request(port, 'GET', '/drawing')[0] == 200
+        # An upload several times the size of a socket buffer, so the job crosses the
+        # spooler connection in many writes
+        noise = np.random.default_rng(0).integers(0, 256, (700, 1000, 3), dtype=np.uint8)
+        status, body = post_image(port, '/print_image', noise)
+        assert status == 202, body
+    finally:
+        for viewer in viewers:
+            viewer.close()
+
+
+def test_first_requests_start_threads_under_gevent(tmp_path):
+    # The first requests in a worker start its metrics and records threads, with locks
+    # made before gevent patched the worker, as preload_app has it
+    (tmp_path / 'records').mkdir()
+    probe = GREENLET_PROBE.format(metrics_dir=str(tmp_path / 'metrics'), greenlets=CONCURRENT)
+    result = subprocess.run([sys.executable, '-c', probe], cwd=tmp_path, env=dict(os.environ, PYTHONPATH=ROOT),
+                            capture_output=True, text=True, timeout=30)
+    assert result.stdout.split() == ['done'] * CONCURRENT, result.stderr
+
+
+def test_variants_at_once(server):
+    # Requests in one worker share its pool, the rest render in the worker itself, and
+    # none of them may wait on another for good
+    port, _ = server
+    gradient = np.tile(np.linspace(0, 255, 800, dtype=np.uint8), (600, 1))
+    with ThreadPoolExecutor(CONCURRENT) as pool:
+        for _ in range(3):
+            responses = list(pool.map(lambda _: post_image(port, '/process_image/variants', gradient),
+                                      range(CONCURRENT)))
+            assert [status for status, _ in responses] == [200] * CONCURRENT
+
+
+@pytest.mark.parametrize('workers', [1, 2, 3])
+def test_variant_pools_share_the_cpus(workers):
+    # Every worker's pool together stays within the CPUs there are
+    cpus = os.cpu_count() or 1
+    result = subprocess.run([sys.executable, '-c', 'from app import variants; print(variants.VARIANT_PROCESSES)'],
+                            env=dict(os.environ, PYTHONPATH=ROOT, WEB_CONCURRENCY=str(workers)),
+                            capture_output=True, text=True, timeout=30, check=True)
+    assert workers * int(result.stdout) <= cpus
+
+
+def spooler_pid(master):
+    # The master's child that is neither a worker nor a helper with a command line of its own
+    with open(f'/proc/{master}/task/{master}/children') as f:
+        children = f.read().split()
+    with open(f'/proc/{master}/cmdline', 'rb') as f:
+        cmdline = f.read()
+    for child in children:
+        try:
+            with open(f'/proc/{child}/cmdline', 'rb') as f:
+                if f.read() != cmdline:
+                    continue
+        except OSError:
+            continue
+        yield int(child)
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/task'), reason="Needs /proc to find the spooler")
+def test_master_restarts_a_dead_spooler(server):
+    port, log = server
+    workers = {int(pid) for pid in re.findall(r'Booting worker with pid: (\d+)', log.read_text())}
+    master = int(re.search(r'Listening at: \S+ \((\d+)\)', log.read_text()).group(1))
+    spooler, = set(spooler_pid(master)) - workers
+    assert request(port, 'GET', '/printers')[0] == 200
+
+    os.kill(spooler, signal.SIGKILL)
+    deadline = time.monotonic() + START_TIMEOUT
+    while 'Spooler exited; starting it again' not in log.read_text() or request(port, 'GET', '/printers')[0] != 200:
+        assert time.monotonic() < deadline, log.read_text()
+        time.sleep(0.2)
+    assert set(spooler_pid(master)) - workers - {spooler}
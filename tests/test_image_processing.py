@@ -0,0 +1,73 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app import create_app
+from app.image_processing import PRINTER_WIDTH, preprocess_image
+from app.records import flush
+
+WIDE = (PRINTER_WIDTH * 2 + 200, 300)  # Wide enough to be box-reduced before compositing
+
+
+def encoded(image, format):
+    buffer = BytesIO()
+    image.save(buffer, format)
+    buffer.seek(0)
+    return buffer
+
+
+def gradient_rgb():
+    x = np.linspace(0, 255, WIDE[0], dtype=np.uint8)
+    y = np.linspace(0, 255, WIDE[1], dtype=np.uint8)
+    return Image.fromarray(np.dstack([np.tile(x, (WIDE[1], 1)), np.tile(y[:, None], (1, WIDE[0])),
+                                      np.full(WIDE[::-1], 128, dtype=np.uint8)]))
+
+
+@pytest.mark.parametrize('mode, format', [('P', 'PNG'), ('P', 'GIF'), ('transparent P', 'PNG'), ('1', 'PNG'),
+                                          ('I;16', 'PNG'), ('I', 'PNG'), ('LA', 'PNG')])
+def test_wide_uploads_in_any_mode(mode, format):
+    if mode == 'transparent P':
+        image = gradient_rgb().quantize(64)
+        image.info['transparency'] = 0
+    elif mode in ('P', '1', 'LA'):
+        image = gradient_rgb().quantize(64) if mode == 'P' else gradient_rgb().convert(mode)
+    else:
+        image = Image.fromarray(np.tile(np.linspace(0, 65535, WIDE[0]).astype(np.uint16), (WIDE[1], 1)))
+        image = image.convert(mode) if mode == 'I' else image
+    gray_image, _ = preprocess_image(encoded(image, format), False)
+    assert gray_image.size == (PRINTER_WIDTH, int(WIDE[1] * PRINTER_WIDTH / WIDE[0]))
+
+
+def test_palette_upload_matches_rgb():
+    # The colours are what count, not how the file stores them
+    palette = gradient_rgb().quantize(64)
+    from_palette, _ = preprocess_image(encoded(palette, 'PNG'), False)
+    from_rgb, _ = preprocess_image(encoded(palette.convert('RGB'), 'PNG'), False)
+    assert np.array_equal(np.asarray(from_palette), np.asarray(from_rgb))
+
+
+def test_process_image_route_with_palette_upload(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'records' / 'images').mkdir(parents=True)
+    client = create_app().test_client()
+    gif = encoded(gradient_rgb().quantize(64), 'GIF')
+    response = client.post('/process_image', data={'image': (gif, 'party.gif'), 'dither': 'BAYER_4x4'})
+    flush()  # The upload is archived in the background, under tmp_path
+    assert response.status_code == 200
+    assert Image.open(BytesIO(response.data)).width == PRINTER_WIDTH
+
+
+def test_upload_processed_for_narrow_paper(tmp_path, monkeypatch):
+    # A pool of 58 mm printers gets photos 384 dots wide, cached apart from wider ones
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'records' / 'images').mkdir(parents=True)
+    from app.printing import prepare_job
+    job = {'type': 'upload', 'data': encoded(gradient_rgb(), 'PNG').getvalue(), 'dither': 'BAYER_4x4',
+           'name': 'gradient', 'filename': 'gradient.png'}
+    narrow = prepare_job(dict(job), print_width=384)
+    wide = prepare_job(dict(job))
+    flush()
+    assert narrow['image'].width == 384 and wide['image'].width == PRINTER_WIDTH
+    assert narrow['cache_key'] != wide['cache_key']
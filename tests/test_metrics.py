@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from app import metrics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A process that finishes one job and exits well before its first flush
+EXITING_PROCESS = '''
+from app import metrics
+metrics.METRICS_DIR = {metrics_dir!r}
+metrics.increment('thermv2_jobs_total', type='text', status='done')
+metrics.observe('thermv2_print_stage_seconds', 0.02, stage='send')
+metrics.set_gauge('thermv2_printer_healthy', 1, printer='printer1')
+'''
+
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    return tmp_path
+
+
+def run_exiting_process(metrics_dir):
+    subprocess.run([sys.executable, '-c', EXITING_PROCESS.format(metrics_dir=str(metrics_dir))],
+                   env=dict(os.environ, PYTHONPATH=ROOT), check=True, timeout=30)
+
+
+def test_exiting_process_leaves_its_counts(metrics_dir):
+    run_exiting_process(metrics_dir)
+    rendered = metrics.render_metrics()
+    assert 'thermv2_jobs_total{status="done",type="text"} 1' in rendered
+    assert 'thermv2_print_stage_seconds_count{stage="send"} 1' in rendered
+    # Its gauges went with it
+    assert 'thermv2_printer_healthy{' not in rendered
+
+
+def test_exited_processes_fold_into_one_file(metrics_dir):
+    for _ in range(3):
+        run_exiting_process(metrics_dir)
+    first = metrics.render_metrics()
+    assert 'thermv2_jobs_total{status="done",type="text"} 3' in first
+    # Only this process's file and the folded one are left, and folding counts nothing twice
+    assert {name for name in os.listdir(metrics_dir) if name.endswith('.json')} == {
+        metrics.EXITED_FILE, f'{os.getpid()}-{metrics._token}.json'}
+    assert metrics.render_metrics() == first
+
+    run_exiting_process(metrics_dir)
+    assert 'thermv2_jobs_total{status="done",type="text"} 4' in metrics.render_metrics()
+    assert 'thermv2_print_stage_seconds_count{stage="send"} 4' in metrics.render_metrics()
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.printing import FRAGMENT_HEIGHT, PRINTER_WIDTH, encode_raster, fragment_image
+
+escpos_printer = pytest.importorskip('escpos.printer')
+
+HEIGHT = FRAGMENT_HEIGHT * 2 + 37  # Two whole fragments and a short one
+
+
+def noise(width, height, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, (height, width), dtype=np.uint8)
+
+
+def gradient(width, height):
+    return np.tile(np.linspace(0, 255, width, dtype=np.uint8), (height, 1))
+
+
+IMAGES = {
+    '1-bit': lambda: Image.fromarray(noise(PRINTER_WIDTH, HEIGHT) > 127),
+    'binary L': lambda: Image.fromarray(np.where(noise(PRINTER_WIDTH, HEIGHT) > 127, 255, 0).astype(np.uint8)),
+    'gray': lambda: Image.fromarray(gradient(PRINTER_WIDTH, HEIGHT)),
+    'RGBA': lambda: Image.fromarray(np.dstack([gradient(PRINTER_WIDTH, HEIGHT), noise(PRINTER_WIDTH, HEIGHT, 1),
+                                               np.full((HEIGHT, PRINTER_WIDTH), 90, dtype=np.uint8),
+                                               noise(PRINTER_WIDTH, HEIGHT, 2)])),
+    'odd width 1-bit': lambda: Image.fromarray(noise(PRINTER_WIDTH - 3, HEIGHT) > 127),
+    'odd width gray': lambda: Image.fromarray(gradient(PRINTER_WIDTH - 3, HEIGHT)),
+}
+
+
+def escpos_raster(image, impl):
+    # What the spooler sent before encode_raster: one printer.image() call per fragment
+    printer = escpos_printer.Dummy()
+    for fragment in fragment_image(image, FRAGMENT_HEIGHT):
+        printer.image(fragment, impl=impl)
+    return printer.output
+
+
+@pytest.mark.parametrize('impl', ['bitImageRaster', 'graphics'])
+@pytest.mark.parametrize('kind', IMAGES)
+def test_encode_raster_matches_escpos(kind, impl):
+    image = IMAGES[kind]()
+    assert encode_raster(image, impl=impl) == escpos_raster(image, impl)
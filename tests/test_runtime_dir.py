@@ -0,0 +1,24 @@
+import os
+
+import pytest
+
+from app import runtime_dir
+from app.runtime_dir import private_dir
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'getuid'), reason="No file ownership to check")
+
+
+def test_folders_inside_are_closed_to_others(tmp_path, monkeypatch):
+    monkeypatch.setattr(runtime_dir, 'RUNTIME_DIR', str(tmp_path / 'thermv2'))
+    private_dir(str(tmp_path / 'thermv2' / 'previews'))
+    for path in (tmp_path / 'thermv2', tmp_path / 'thermv2' / 'previews'):
+        assert os.stat(path).st_mode & 0o777 == 0o700
+
+
+def test_folder_made_by_someone_else_is_refused(tmp_path):
+    # Made first by another user, open for them to plant files in
+    planted = tmp_path / 'previews'
+    planted.mkdir()
+    planted.chmod(0o777)
+    with pytest.raises(RuntimeError):
+        private_dir(str(planted))
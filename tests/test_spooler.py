@@ -0,0 +1,61 @@
+import threading
+import time
+
+from app import printing, spooler
+from app.spooler import PrinterConnection, Spooler
+
+WAIT_TIMEOUT = 10
+
+
+class FlakyConnection(PrinterConnection):
+    # A printer that answers only while `up` is set
+    def __init__(self):
+        super().__init__('printer1', '127.0.0.1', 9100, 576)
+        self.up = threading.Event()
+
+    def try_connect(self):
+        return self.up.is_set()
+
+    def close(self):
+        pass
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_job_waits_for_a_printer_that_is_briefly_down(monkeypatch):
+    monkeypatch.setattr(spooler, 'RECONNECT_DELAY', 0.01)
+    monkeypatch.setattr(spooler, 'record_print', lambda job_id, seconds: None)
+    printed = []
+    monkeypatch.setattr(printing, 'run_job', lambda printer, job, flow, impl: printed.append(job['message']))
+
+    connection = FlakyConnection()
+    connection.up.set()
+    queue = Spooler([connection])
+    threading.Thread(target=queue.printer_loop, args=(connection,), daemon=True).start()
+    wait_for(lambda: connection.healthy)
+
+    # The printer drops just before a job comes in, which never reaches it
+    connection.up.clear()
+    queue.jobs[1] = {'id': 1, 'type': 'text', 'status': 'queued', 'error': None, 'printer': None}
+    queue.dispatch(1, {'type': 'text', 'name': 'test', 'message': 'hello'}, set())
+    wait_for(lambda: not connection.healthy)
+    assert queue.jobs[1]['status'] == 'queued' and printed == []
+
+    connection.up.set()
+    wait_for(lambda: queue.jobs[1]['status'] == 'done')
+    assert printed == ['hello']
+
+
+def test_uploads_fit_the_narrowest_printer_up():
+    wide, narrow = PrinterConnection('wide', '127.0.0.1', 9100, 576), PrinterConnection('narrow', '127.0.0.1', 9101, 384)
+    queue = Spooler([wide, narrow])
+    assert queue.print_width() == 384
+    wide.healthy = True
+    assert queue.print_width() == 576
+    narrow.healthy = True
+    assert queue.print_width() == 384
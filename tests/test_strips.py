@@ -0,0 +1,32 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.image_processing import DITHER_OPTIONS, PRINTER_WIDTH, apply_dither, preprocess_image
+from app.printing import image_bits
+from app.strips import open_strips
+
+
+def tall_upload(brightness):
+    # Smooth shapes and noise, tall enough to print band by band
+    rng = np.random.default_rng(0)
+    height, width = 2200, 600  # 2112 rows at print width
+    y, x = np.mgrid[0:height, 0:width]
+    photo = 128 + 60 * np.sin(x / 40) * np.cos(y / 90) + rng.normal(0, 12, (height, width))
+    buffer = BytesIO()
+    Image.fromarray(np.clip(photo * brightness, 0, 255).astype(np.uint8)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('brightness', [1.0, 0.3, 0.7, 1.8])
+@pytest.mark.parametrize('dither', DITHER_OPTIONS)
+def test_preview_matches_paper(brightness, dither):
+    # What /process_image shows is what the strips put on paper, dot for dot
+    data = tall_upload(brightness)
+    gray_image, _ = preprocess_image(BytesIO(data), False)
+    preview = image_bits(apply_dither(gray_image, dither))
+    paper = np.vstack(list(open_strips(BytesIO(data), dither).process()))
+    assert gray_image.width == PRINTER_WIDTH
+    assert np.array_equal(preview, paper)